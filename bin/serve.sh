@@ -0,0 +1,31 @@
+#!/usr/bin/env bash
+echo $1
+config_file=$1
+
+source ${config_file}
+
+params=${@:2}
+
+echo "Using CUDA_VISIBLE_DEVICES="$CUDA_VISIBLE_DEVICES
+
+transition_stats=$data_dir/transition_probs.tsv
+
+echo "python3 src/serve.py \
+--transition_stats $transition_stats \
+--data_config $data_config \
+--model_configs $model_configs \
+--task_configs $task_configs \
+--layer_configs $layer_configs \
+--attention_configs "$attention_configs" \
+--hparam "mode=predict" \
+$params"
+
+python3 src/serve.py \
+--transition_stats $transition_stats \
+--data_config $data_config \
+--model_configs $model_configs \
+--task_configs $task_configs \
+--layer_configs $layer_configs \
+--attention_configs "$attention_configs" \
+--hparam "mode=predict" \
+$params
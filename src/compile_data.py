@@ -0,0 +1,49 @@
+from collections import OrderedDict
+
+import tensorflow as tf
+import argparse
+import os
+import train_utils
+import data_generator
+from vocab import Vocab
+import util
+
+arg_parser = argparse.ArgumentParser(description='Compile CoNLL data files into int-mapped binary shards that the '
+                                                 'input pipeline reads instead of the text files.')
+arg_parser.add_argument('--save_dir', required=True,
+                        help='Directory containing (or to contain) the vocabs in assets.extra')
+arg_parser.add_argument('--data_config', required=True,
+                        help='Path to data configuration json')
+arg_parser.add_argument('--train_files',
+                        help='Comma-separated list of training data files. If given, vocabs are built from these and '
+                             'the dev files exactly as in train.py; otherwise the vocabs in save_dir are loaded and '
+                             'updated with the test files as in evaluate_exported.py')
+arg_parser.add_argument('--dev_files',
+                        help='Comma-separated list of development data files')
+arg_parser.add_argument('--test_files',
+                        help='Comma-separated list of test data files')
+
+args, leftovers = arg_parser.parse_known_args()
+
+util.init_logging(tf.logging.INFO)
+
+data_config = train_utils.load_json_configs(args.data_config)
+data_config = OrderedDict(sorted(data_config.items(), key=lambda x: x[1]['conll_idx'] if isinstance(x[1]['conll_idx'], int) else x[1]['conll_idx'][0]))
+
+train_filenames = args.train_files.split(',') if args.train_files else []
+dev_filenames = args.dev_files.split(',') if args.dev_files else []
+test_filenames = args.test_files.split(',') if args.test_files else []
+
+if train_filenames:
+  if not os.path.exists(args.save_dir):
+    os.makedirs(args.save_dir)
+  vocab = Vocab(data_config, args.save_dir, train_filenames)
+  vocab.update(dev_filenames)
+else:
+  if not os.path.isdir(args.save_dir):
+    util.fatal_error("save_dir not found: %s" % args.save_dir)
+  vocab = Vocab(data_config, args.save_dir)
+  vocab.update(test_filenames)
+
+for filename in train_filenames + dev_filenames + test_filenames:
+  data_generator.compile_conll_file(filename, data_config, vocab)
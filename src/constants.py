@@ -7,6 +7,11 @@ OOV_STRING = "<OOV>"
 
 DEFAULT_BUCKET_BOUNDARIES = [20, 30, 50, 80, 100, 120, 150]
 
+# tf.data.experimental.AUTOTUNE
+AUTOTUNE = -1
+
+INPUT_STATS_COLLECTION = 'input_stats'
+
 VERY_LARGE = 1e9
 VERY_SMALL = -1e9
 SMOOTHED_VERY_LARGE = 1e3
@@ -197,7 +202,20 @@ hparams = {
   'correct_vi_objective': False,
   'clip_z_prob': False,
   'sharpen_z_prob': False,
-  'parse_label_count': -1
+  'parse_label_count': -1,
+  'input_num_shards': 1,
+  'input_num_parallel_reads': 0,
+  'input_deterministic': True,
+  'input_map_parallel_calls': AUTOTUNE,
+  'input_prefetch_buffer_size': AUTOTUNE,
+  'input_prefetch_to_device': '',
+  'log_input_stalls': False,
+  'input_stall_threshold_secs': 0.005,
+  'input_cache_dir': '',
+  'prune_embeddings': False,
+  'cwr_streaming': False,
+  'deferred_eval': False,
+  'deferred_eval_background': False
 }
 
 
@@ -1,4 +1,5 @@
 import constants
+import numpy as np
 import tensorflow as tf
 def lowercase_converter(split_line, idx):
   return [split_line[idx].lower()]
@@ -136,3 +137,160 @@ def dispatch(converter_name):
     except KeyError:
       print('Undefined data converter: %s' % converter_name)
       exit(1)
+
+
+'''
+Column-oriented converters.
+
+These mirror the per-token converters above, but take a whole sentence (or any block of tokens with the same
+number of fields) as a 2D string array of shape [num_tokens, num_fields] and convert every token at once with
+NumPy string/array ops. They return a 2D string array of shape [num_tokens, num_outputs].
+'''
+
+
+def _column(columns, idx):
+  return columns[:, idx]
+
+
+def _char_codes(col, width):
+  # unicode code points of the first `width` characters of each string, zero-padded
+  return np.ascontiguousarray(col.astype('U%d' % width)).view(np.uint32).reshape([len(col), width])
+
+
+def _drop_first_char(col):
+  width = max(col.dtype.itemsize // 4, 2)
+  codes = np.ascontiguousarray(_char_codes(col, width)[:, 1:])
+  return codes.view('U%d' % (width - 1)).reshape([len(col)])
+
+
+def _int_column(col):
+  return col.astype(np.int64)
+
+
+def _predicate_sense_column(col):
+  # second '.'-separated field of lemma.sense
+  return np.char.partition(np.char.partition(col, '.')[:, 2], '.')[:, 0]
+
+
+def lowercase_columns(columns, idx):
+  return np.char.lower(_column(columns, idx))[:, None]
+
+
+def parse_roots_self_loop_columns(columns, idx):
+  head = _int_column(_column(columns, idx[0]))
+  id = _int_column(_column(columns, idx[1]))
+  return np.where(head == 0, id, head - 1).astype(str)[:, None]
+
+
+def parse_roots_unmod_columns(columns, idx):
+  return _int_column(_column(columns, idx[0])).astype(str)[:, None]
+
+
+def strip_conll12_domain_columns(columns, idx):
+  return np.char.partition(_column(columns, idx), '/')[:, 0][:, None]
+
+
+def conll12_binary_predicates_columns(columns, idx):
+  return (_column(columns, idx) != '-').astype(str)[:, None]
+
+
+def conll09_binary_predicates_columns(columns, idx):
+  return (_column(columns, idx) != '_').astype(str)[:, None]
+
+
+def conll09_predicate_sense_columns(columns, idx):
+  col = _column(columns, idx)
+  return np.where(col == '_', '-1', _predicate_sense_column(col))[:, None]
+
+
+def conll09_chn_predicate_sense_columns(columns, idx):
+  col = _column(columns, idx)
+  sense = _predicate_sense_column(col)
+  return np.where(col == '_', '-1', np.where(sense == 'XX', '99', sense))[:, None]
+
+
+def conll09_spa_predicate_sense_columns(columns, idx):
+  col = _column(columns, idx)
+  codes = _char_codes(_predicate_sense_column(col), 2).astype(np.int64)
+  sense = 10 * (codes[:, 0] - 96) + (codes[:, 1] - ord('0'))
+  return np.where(col == '_', '-1', sense.astype(str))[:, None]
+
+
+def conll09_cze_predicate_sense_columns(columns, idx):
+  return np.full([columns.shape[0], 1], '0')
+
+
+def conll09_cat_predicate_sense_columns(columns, idx):
+  col = _column(columns, idx)
+  sense = np.char.rpartition(col, '.')[:, 2]
+  first = _char_codes(sense, 1)[:, 0].astype(np.int64)
+  rest = np.where(col == '_', '0', _drop_first_char(sense))
+  sense = 100 * (first - 96) + _int_column(rest)
+  return np.where(col == '_', '-1', sense.astype(str))[:, None]
+
+
+def joint_columns(columns, idx, component_converters):
+  components = [dispatch_columns(converter)(columns, i)[:, 0] for i, converter in zip(idx, component_converters)]
+  joint = components[0]
+  for component in components[1:]:
+    joint = np.char.add(np.char.add(joint, constants.JOINT_LABEL_SEP), component)
+  return joint[:, None]
+
+
+def idx_range_columns(columns, idx):
+  return columns[:, idx[0]: (idx[1] if idx[1] != -1 else columns.shape[1])]
+
+
+def idx_list_columns(columns, idx):
+  if isinstance(idx, int):
+    return columns[:, idx][:, None]
+  return columns[:, idx]
+
+
+column_dispatcher = {
+  'parse_roots_self_loop': parse_roots_self_loop_columns,
+  'parse_roots_unmodified': parse_roots_unmod_columns,
+  'parse_roots_with_root_token': parse_roots_unmod_columns,
+  'strip_conll12_domain': strip_conll12_domain_columns,
+  'conll12_binary_predicates': conll12_binary_predicates_columns,
+  'conll09_binary_predicates': conll09_binary_predicates_columns,
+  'conll09_predicate_sense': conll09_predicate_sense_columns,
+  'conll09_spa_predicate_sense': conll09_spa_predicate_sense_columns,
+  'conll09_cat_predicate_sense': conll09_cat_predicate_sense_columns,
+  'conll09_chn_predicate_sense': conll09_chn_predicate_sense_columns,
+  'conll09_cze_predicate_sense': conll09_cze_predicate_sense_columns,
+  'lowercase': lowercase_columns,
+  'joint_converter': joint_columns,
+  'idx_range_converter': idx_range_columns,
+  'idx_list_converter': idx_list_columns,
+  'default_converter': idx_list_columns
+}
+
+
+def dispatch_columns(converter_name):
+    try:
+      return column_dispatcher[converter_name]
+    except KeyError:
+      print('Undefined data converter: %s' % converter_name)
+      exit(1)
+
+
+def convert_columns(datum_config, columns):
+  '''
+  Applies the converter of datum_config to every token in columns, a 2D string array of shape
+  [num_tokens, num_fields]. Returns a 2D string array of shape [num_tokens, num_outputs].
+  '''
+  converter_name = datum_config['converter']['name'] if 'converter' in datum_config else 'default_converter'
+  params = {'columns': columns, 'idx': datum_config['conll_idx']}
+  if 'converter' in datum_config and 'params' in datum_config['converter']:
+    params.update(datum_config['converter']['params'])
+  return dispatch_columns(converter_name)(**params)
+
+
+def convert_sentence(split_lines, data_config, datum_names):
+  '''
+  Converts a sentence, given as a list of split CoNLL lines, into a 2D string array holding the
+  concatenated outputs of the converters of datum_names, in order.
+  '''
+  columns = np.array(split_lines)
+  return np.concatenate([convert_columns(data_config[d], columns) for d in datum_names], axis=-1)
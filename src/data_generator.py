@@ -1,47 +1,268 @@
+import glob
+import hashlib
+import json
+import os
+import uuid
+
+import numpy as np
+import tensorflow as tf
+
 import data_converters
 
 
-def conll_data_generator(filenames, data_config):
-  # print("debug <processing input data using config>: ", data_config)
+def conll_data_generator(filenames, data_config, shard_index=0, num_shards=1):
+  '''
+  Yields the converted sentences of filenames. If num_shards > 1, each file is split into num_shards byte ranges
+  aligned to sentence boundaries and only the sentences of range shard_index are read and converted, so that
+  several generators can split up the same files without reading all of them.
+  '''
+  # only return the data that we're actually going to use as inputs or outputs
+  feature_label_names = get_feature_label_names(data_config)
   for filename in filenames:
-    with open(filename, 'r') as f:
-      sents = 0
-      toks = 0
+    start, end = get_shard_byte_ranges(filename, num_shards)[shard_index]
+    with open(filename, 'rb') as f:
+      f.seek(start)
+      position = start
       buf = []
-      for line in f:
-        line = line.strip()
-        # print("debug <input line>: ", line)
+      while position < end:
+        line = f.readline()
+        if not line:
+          break
+        position += len(line)
+        line = line.decode('utf-8').strip()
         if line:
-          # if toks <20:
-          # print("debug <input line>: ", line)
-          toks += 1
-          split_line = line.split()
-          data_vals = []
-          for d in data_config.keys():
-            # only return the data that we're actually going to use as inputs or outputs
-            if ('feature' in data_config[d] and data_config[d]['feature']) or \
-               ('label' in data_config[d] and data_config[d]['label']):
-              datum_idx = data_config[d]['conll_idx']
-              converter_name = data_config[d]['converter']['name'] if 'converter' in data_config[d] else 'default_converter'
-              converter_params = data_converters.get_params(data_config[d], split_line, datum_idx)
-              # print(datum_idx, converter_name)
-              # try:
-              data = data_converters.dispatch(converter_name)(**converter_params)
-              # except Exception as e:
-              #   print(e)
-              #   print("debug <converter_name, converter_params>", converter_name, '\n',converter_params)
-              data_vals.extend(data)
-          # if toks < 30:
-            # print("debug <data_vals>: ",tuple(data_vals))
-          # print("debug <data_vals>:", tuple(data_vals))
-          buf.append(tuple(data_vals))
-
-        else:
-          if buf:
-            sents += 1
-            yield buf
-            buf = []
-          # print()
+          buf.append(line.split())
+        elif buf:
+          # convert the whole sentence at once, column by column
+          yield data_converters.convert_sentence(buf, data_config, feature_label_names)
+          buf = []
       # catch the last one
       if buf:
-        yield buf
+        yield data_converters.convert_sentence(buf, data_config, feature_label_names)
+
+
+def get_shard_byte_ranges(filename, num_shards):
+  '''
+  Splits filename into num_shards (start, end) byte ranges of about the same size, each starting at the
+  beginning of a sentence; ranges may be empty when the file has fewer sentences than shards
+  '''
+  size = os.path.getsize(filename)
+  boundaries = [0]
+  with open(filename, 'rb') as f:
+    for i in range(1, num_shards):
+      boundary = max(boundaries[-1], size * i // num_shards)
+      if boundary > 0 and boundary < size:
+        # move on to the line after the next blank line
+        f.seek(boundary - 1)
+        f.readline()
+        line = f.readline()
+        while line and line.strip():
+          line = f.readline()
+        boundary = f.tell()
+      boundaries.append(min(boundary, size))
+  boundaries.append(size)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+'''
+Precompiled corpus shards.
+
+A compiled shard stores the already int-mapped sentences of one CoNLL data file, so that the input pipeline can
+skip the per-epoch string parsing, converters and vocab lookups. The shard is a directory living next to the data
+file (<data_file>.compiled) containing:
+  data.npy:   flat int32 array holding every sentence's [num_tokens, width] matrix, row major
+  index.npy:  int64 array of shape [num_sents, 3] with (offset into data, num_tokens, width) for each sentence
+  meta.json:  signature of the data file, data_config and vocabs the shard was compiled against
+'''
+COMPILED_SUFFIX = '.compiled'
+COMPILED_FORMAT_VERSION = 1
+
+
+def get_compiled_path(filename):
+  return filename + COMPILED_SUFFIX
+
+
+def get_feature_label_names(data_config):
+  return [d for d in data_config.keys() if
+          ('feature' in data_config[d] and data_config[d]['feature']) or
+          ('label' in data_config[d] and data_config[d]['label'])]
+
+
+def _int_mappers(data_config, feature_label_names, vocab):
+  # mirrors the lookup tables built by Vocab.create_vocab_lookup_ops: vocab files map OOV to the last index
+  # when 'oov' is set (and to -1 otherwise), embedding vocabs always have a single OOV bucket
+  mappers = []
+  for datum_name in feature_label_names:
+    if 'vocab' in data_config[datum_name]:
+      vocab_name = data_config[datum_name]['vocab']
+      if vocab_name in vocab.vocab_maps:
+        this_map = vocab.vocab_maps[vocab_name]
+        oov_idx = len(this_map) if vocab.oovs[vocab_name] else -1
+      else:
+        this_map = vocab.load_embedding_vocab_map(vocab_name)
+        oov_idx = len(this_map)
+      mappers.append(lambda s, m=this_map, o=oov_idx: m.get(s, o))
+    else:
+      mappers.append(int)
+  return mappers
+
+
+def map_sentence_to_ints(sent, data_config, feature_label_names, mappers):
+  '''
+  NumPy equivalent of dataset.map_strings_to_ints for a single sentence, given as a list of per-token tuples
+  of strings as produced by conll_data_generator.
+  '''
+  num_cols = len(sent[0])
+  columns = []
+  for i, (datum_name, mapper) in enumerate(zip(feature_label_names, mappers)):
+    if 'type' in data_config[datum_name] and data_config[datum_name]['type'] == 'range' and \
+       data_config[datum_name]['conll_idx'][1] == -1:
+      cols = range(i, num_cols)
+    else:
+      cols = [i]
+    for j in cols:
+      columns.append([mapper(tok[j]) for tok in sent])
+  return np.array(columns, dtype=np.int32).T.reshape(len(sent), len(columns))
+
+
+def _file_signature(filename):
+  stat = os.stat(filename)
+  return [os.path.abspath(filename), stat.st_size, int(stat.st_mtime)]
+
+
+def compiled_signature(data_config, vocab):
+  '''
+  Signature of everything a compiled shard depends on besides the data file itself: the feature/label part of
+  the data config and the contents (for vocab files) or identity (for embedding files) of every vocab used.
+  '''
+  feature_label_names = get_feature_label_names(data_config)
+  config_str = json.dumps([[d, data_config[d]] for d in feature_label_names], sort_keys=True)
+  vocab_sigs = {}
+  for datum_name in feature_label_names:
+    if 'vocab' in data_config[datum_name]:
+      vocab_name = data_config[datum_name]['vocab']
+      if vocab_name in vocab.vocab_maps:
+        keys_hash = hashlib.sha1('\n'.join(vocab.vocab_maps[vocab_name].keys()).encode('utf-8')).hexdigest()
+        vocab_sigs[vocab_name] = [len(vocab.vocab_maps[vocab_name]), vocab.oovs[vocab_name], keys_hash]
+      else:
+        vocab_sigs[vocab_name] = vocab.get_embedding_vocab_signature(vocab_name)
+  return {'version': COMPILED_FORMAT_VERSION,
+          'data_config': hashlib.sha1(config_str.encode('utf-8')).hexdigest(),
+          'vocabs': vocab_sigs}
+
+
+def get_cache_filename(cache_dir, filenames, data_config, vocab):
+  '''
+  Returns the prefix of the tf.data cache files for the int-mapped contents of filenames, see get_cache_prefix.
+  The cache directory is named after a hash of the data files, data_config and vocabs, so that a cache is reused
+  across processes exactly when all three match.
+  '''
+  key = {'files': [_file_signature(filename) for filename in filenames],
+         'signature': compiled_signature(data_config, vocab)}
+  key_hash = hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir, exist_ok=True)
+  return get_cache_prefix(os.path.join(cache_dir, 'dataset-%s' % key_hash))
+
+
+CACHE_TMP_INFIX = '.tmp-'
+CACHE_PREFIX = 'cache'
+
+
+def get_cache_prefix(cache_dir):
+  '''
+  The tf.data cache prefix a process should use for the cache directory cache_dir. A complete cache, one with
+  its .index file, is read from cache_dir. Otherwise the cache is written into a directory unique to this
+  process, so that concurrent jobs never share tf.data's lockfile and a crashed job leaves no stale lock behind;
+  the first job to find a completed temporary cache renames its directory to cache_dir, which is atomic.
+  '''
+  cache_prefix = os.path.join(cache_dir, CACHE_PREFIX)
+  if not os.path.exists(cache_prefix + '.index'):
+    for tmp_index in glob.glob(os.path.join(glob.escape(cache_dir + CACHE_TMP_INFIX) + '*', CACHE_PREFIX + '.index')):
+      try:
+        os.rename(os.path.dirname(tmp_index), cache_dir)
+        tf.logging.log(tf.logging.INFO, "Moved completed cache %s into place" % os.path.dirname(tmp_index))
+        break
+      except OSError:
+        # cache_dir is already in place, possibly moved there by another job
+        pass
+  if os.path.exists(cache_prefix + '.index'):
+    return cache_prefix
+  tmp_dir = '%s%s%s' % (cache_dir, CACHE_TMP_INFIX, uuid.uuid4().hex)
+  os.makedirs(tmp_dir)
+  return os.path.join(tmp_dir, CACHE_PREFIX)
+
+
+def compile_conll_file(filename, data_config, vocab, output_dir=None):
+  '''
+  Runs the data_config converters and vocab lookups over filename once, and writes the result as a compiled shard.
+
+  Returns:
+    Path of the written shard directory
+  '''
+  output_dir = output_dir or get_compiled_path(filename)
+  if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+  feature_label_names = get_feature_label_names(data_config)
+  mappers = _int_mappers(data_config, feature_label_names, vocab)
+
+  sents = []
+  index = []
+  offset = 0
+  for sent in conll_data_generator([filename], data_config):
+    int_sent = map_sentence_to_ints(sent, data_config, feature_label_names, mappers)
+    sents.append(int_sent.reshape([-1]))
+    index.append((offset, int_sent.shape[0], int_sent.shape[1]))
+    offset += int_sent.size
+
+  data = np.concatenate(sents) if sents else np.zeros([0], dtype=np.int32)
+  np.save(os.path.join(output_dir, 'data.npy'), data.astype(np.int32))
+  np.save(os.path.join(output_dir, 'index.npy'), np.array(index, dtype=np.int64).reshape([-1, 3]))
+
+  meta = compiled_signature(data_config, vocab)
+  meta['source'] = _file_signature(filename)
+  meta['num_sents'] = len(index)
+  meta['num_tokens'] = int(sum(i[1] for i in index))
+  with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+    json.dump(meta, f, indent=2)
+
+  tf.logging.log(tf.logging.INFO, "Compiled %d sentences (%d tokens) from %s into %s" %
+                 (meta['num_sents'], meta['num_tokens'], filename, output_dir))
+  return output_dir
+
+
+def find_compiled_shards(filenames, data_config, vocab):
+  '''
+  Returns the compiled shard directories for filenames if every one of them exists and is up to date with
+  respect to its data file, data_config and vocab; otherwise None, in which case the text files should be used.
+  '''
+  signature = None
+  shards = []
+  for filename in filenames:
+    shard_dir = get_compiled_path(filename)
+    meta_file = os.path.join(shard_dir, 'meta.json')
+    if not os.path.exists(meta_file):
+      return None
+    with open(meta_file, 'r') as f:
+      meta = json.load(f)
+    if signature is None:
+      # round-trip through json so that tuples/lists compare equal
+      signature = json.loads(json.dumps(compiled_signature(data_config, vocab)))
+    if meta['source'] != _file_signature(filename) or \
+       any(meta[k] != signature[k] for k in signature.keys()):
+      tf.logging.log(tf.logging.WARN, "Ignoring stale compiled shard: %s" % shard_dir)
+      return None
+    shards.append(shard_dir)
+  return shards
+
+
+def compiled_data_generator(shard_dirs, shard_index=0, num_shards=1):
+  for shard_dir in shard_dirs:
+    data = np.load(os.path.join(shard_dir, 'data.npy'), mmap_mode='r')
+    index = np.load(os.path.join(shard_dir, 'index.npy'))
+    # each shard reads a contiguous part of the mmapped data
+    shard_index_start = len(index) * shard_index // num_shards
+    shard_index_end = len(index) * (shard_index + 1) // num_shards
+    for offset, num_tokens, width in index[shard_index_start:shard_index_end]:
+      yield np.array(data[offset:offset + num_tokens * width]).reshape([num_tokens, width])
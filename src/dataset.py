@@ -1,6 +1,6 @@
 import tensorflow as tf
 import constants
-from data_generator import conll_data_generator
+from data_generator import conll_data_generator, compiled_data_generator
 # from tensor2tensor import utils
 
 from t2t_data_reader import input_fn, token_based_batching
@@ -46,12 +46,48 @@ def map_strings_to_ints(vocab_lookup_ops, data_config, feature_label_names, cach
   return _mapper
 
 
-def get_data_iterator(data_filenames, data_config, vocab_lookup_ops, batch_size, num_epochs, shuffle,
-                      shuffle_buffer_multiplier, is_token_based_batching, cached_embedding=None):
-
+def get_input_hparam(hparams, name):
+  return getattr(hparams, name) if hparams is not None and name in hparams.values() else constants.get_default(name)
+
+
+def get_source_dataset(data_filenames, data_config, compiled_shards, num_shards, num_parallel_reads, deterministic):
+  '''
+  Creates the dataset of (string or, for compiled shards, int) sentence matrices. By default all files are read in
+  order by a single generator. With num_shards > 1, each file is split into num_shards byte ranges (contiguous
+  sentence ranges for compiled shards), and all file shards are read concurrently with a parallel interleave. If
+  deterministic, sentences come out in a fixed round-robin order over the shards; otherwise in whatever order
+  they are ready. Shards are read by Python generators, so the concurrency mostly overlaps I/O; compiled shards,
+  which only slice memory-mapped arrays, gain the most.
+  '''
+  if compiled_shards:
+    sources = compiled_shards
+    output_type = tf.int32
+    source_generator = lambda i: compiled_data_generator([sources[i // num_shards]], i % num_shards, num_shards)
+    all_generator = lambda: compiled_data_generator(sources)
+  else:
+    sources = data_filenames
+    output_type = tf.string
+    source_generator = lambda i: conll_data_generator([sources[i // num_shards]], data_config, i % num_shards, num_shards)
+    all_generator = lambda: conll_data_generator(sources, data_config)
+
+  if num_shards <= 1:
+    return tf.data.Dataset.from_generator(all_generator, output_shapes=[None, None], output_types=output_type)
+
+  num_sources = len(sources) * num_shards
+  cycle_length = min(num_parallel_reads, num_sources) if num_parallel_reads > 0 else num_sources
+  tf.logging.log(tf.logging.INFO, "Reading %d input shards with %d parallel readers (deterministic=%r)" %
+                 (num_sources, cycle_length, deterministic))
+  dataset = tf.data.Dataset.range(num_sources)
+  dataset = dataset.apply(tf.data.experimental.parallel_interleave(
+    lambda i: tf.data.Dataset.from_generator(source_generator, args=(i,), output_shapes=[None, None],
+                                             output_types=output_type),
+    cycle_length=cycle_length, sloppy=not deterministic))
+  return dataset
 
 
-  # todo do something smarter with multiple files + parallel?
+def get_data_iterator(data_filenames, data_config, vocab_lookup_ops, batch_size, num_epochs, shuffle,
+                      shuffle_buffer_multiplier, is_token_based_batching, cached_embedding=None, compiled_shards=None,
+                      cache_filename=None, hparams=None):
 
   with tf.device('/cpu:0'):
 
@@ -62,14 +98,26 @@ def get_data_iterator(data_filenames, data_config, vocab_lookup_ops, batch_size,
                            ('label' in data_config[d] and data_config[d]['label'])]
 
     # get the dataset
-    dataset = tf.data.Dataset.from_generator(lambda: conll_data_generator(data_filenames, data_config),
-                                             output_shapes=[None, None], output_types=tf.string)
-
-    # intmap the dataset
-    dataset = dataset.map(map_strings_to_ints(vocab_lookup_ops, data_config, feature_label_names, None), num_parallel_calls=8)
+    dataset = get_source_dataset(data_filenames, data_config, compiled_shards,
+                                 num_shards=get_input_hparam(hparams, 'input_num_shards'),
+                                 num_parallel_reads=get_input_hparam(hparams, 'input_num_parallel_reads'),
+                                 deterministic=get_input_hparam(hparams, 'input_deterministic'))
+
+    if compiled_shards:
+      # the shards are already int-mapped (see compile_data.py), so we can skip vocab lookups
+      tf.logging.log(tf.logging.INFO, "Reading compiled shards: %s" % str(compiled_shards))
+    else:
+      # intmap the dataset
+      dataset = dataset.map(map_strings_to_ints(vocab_lookup_ops, data_config, feature_label_names, None),
+                            num_parallel_calls=get_input_hparam(hparams, 'input_map_parallel_calls'))
     # dataset = dataset.map(map_strings_to_ints(vocab_lookup_ops, data_config, feature_label_names))
 
-    dataset = dataset.cache()
+    if cache_filename:
+      # persist the int-mapped dataset on disk so that other processes / restarts can reuse it
+      tf.logging.log(tf.logging.INFO, "Caching input data in: %s" % cache_filename)
+      dataset = dataset.cache(cache_filename)
+    else:
+      dataset = dataset.cache()
     if is_token_based_batching:
       dataset = token_based_batching(dataset=dataset,
              batch_size_means_tokens=True,
@@ -93,13 +141,55 @@ def get_data_iterator(data_filenames, data_config, vocab_lookup_ops, batch_size,
       if shuffle:
         dataset = dataset.apply(tf.contrib.data.shuffle_and_repeat(buffer_size=batch_size*shuffle_buffer_multiplier,
                                                                    count=num_epochs))
-    # todo should the buffer be bigger?
-    dataset.prefetch(buffer_size=1)
-
+    dataset = dataset.prefetch(buffer_size=get_input_hparam(hparams, 'input_prefetch_buffer_size'))
+    prefetch_device = get_input_hparam(hparams, 'input_prefetch_to_device')
+    if prefetch_device:
+      # has to be the last transformation in the pipeline
+      dataset = dataset.apply(tf.data.experimental.prefetch_to_device(prefetch_device))
+
+  # the iterator of a dataset prefetched to a device has to live on that device, or every batch is copied back
+  with tf.device(prefetch_device or '/cpu:0'):
     # create the iterator
     # it has to be initializable due to the lookup tables
     iterator = dataset.make_initializable_iterator()
     tf.add_to_collection(tf.GraphKeys.TABLE_INITIALIZERS, iterator.initializer)
 
+    if get_input_hparam(hparams, 'log_input_stalls'):
+      return get_next_with_stall_stats(iterator, get_input_hparam(hparams, 'input_stall_threshold_secs'))
     return iterator.get_next()
     # return dataset # in case of distributed training
+
+
+def get_next_with_stall_stats(iterator, stall_threshold_secs):
+  '''
+  Wraps iterator.get_next() so that every step records how long it waited on the input pipeline. A step counts as
+  stalled if the wait exceeds stall_threshold_secs. The fraction of stalled steps and the mean wait are added to
+  the constants.INPUT_STATS_COLLECTION collection, which the model logs alongside the loss. The element stays on
+  the iterator's device; the timing and counters are kept on the CPU.
+  '''
+  with tf.device('/cpu:0'):
+    start = tf.timestamp()
+  with tf.control_dependencies([start]):
+    next_element = iterator.get_next()
+
+  def _local_counter(name, dtype):
+    return tf.Variable(tf.zeros([], dtype=dtype), name=name, trainable=False,
+                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+
+  with tf.device('/cpu:0'):
+    with tf.control_dependencies([next_element]):
+      wait_secs = tf.timestamp() - start
+    num_steps = _local_counter('input_num_steps', tf.float64)
+    num_stalls = _local_counter('input_num_stalls', tf.float64)
+    total_wait_secs = _local_counter('input_total_wait_secs', tf.float64)
+    updates = [num_steps.assign_add(1.),
+               num_stalls.assign_add(tf.cast(tf.greater(wait_secs, stall_threshold_secs), tf.float64)),
+               total_wait_secs.assign_add(wait_secs)]
+    with tf.control_dependencies(updates):
+      stall_fraction = tf.identity(num_stalls / tf.maximum(num_steps, 1.), name='input_stall_fraction')
+      mean_wait_secs = tf.identity(total_wait_secs / tf.maximum(num_steps, 1.), name='input_mean_wait_secs')
+  with tf.control_dependencies(updates):
+    next_element = tf.identity(next_element)
+  tf.add_to_collection(constants.INPUT_STATS_COLLECTION, stall_fraction)
+  tf.add_to_collection(constants.INPUT_STATS_COLLECTION, mean_wait_secs)
+  return next_element
@@ -1,3 +1,4 @@
+import concurrent.futures
 import json
 from collections import OrderedDict
 
@@ -12,9 +13,12 @@ from vocab import Vocab
 import sys
 from tensorflow.contrib import predictor
 import evaluation_fns_np as eval_fns
+import inference
+import srl_transformations
 import constants
 import os
 import util
+import output_fns
 from model import LISAModel
 
 
@@ -46,6 +50,9 @@ arg_parser.add_argument('--attention_configs',
 
 arg_parser.add_argument('--ensemble', dest='ensemble', action='store_true',
                         help='Whether to ensemble models in save dir.')
+arg_parser.add_argument('--ensemble_rule', choices=util.ENSEMBLE_RULES, default='product',
+                        help='How to combine the output distributions of ensembled models: their normalized product '
+                             '(product of experts) or their mean')
 arg_parser.add_argument('--okazaki_discounting', dest='okazaki_discounting', action='store_true',
                         help='whether to use okazaki style of discounting method')
 
@@ -58,8 +65,31 @@ arg_parser.add_argument('--aggregator_mlp_bn', dest='aggregator_mlp_bn', action=
 arg_parser.add_argument('--eval_with_transformation', dest='eval_with_transformation', action='store_true',
                         help='whether to evaluate with result transformation')
 
+arg_parser.add_argument('--transformation_workers', type=int, default=4,
+                        help='Number of processes applying the transformations of --eval_with_transformation')
 arg_parser.add_argument('--output_predictions', dest='output_predictions', action='store_true',
                         help='whether to evaluate with result transformation')
+arg_parser.add_argument('--output_sidecar', dest='output_sidecar', action='store_true',
+                        help='Whether to also write the CoNLL-2009 outputs as a binary sidecar of the batch arrays, '
+                             'for scoring with evaluation_fns_np.conll09_sidecar_counts')
+arg_parser.add_argument('--concurrent_eval', dest='concurrent_eval', action='store_true',
+                        help='Whether to evaluate the dev and test files concurrently, one thread per file sharing the '
+                             'predictors, rather than one after another')
+arg_parser.add_argument('--pipeline_queue_size', type=int, default=2,
+                        help='Number of batches that may wait between the input, prediction and decoding stages of '
+                             'evaluation, each run in its own thread; 0 runs them serially')
+arg_parser.add_argument('--length_sorted_batching', dest='length_sorted_batching', action='store_true',
+                        help='Whether to read each eval file whole, sort its sentences by length and evaluate them in '
+                             'tight batches, writing the CoNLL-2009 outputs in file order. Only for eval fns whose '
+                             'eval files are the CoNLL-2009 outputs')
+arg_parser.add_argument('--max_batch_tokens', type=int, default=4096,
+                        help='With --length_sorted_batching, maximum number of tokens in a batch, counting padding')
+arg_parser.add_argument('--max_batch_pairs', type=int,
+                        help='With --length_sorted_batching, maximum number of token pairs in a batch, counting '
+                             'padding, which bounds the quadratic cost of the attention and dependency prior layers')
+arg_parser.add_argument('--viterbi_in_graph', dest='viterbi_in_graph', action='store_true',
+                        help='Whether to use the predictions the exported model decodes in-graph with its transition '
+                             'params instead of Viterbi decoding the scores on the host (single model only)')
 
 
 
@@ -69,6 +99,10 @@ args, leftovers = arg_parser.parse_known_args()
 
 util.init_logging(tf.logging.INFO)
 
+if args.eval_with_transformation and args.transformation_workers > 1:
+  # fork the workers now, before the predictors' sessions and the eval pipeline start any threads
+  srl_transformations.start_pool(args.transformation_workers)
+
 if not os.path.isdir(args.save_dir):
   util.fatal_error("save_dir not found: %s" % args.save_dir)
 
@@ -135,8 +169,17 @@ def constrcut_predictor(path):
     return estimator
 
 if args.ensemble:
-  predict_fns = [predictor.from_saved_model("%s/%s" % (args.save_dir, subdir))
-                 for subdir in util.get_immediate_subdirectories(args.save_dir)]
+  if util.streams_cwr(hparams):
+    util.fatal_error("Streamed cached embeddings are gathered in a tf.py_func, which the exported models of "
+                     "--ensemble can't run")
+  ensemble_dirs = [os.path.join(args.save_dir, subdir)
+                   for subdir in sorted(util.get_immediate_subdirectories(args.save_dir))
+                   if os.path.isfile(os.path.join(args.save_dir, subdir, 'saved_model.pb'))]
+  if not ensemble_dirs:
+    util.fatal_error("No exported models to ensemble in save_dir: %s" % args.save_dir)
+  tf.logging.log(tf.logging.INFO, "Ensembling %d models with rule '%s': %s" % (len(ensemble_dirs), args.ensemble_rule,
+                                                                              str(ensemble_dirs)))
+  predict_fns = [predictor.from_saved_model(ensemble_dir) for ensemble_dir in ensemble_dirs]
 else:
   # predict_fns = [predictor.from_saved_model(args.save_dir)]
   estimator = constrcut_predictor(args.save_dir)
@@ -146,108 +189,117 @@ else:
 
 def dev_input_fn():
   return train_utils.get_input_fn(vocab, data_config, dev_filenames, hparams.batch_size, num_epochs=1, shuffle=False,
-                                  embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching)
+                                  embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching,
+                                  hparams=hparams)
 
 
-def eval_fn(input_op, sess, input_source):
+def fetch_batches(input_op, sess):
+  while True:
+    try:
+      yield sess.run(input_op)
+    except tf.errors.OutOfRangeError:
+      return
+
+
+# eval fns with eval files that are not written through the conll09 writers, which alone restore file order
+unordered_eval_fns = sorted(set(eval_map['name'] for task_map in task_config.values()
+                                for eval_map in task_map['eval_fns'].values()
+                                if not eval_map['name'].startswith('conll09_srl_eval') and
+                                any(p.endswith('_eval_file') for p in eval_map.get('params', {}))) |
+                            ({'conll_srl_eval_with_transformation'} if args.eval_with_transformation else set()))
+if args.length_sorted_batching and unordered_eval_fns:
+  util.fatal_error("--length_sorted_batching would write the eval files of %s out of file order"
+                   % ', '.join(unordered_eval_fns))
+
+sentence_converter = inference.SentenceConverter(data_config, vocab)
+
+
+def length_sorted_batches(filenames):
+  '''
+  Reads the sentences of eval files, sorts them by length, longest first, and batches them under the
+  --max_batch_tokens and --max_batch_pairs budgets. Returns the batches and the position in the files of each
+  sentence in their order
+  '''
+  int_sents = []
+  for filename in filenames:
+    with open(filename) as f:
+      int_sents.extend(sentence_converter.prepare_sentence(split_lines) for split_lines in inference.read_sentences(f))
+  batches, sentence_order = inference.length_sorted_batches(int_sents, args.max_batch_tokens, args.max_batch_pairs)
+  tf.logging.log(tf.logging.INFO, "Length-sorted %d sentences into %d batches of %d padded tokens" %
+                 (len(int_sents), len(batches), sum(b.shape[0] * b.shape[1] for b in batches)))
+  return batches, sentence_order
+
+
+viterbi_in_graph_tasks = set()
+if args.viterbi_in_graph and len(predict_fns) == 1:
+  for task in transition_params:
+    if output_fns.decodes_viterbi_in_graph(task_config[task]['output_fn']['name'], hparams):
+      viterbi_in_graph_tasks.add(task)
+    else:
+      tf.logging.log(tf.logging.INFO, "Task %s does not Viterbi decode in-graph, decoding it on the host" % task)
+
+# ensemble members run on each batch concurrently, so a batch takes about as long as the slowest member
+ensemble_executor = concurrent.futures.ThreadPoolExecutor(len(predict_fns)) if len(predict_fns) > 1 else None
+
+
+def predict_batch(input_np):
+  predictor_input = {'input': input_np}
+  if ensemble_executor is None:
+    return input_np, [predict_fn(predictor_input) for predict_fn in predict_fns]
+  return input_np, list(ensemble_executor.map(lambda predict_fn: predict_fn(predictor_input), predict_fns))
+
+
+def decode_batch(batch):
+  input_np, predictions = batch
+  # every member's outputs are combined once per batch, for all tasks
+  combined_outputs = util.ensemble_outputs(predictions, args.ensemble_rule)
+  combined_loss = {k: v for k, v in combined_outputs.items() if k.endswith("loss")}
+  combined_predictions, feats, labels, tokens_to_keep = \
+    util.decode_predictions(input_np, combined_outputs, feature_idx_map, label_idx_map, task_config, transition_params,
+                            viterbi_in_graph_tasks)
+  return combined_predictions, combined_loss, feats, labels, tokens_to_keep
+
+
+def eval_fn(input_op, sess, input_source, filenames, separate_outputs=False):
+  '''
+  Evaluates the batches of input_op, or with --length_sorted_batching those read from filenames, and returns the
+  eval results. With separate_outputs, eval files not already named after the input source are, so that files
+  can be evaluated concurrently
+  '''
   if args.eval_with_transformation:
     task_config['srl']['eval_fns']['srl_f1']['name'] = 'conll_srl_eval_with_transformation'
     pass
 
   eval_accumulators = eval_fns.get_accumulators(task_config)
   eval_results = OrderedDict({})
-  i = 0
-  while True:
-    i += 1
-    try:
-      # input_np = sess.run(dev_input_fn())
-      input_np = sess.run(input_op)
-      # print("<debug input_np>: {}".format(input_np))
-      predictor_input = {'input': input_np}
-      predictions = [predict_fn(predictor_input) for predict_fn in predict_fns]
-
-      shape = input_np.shape
-      batch_size = shape[0]
-      batch_seq_len = shape[1]
-
-      feats = {f: input_np[:, :, idx] for f, idx in feature_idx_map.items()}
-
-      # print(feats.keys())
-      tokens_to_keep = np.where(feats['word'] == constants.PAD_VALUE, 0, 1)
-
-      combined_predictions = predictions[0]
-      # print(combined_predictions)
-      # print([i for i in combined_predictions])
-
-      # todo: implement ensembling
-      combined_scores = {k: v for k, v in combined_predictions.items() if k.endswith("_scores")}
-      combined_probabilities = {k: v for k, v in combined_predictions.items() if k.endswith("_probabilities")}
-      combined_loss = {k: v for k, v in combined_predictions.items() if k.endswith("loss")}
-
-      # for model_outputs in predictions:
-      #   for key, val in model_outputs.items():
-      #     if key.endswith("_probabilities"):
-      #       if key not in combined_probabilities:
-      #         print("init", key)
-      #         combined_probabilities[key] = val
-      #       else:
-      #         print("adding ", key)
-      #         # product of experts ensembling
-      #         if val.shape == combined_probabilities[key].shape:
-      #           combined_scores[key] = np.multiply(combined_probabilities[key], val)
-
-      combined_predictions.update({k.replace('scores', 'predictions'): np.argmax(v, axis=-1) for k, v in combined_scores.items()})
-      combined_predictions.update({k.replace('probabilities', 'predictions'): np.argmax(v, axis=-1) for k, v in combined_probabilities.items()})
-
-      labels = {}
-      for l, idx in label_idx_map.items():
-        these_labels = input_np[:, :, idx[0]:idx[0]+1] if idx[1] != -1 else input_np[:, :, idx[0]:]
-        these_labels_masked = np.multiply(these_labels, np.expand_dims(tokens_to_keep, -1))
-        # check if we need to mask another dimension
-        if idx[1] == -1:
-          this_mask = np.where(these_labels_masked == constants.PAD_VALUE, 0, 1)
-          these_labels_masked = np.multiply(these_labels_masked, this_mask)
-        else:
-          these_labels_masked = np.squeeze(these_labels_masked, -1)
-        labels[l] = these_labels_masked
-
-      # print("debug <combined prediction>: ", combined_predictions)
-      for task, tran_params in transition_params.items():
-        # print("debug <task & tran_params>:", task, tran_params, tran_params.shape)
-        task_predictions = np.empty_like(combined_predictions['%s_predictions' % task])
-        token_take_mask = util.get_token_take_mask(task, task_config, combined_predictions, labels)
-        # print("task <{}>".format(task), token_take_mask)
-        if token_take_mask is not None:
-          toks_to_keep_tiled = np.reshape(np.tile(tokens_to_keep, [1, batch_seq_len]),
-                                          [batch_size, batch_seq_len, batch_seq_len])
-          toks_to_keep_task = toks_to_keep_tiled[np.where(token_take_mask == 1)]
-        else:
-          toks_to_keep_task = tokens_to_keep
-        sent_lens_task = np.sum(toks_to_keep_task, axis=-1)
-        if 'srl' in transition_params:
-          # print("debug <doing stuff for srl>: ",task)
-          # print("debug <doing stuff for srl>: ", combined_scores['%s_scores' % task], sent_lens_task)
-          for idx, (sent, sent_len) in enumerate(zip(combined_scores['%s_scores' % task], sent_lens_task)):
-            viterbi_sequence, score = tf.contrib.crf.viterbi_decode(sent[:sent_len], tran_params)
-            task_predictions[idx, :sent_len] = viterbi_sequence
-        combined_predictions['%s_predictions' % task] = task_predictions
-
-
-
-
-      # for i in layer_task_config:
-      for task, task_map in task_config.items():
-        for eval_name, eval_map in task_map['eval_fns'].items():
-          eval_fn_params = eval_fns.get_params(task, eval_map, combined_predictions, feats, labels,
-                                               vocab.reverse_maps, tokens_to_keep)
-          if eval_map["name"].startswith("conll09_srl_") and eval_map["name"].endswith("srl_only"):# == "conll09_srl_eval_all_srl_only" or eval_map["name"] == "conll09_srl_eval_srl_only":
-            # conll09_srl_eval_all_srl_only
-            eval_fn_params["input_source"] = input_source
-          eval_fn_params['accumulator'] = eval_accumulators[eval_name]
-          eval_result = eval_fns.dispatch(eval_map['name'])(**eval_fn_params)
-          eval_results[eval_name] = eval_result
-    except tf.errors.OutOfRangeError:
-      break
+  if args.length_sorted_batching:
+    batches, sentence_order = length_sorted_batches(filenames)
+    eval_fns.set_conll09_sentence_order(input_source, sentence_order)
+  else:
+    batches = fetch_batches(input_op, sess)
+  # batches are fetched, predicted and decoded in their own threads while the previous ones are scored;
+  # scoring stays in this thread and in input order since the accumulators and output files are shared
+  for combined_predictions, combined_loss, feats, labels, tokens_to_keep in \
+      util.pipeline(batches, [predict_batch, decode_batch], args.pipeline_queue_size):
+    # for i in layer_task_config:
+    for task, task_map in task_config.items():
+      for eval_name, eval_map in task_map['eval_fns'].items():
+        eval_fn_params = eval_fns.get_params(task, eval_map, combined_predictions, feats, labels,
+                                             vocab.reverse_maps, tokens_to_keep)
+        if eval_map["name"].startswith("conll09_srl_") and eval_map["name"].endswith("srl_only"):# == "conll09_srl_eval_all_srl_only" or eval_map["name"] == "conll09_srl_eval_srl_only":
+          # conll09_srl_eval_all_srl_only
+          eval_fn_params["input_source"] = input_source
+          eval_fn_params["sidecar"] = args.output_sidecar
+        if eval_map["name"] == 'conll_srl_eval_with_transformation':
+          eval_fn_params["num_workers"] = args.transformation_workers
+        if separate_outputs and "input_source" not in eval_fn_params:
+          for param_name in [p for p in eval_fn_params if p.endswith('_eval_file')]:
+            eval_fn_params[param_name] = '%s.%s' % (eval_fn_params[param_name],
+                                                    eval_fns.input_source_suffix(input_source))
+        eval_fn_params['accumulator'] = eval_accumulators[eval_name]
+        eval_result = eval_fns.dispatch(eval_map['name'])(**eval_fn_params)
+        eval_results[eval_name] = eval_result
+  eval_fns.close_conll09_writers(input_source)
   # print(eval_results)
   for k in eval_results.keys():
     if isinstance(eval_results[k], np.ndarray):
@@ -255,7 +307,7 @@ def eval_fn(input_op, sess, input_source):
   for k in combined_loss.keys():
     if isinstance(combined_loss[k], np.ndarray):
       combined_loss[k] = combined_loss[k].tolist()
-  tf.logging.log(tf.logging.INFO, json.dumps(eval_results))
+  return eval_results
 
 
 
@@ -268,14 +320,27 @@ with tf.Session() as sess:
   for test_file in test_filenames:
       def test_input_fn():
         return train_utils.get_input_fn(vocab, data_config, [test_file], hparams.batch_size, num_epochs=1, shuffle=False,
-                                        embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching)
+                                        embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching,
+                                        hparams=hparams)
       test_input_ops[test_file] = test_input_fn()
 
   sess.run(tf.tables_initializer())
 
-  tf.logging.log(tf.logging.INFO, "Evaluating on dev files: %s" % str(dev_filenames))
-  eval_fn(dev_input_op, sess, dev_filenames[0])
-  for test_file, test_input_op in test_input_ops.items():
-      tf.logging.log(tf.logging.INFO, "Evaluating on test file: %s" % str(test_file))
-      eval_fn(test_input_op, sess, test_file)
-
+  eval_inputs = [(dev_input_op, dev_filenames[0], dev_filenames, "Evaluating on dev files: %s" % str(dev_filenames))]
+  eval_inputs += [(test_input_op, test_file, [test_file], "Evaluating on test file: %s" % str(test_file))
+                  for test_file, test_input_op in test_input_ops.items()]
+
+  if args.concurrent_eval:
+    tf.logging.log(tf.logging.INFO, "Evaluating %d input files concurrently" % len(eval_inputs))
+    with concurrent.futures.ThreadPoolExecutor(len(eval_inputs)) as executor:
+      eval_futures = [executor.submit(eval_fn, input_op, sess, input_source, filenames, True)
+                      for input_op, input_source, filenames, _ in eval_inputs]
+      # results are logged in input order, whichever file finishes first
+      for (_, _, _, message), eval_future in zip(eval_inputs, eval_futures):
+        eval_results = eval_future.result()
+        tf.logging.log(tf.logging.INFO, message)
+        tf.logging.log(tf.logging.INFO, json.dumps(eval_results))
+  else:
+    for input_op, input_source, filenames, message in eval_inputs:
+      tf.logging.log(tf.logging.INFO, message)
+      tf.logging.log(tf.logging.INFO, json.dumps(eval_fn(input_op, sess, input_source, filenames)))
@@ -1,3 +1,5 @@
+import functools
+
 import tensorflow as tf
 import evaluation_fns_np
 import nn_utils
@@ -338,6 +340,133 @@ def conll_parse_eval_tf(predictions, targets, parse_head_predictions, words, mas
     return accuracies, update_op
 
 
+def deferred_counts_tf(score_fn, inputs, num_counts, background):
+  '''
+  Update op that only buffers the batch's int inputs, and a vector of counts that scores every buffered
+  batch with score_fn once it's read at the end of the eval pass (see evaluation_fns_np.DeferredEval)
+  '''
+  deferred_eval = evaluation_fns_np.DeferredEval(score_fn, num_counts, background)
+  update_op = tf.py_func(deferred_eval.append, inputs, tf.int64, stateful=True)
+  counts = tf.py_func(deferred_eval.result, [], tf.int64, stateful=True)
+  counts.set_shape([num_counts])
+  return counts, update_op
+
+
+def srl_scores_from_counts(counts):
+  '''
+  Precision, recall and f1 from [correct, excess, missed] counts, 0 rather than nan when a denominator is 0
+  (e.g. an eval pass with no predicted or no gold arguments)
+  '''
+  counts = tf.cast(counts, tf.float64)
+  correct, excess, missed = counts[0], counts[1], counts[2]
+  precision = tf.div_no_nan(correct, correct + excess)
+  recall = tf.div_no_nan(correct, correct + missed)
+  f1 = tf.div_no_nan(2 * precision * recall, precision + recall)
+  return precision, recall, f1
+
+
+def conll_srl_eval_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                               reverse_maps, gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets,
+                               background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    score_fn = functools.partial(evaluation_fns_np.conll_srl_eval_ints,
+                                 evaluation_fns_np.reverse_map_tables(reverse_maps))
+    counts, update_op = deferred_counts_tf(score_fn, [predictions, targets, predicate_predictions, words, mask,
+                                                      predicate_targets], 3, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return f1, update_op
+
+
+def conll_srl_eval_all_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                   reverse_maps, gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets,
+                                   background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    score_fn = functools.partial(evaluation_fns_np.conll_srl_eval_ints,
+                                 evaluation_fns_np.reverse_map_tables(reverse_maps))
+    counts, update_op = deferred_counts_tf(score_fn, [predictions, targets, predicate_predictions, words, mask,
+                                                      predicate_targets], 3, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return [precision, recall, f1], update_op
+
+
+def conll09_srl_counts_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                   reverse_maps, pred_sense, gold_sense, srl_only, background):
+  score_fn = functools.partial(evaluation_fns_np.conll09_srl_eval_ints,
+                               evaluation_fns_np.reverse_map_tables(reverse_maps), srl_only=srl_only)
+  return deferred_counts_tf(score_fn, [predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                       pred_sense, gold_sense], 3, background)
+
+
+def conll09_srl_eval_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                 reverse_maps, gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets,
+                                 parse_head_targets, parse_head_predictions, parse_label_targets,
+                                 parse_label_predictions, pred_sense, gold_sense, background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    counts, update_op = conll09_srl_counts_deferred_tf(predictions, targets, predicate_predictions, words, mask,
+                                                       predicate_targets, reverse_maps, pred_sense, gold_sense,
+                                                       False, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return f1, update_op
+
+
+def conll09_srl_eval_srl_only_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                          reverse_maps, gold_srl_eval_file, pred_srl_eval_file, pos_predictions,
+                                          pos_targets, parse_head_targets, parse_head_predictions, parse_label_targets,
+                                          parse_label_predictions, pred_sense, gold_sense, background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    counts, update_op = conll09_srl_counts_deferred_tf(predictions, targets, predicate_predictions, words, mask,
+                                                       predicate_targets, reverse_maps, pred_sense, gold_sense,
+                                                       True, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return f1, update_op
+
+
+def conll09_srl_eval_all_deferred_tf(predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                                     reverse_maps, gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets,
+                                     parse_head_targets, parse_head_predictions, parse_label_targets,
+                                     parse_label_predictions, pred_sense, gold_sense, background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    counts, update_op = conll09_srl_counts_deferred_tf(predictions, targets, predicate_predictions, words, mask,
+                                                       predicate_targets, reverse_maps, pred_sense, gold_sense,
+                                                       False, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return [precision, recall, f1], update_op
+
+
+def conll09_srl_eval_all_srl_only_deferred_tf(predictions, targets, predicate_predictions, words, mask,
+                                              predicate_targets, reverse_maps, gold_srl_eval_file, pred_srl_eval_file,
+                                              pos_predictions, pos_targets, parse_head_targets, parse_head_predictions,
+                                              parse_label_targets, parse_label_predictions, pred_sense, gold_sense,
+                                              background=False):
+
+  with tf.name_scope('conll_srl_eval'):
+    counts, update_op = conll09_srl_counts_deferred_tf(predictions, targets, predicate_predictions, words, mask,
+                                                       predicate_targets, reverse_maps, pred_sense, gold_sense,
+                                                       True, background)
+    precision, recall, f1 = srl_scores_from_counts(counts)
+    return [precision, recall, f1], update_op
+
+
+def conll_parse_eval_deferred_tf(predictions, targets, parse_head_predictions, words, mask, parse_head_targets,
+                                 reverse_maps, gold_parse_eval_file, pred_parse_eval_file, pos_targets,
+                                 has_root_token=False, background=False):
+
+  with tf.name_scope('conll_parse_eval'):
+    score_fn = functools.partial(evaluation_fns_np.conll_parse_eval_ints,
+                                 evaluation_fns_np.reverse_map_tables(reverse_maps), pred_parse_eval_file,
+                                 gold_parse_eval_file, has_root_token=has_root_token)
+    counts, update_op = deferred_counts_tf(score_fn, [predictions, targets, parse_head_predictions, words, mask,
+                                                      parse_head_targets, pos_targets], 4, background)
+    counts = tf.cast(counts, tf.float64)
+    accuracies = tf.div_no_nan(counts[1:], counts[0])
+    return accuracies, update_op
+
+
 dispatcher = {
   'accuracy': accuracy_tf,
   'precision': precision_tf,
@@ -351,6 +480,14 @@ dispatcher = {
 
   'conll09_srl_eval_all': conll09_srl_eval_all_tf,
   'conll09_srl_eval_all_srl_only': conll09_srl_eval_all_srl_only_tf,
+
+  'conll_srl_eval_deferred': conll_srl_eval_deferred_tf,
+  'conll_srl_all_eval_deferred': conll_srl_eval_all_deferred_tf,
+  'conll_parse_eval_deferred': conll_parse_eval_deferred_tf,
+  'conll09_srl_eval_deferred': conll09_srl_eval_deferred_tf,
+  'conll09_srl_eval_srl_only_deferred': conll09_srl_eval_srl_only_deferred_tf,
+  'conll09_srl_eval_all_deferred': conll09_srl_eval_all_deferred_tf,
+  'conll09_srl_eval_all_srl_only_deferred': conll09_srl_eval_all_srl_only_deferred_tf,
 }
 
 
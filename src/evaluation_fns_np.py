@@ -1,10 +1,16 @@
+import atexit
+import functools
 import ntpath
-import subprocess
+import queue
+import threading
 from collections import OrderedDict
 
 import tensorflow as tf
 import numpy as np
 import util
+import srl_eval
+import srl_eval09
+import srl_transformations
 import os
 import re
 from subprocess import check_output, CalledProcessError
@@ -21,8 +27,59 @@ transformation_list =[
   'add_arg'
 ]
 
+def bilou_step(s, converted, started_types, pop_last=False):
+  '''
+  Converts the next BILOU-encoded label s, appending its conll tag to converted and closing spans on the
+  previous tag as needed. started_types holds the spans left open by the preceding labels.
+  convert_bilou and convert_bilou_true differ only in which I- type is dropped (pop_last) when reopening spans
+  '''
+  s = s if isinstance(s, str) else s.decode('utf-8')
+  label_parts = s.split('/')
+  curr_len = len(label_parts)
+  combined_str = ''
+  Itypes = []
+  Btypes = []
+  for idx, label in enumerate(label_parts):
+    bilou = label[0]
+    label_type = label[2:]
+    props_str = ''
+    if bilou == 'I':
+      Itypes.append(label_type)
+      props_str = ''
+    elif bilou == 'O':
+      curr_len = 0
+      props_str = ''
+    elif bilou == 'U':
+      # need to check whether last one was ended
+      props_str = '(' + label_type + ('*)' if idx == len(label_parts) - 1 else "")
+    elif bilou == 'B':
+      # need to check whether last one was ended
+      props_str = '(' + label_type
+      started_types.append(label_type)
+      Btypes.append(label_type)
+    elif bilou == 'L':
+      props_str = ')'
+      started_types.pop()
+      curr_len -= 1
+    combined_str += props_str
+  while len(started_types) > curr_len:
+    converted[-1] += ')'
+    started_types.pop()
+  while len(started_types) < len(Itypes) + len(Btypes):
+    combined_str = '(' + Itypes[-1] + combined_str
+    started_types.append(Itypes[-1])
+    Itypes.pop(-1 if pop_last else 0)
+  if not combined_str:
+    combined_str = '*'
+  elif combined_str[0] == "(" and combined_str[-1] != ")":
+    combined_str += '*'
+  elif combined_str[-1] == ")" and combined_str[0] != "(":
+    combined_str = '*' + combined_str
+  converted.append(combined_str)
+
+
 # todo simplify to convert_bio
-def convert_bilou(bio_predicted_roles):
+def convert_bilou(bio_predicted_roles, pop_last=False):
   '''
 
   :param bio_predicted_roles: sequence of BIO-encoded predicted role labels
@@ -31,122 +88,161 @@ def convert_bilou(bio_predicted_roles):
 
   converted = []
   started_types = []
-  for i, s in enumerate(bio_predicted_roles):
-    s = s if isinstance(s, str) else s.decode('utf-8')
-    label_parts = s.split('/')
-    # print("debug label_parts", label_parts)
-    curr_len = len(label_parts)
-    combined_str = ''
-    Itypes = []
-    Btypes = []
-    for idx, label in enumerate(label_parts):
-      bilou = label[0]
-      label_type = label[2:]
-      props_str = ''
-      if bilou == 'I':
-        Itypes.append(label_type)
-        props_str = ''
-      # elif bilou == 'I' and label_type not in started_types:
-      #   #if there's a I going in the middle without B -> treat it as B
-      #   props_str = '(' + label_type
-      #   started_types.append(label_type)
-      #   Btypes.append(label_type)
-      #   # Itypes.append(label_type)
-        # props_str = ''
-      elif bilou == 'O':
-        curr_len = 0
-        props_str = ''
-      elif bilou == 'U':
-        # need to check whether last one was ended
-        props_str = '(' + label_type + ('*)' if idx == len(label_parts) - 1 else "")
-      elif bilou == 'B':
-        # need to check whether last one was ended
-        props_str = '(' + label_type
-        started_types.append(label_type)
-        Btypes.append(label_type)
-      elif bilou == 'L':
-        # print("<debug>: ", started_types, curr_len)
-        props_str = ')'
-        started_types.pop()
-        curr_len -= 1
-      combined_str += props_str
-    while len(started_types) > curr_len:
-      # print("<debug>: ", started_types, curr_len, Btypes, Itypes)
-      converted[-1] += ')'
-      started_types.pop()
-    while len(started_types) < len(Itypes) + len(Btypes):
-      combined_str = '(' + Itypes[-1] + combined_str
-      started_types.append(Itypes[-1])
-      Itypes.pop(0)
-    if not combined_str:
-      combined_str = '*'
-    elif combined_str[0] == "(" and combined_str[-1] != ")":
-      combined_str += '*'
-    elif combined_str[-1] == ")" and combined_str[0] != "(":
-      combined_str = '*' + combined_str
-    # print("debug combined_str", combined_str)
-    converted.append(combined_str)
+  for s in bio_predicted_roles:
+    bilou_step(s, converted, started_types, pop_last)
   while len(started_types) > 0:
     converted[-1] += ')'
     started_types.pop()
   return converted
+
+
 def convert_bilou_true(bio_predicted_roles):
   '''
 
   :param bio_predicted_roles: sequence of BIO-encoded predicted role labels
   :return: sequence of conll-formatted predicted role labels
   '''
+  return convert_bilou(bio_predicted_roles, pop_last=True)
 
-  converted = []
-  started_types = []
-  for i, s in enumerate(bio_predicted_roles):
-    s = s if isinstance(s, str) else s.decode('utf-8')
-    label_parts = s.split('/')
-    curr_len = len(label_parts)
-    combined_str = ''
-    Itypes = []
-    Btypes = []
-    for idx, label in enumerate(label_parts):
-      bilou = label[0]
-      label_type = label[2:]
-      props_str = ''
-      if bilou == 'I':
-        Itypes.append(label_type)
-        props_str = ''
-      elif bilou == 'O':
-        curr_len = 0
-        props_str = ''
-      elif bilou == 'U':
-        # need to check whether last one was ended
-        props_str = '(' + label_type + ('*)' if idx == len(label_parts) - 1 else "")
-      elif bilou == 'B':
-        # need to check whether last one was ended
-        props_str = '(' + label_type
-        started_types.append(label_type)
-        Btypes.append(label_type)
-      elif bilou == 'L':
-        props_str = ')'
-        started_types.pop()
-        curr_len -= 1
-      combined_str += props_str
-    while len(started_types) > curr_len:
-      converted[-1] += ')'
-      started_types.pop()
-    while len(started_types) < len(Itypes) + len(Btypes):
-      combined_str = '(' + Itypes[-1] + combined_str
-      started_types.append(Itypes[-1])
-      Itypes.pop()
-    if not combined_str:
-      combined_str = '*'
-    elif combined_str[0] == "(" and combined_str[-1] != ")":
-      combined_str += '*'
-    elif combined_str[-1] == ")" and combined_str[0] != "(":
-      combined_str = '*' + combined_str
-    converted.append(combined_str)
-  while len(started_types) > 0:
-    converted[-1] += ')'
-    started_types.pop()
-  return converted
+
+@functools.lru_cache(maxsize=None)
+def bilou_transition(label, depth, pop_last=False):
+  '''
+  One bilou_step on label with depth spans open. Only the number of open spans carries over from one
+  label to the next, so this is all of convert_bilou's state. Returns the number of spans closed on
+  the previous tag, the label's own conll tag and the new depth, or None where convert_bilou would fail
+  '''
+  converted = ['']
+  started_types = [None] * depth
+  try:
+    bilou_step(label, converted, started_types, pop_last)
+  except IndexError:
+    return None
+  return len(converted[0]), converted[1], len(started_types)
+
+
+class BilouConverter(object):
+  '''
+  Vectorized convert_bilou over int label ids, labels[i] being the label with id i (e.g. the values of
+  vocab.reverse_maps['srl']). A bilou_transition is precomputed for every label and depth, so a batch of
+  label rows is converted with one table lookup per token position, across all rows at once.
+
+  convert returns the id of each token's own conll tag and the number of spans closed after it; these are
+  written out by to_strings and read as srl_eval brackets by load_args without going through strings
+  '''
+  def __init__(self, labels, pop_last=False):
+    labels = [l if isinstance(l, str) else l.decode('utf-8') for l in labels]
+    self.max_depth = max([l.count('/') + 1 for l in labels] + [1])
+    shape = [max(len(labels), 1), self.max_depth + 1]
+    self.valid = np.zeros(shape, dtype=bool)
+    self.prev_closes = np.zeros(shape, dtype=np.int64)
+    self.next_depth = np.zeros(shape, dtype=np.int64)
+    self.tag_ids = np.zeros(shape, dtype=np.int64)
+    tags = OrderedDict()
+    for label_id, label in enumerate(labels):
+      for depth in range(self.max_depth + 1):
+        transition = bilou_transition(label, depth, pop_last)
+        if transition is not None:
+          prev_closes, tag, next_depth = transition
+          self.valid[label_id, depth] = True
+          self.prev_closes[label_id, depth] = prev_closes
+          self.next_depth[label_id, depth] = next_depth
+          self.tag_ids[label_id, depth] = tags.setdefault(tag, len(tags))
+    self.tags = np.array(list(tags.keys()) or [''])
+
+    # the brackets of each tag, None where srl-eval.pl can't parse it
+    self.tag_brackets = []
+    for tag in self.tags:
+      try:
+        self.tag_brackets.append(srl_eval.parse_tag(tag))
+      except srl_eval.SRLEvalFormatError:
+        self.tag_brackets.append(None)
+    self.tag_has_brackets = np.array([brackets is None or any(brackets) for brackets in self.tag_brackets])
+
+  '''
+  label_ids is num_rows x batch_seq_len, lens the number of labels to convert in each row. Returns the
+  num_rows x batch_seq_len tag ids and closes, which are only meaningful within each row's length
+  '''
+  def convert(self, label_ids, lens):
+    label_ids = np.asarray(label_ids, dtype=np.int64)
+    lens = np.asarray(lens, dtype=np.int64)
+    num_rows, batch_seq_len = label_ids.shape
+    tag_ids = np.zeros([num_rows, batch_seq_len], dtype=np.int64)
+    closes = np.zeros([num_rows, batch_seq_len], dtype=np.int64)
+    depth = np.zeros(num_rows, dtype=np.int64)
+    for i in range(min(batch_seq_len, int(np.max(lens, initial=0)))):
+      active = i < lens
+      ids = label_ids[:, i]
+      valid = self.valid[ids, depth]
+      if i > 0:
+        closes[:, i - 1] += np.where(active, self.prev_closes[ids, depth], 0)
+      else:
+        # there is no previous tag to close spans on
+        valid &= self.prev_closes[ids, depth] == 0
+      if not np.all(valid[active]):
+        raise ValueError("invalid BILOU sequence at position %d" % i)
+      tag_ids[:, i] = self.tag_ids[ids, depth]
+      depth = np.where(active, self.next_depth[ids, depth], depth)
+    # close whatever is still open on the last tag of each row
+    rows = np.nonzero(lens > 0)[0]
+    closes[rows, lens[rows] - 1] += depth[rows]
+    return tag_ids, closes
+
+  def to_strings(self, tag_ids, closes):
+    close_strs = np.array([')' * n for n in range(int(np.max(closes, initial=0)) + 1)], dtype=object)
+    return self.tags.astype(object)[tag_ids] + close_strs[closes]
+
+  '''
+  The srl_eval brackets of one converted row, for each position that opens or closes a phrase
+  '''
+  def brackets(self, row):
+    tag_ids, closes = row
+    brackets = []
+    for wid in np.nonzero(self.tag_has_brackets[tag_ids] | (closes > 0))[0]:
+      tag_brackets = self.tag_brackets[tag_ids[wid]]
+      if tag_brackets is None:
+        raise srl_eval.SRLEvalFormatError("bad format in %s at %d-th position" % (self.tags[tag_ids[wid]], wid))
+      open_types, close_types = tag_brackets
+      brackets.append((wid, open_types, close_types + [''] * closes[wid]))
+    return brackets
+
+  '''
+  Arguments of one converted row, as srl_eval.load_args would read them from its conll tags
+  '''
+  def load_args(self, row):
+    return srl_eval.merge_continuations(srl_eval.build_phrases(self.brackets(row)))
+
+
+'''
+Maps arrays of string labels to ids over their distinct labels, returning the labels and the id arrays
+'''
+def encode_labels(*label_arrays):
+  label_arrays = [util.batch_str_decode(np.asarray(a)) for a in label_arrays]
+  labels, ids = np.unique(np.concatenate([np.ravel(a) for a in label_arrays]).astype(str), return_inverse=True)
+  id_arrays = []
+  for a in label_arrays:
+    id_arrays.append(np.reshape(ids[:np.size(a)], np.shape(a)))
+    ids = ids[np.size(a):]
+  return labels, id_arrays
+
+
+@functools.lru_cache(maxsize=16)
+def get_bilou_converter(labels, pop_last=False):
+  return BilouConverter(labels, pop_last)
+
+
+'''
+The num_predicates x batch_seq_len role label ids of a batch converted for write_srl_eval, along with the
+sentence lengths of each row, the predicates of a sentence taking the rows after those of the preceding ones
+'''
+def convert_batch_roles(converter, predicates, sent_lens, role_label_ids):
+  role_label_ids = np.asarray(role_label_ids)
+  if role_label_ids.ndim != 2:
+    role_label_ids = np.zeros([0, np.shape(predicates)[-1]], dtype=np.int64)
+  num_predicates_per_sent = np.sum(predicates, -1)
+  row_lens = np.repeat(sent_lens, num_predicates_per_sent)[:len(role_label_ids)]
+  row_lens = np.pad(row_lens, [0, len(role_label_ids) - len(row_lens)], 'constant')
+  return converter.convert(role_label_ids, row_lens)
 
 
 def convert_conll(predicted_roles):
@@ -222,7 +318,16 @@ def f1_np(predictions, targets, mask, accumulator):
 # -        (C-A1*  *
 # widen     *     (V*)
 # -         *     (A4*
-def write_srl_eval(filename, words, predicates, sent_lens, role_labels):
+def write_srl_eval(filename, words, predicates, sent_lens, role_labels, converter=None):
+  '''
+  role_labels are strings, or label ids of the converter's labels if one is given
+  '''
+  if converter is None:
+    labels, (role_labels,) = encode_labels(role_labels)
+    converter = get_bilou_converter(tuple(labels))
+  tag_ids, closes = convert_batch_roles(converter, predicates, sent_lens, role_labels)
+  conll_role_labels = converter.to_strings(tag_ids, closes)
+
   with open(filename, 'w') as f:
     role_labels_start_idx = 0
     num_predicates_per_sent = np.sum(predicates, -1)
@@ -232,110 +337,205 @@ def write_srl_eval(filename, words, predicates, sent_lens, role_labels):
     # for each sentence in the batch
     for sent_words, sent_predicates, sent_len, sent_num_predicates in zip(words, predicates, sent_lens,
                                                                           num_predicates_per_sent):
-      # grab predicates and convert to conll format from bio
-      # this is a sent_num_predicates x batch_seq_len array
-      sent_role_labels_bio = role_labels[role_labels_start_idx: role_labels_start_idx + sent_num_predicates]
-
-      # this is a list of sent_num_predicates lists of srl role labels
-      sent_role_labels = list(map(list, zip(*[convert_bilou(j[:sent_len]) for j in sent_role_labels_bio])))
+      # this is a batch_seq_len x sent_num_predicates array of conll role labels
+      sent_role_labels = np.transpose(conll_role_labels[role_labels_start_idx: role_labels_start_idx + sent_num_predicates])
       role_labels_start_idx += sent_num_predicates
 
       # for each token in the sentence
       for j, (word, predicate) in enumerate(zip(sent_words[:sent_len], sent_predicates[:sent_len])):
-        tok_role_labels = sent_role_labels[j] if sent_role_labels else []
+        tok_role_labels = sent_role_labels[j] if len(sent_role_labels) else []
         predicate_str = word if predicate else '-'
         roles_str = '\t'.join(tok_role_labels)
         print("%s\t%s" % (predicate_str, roles_str), file=f)
       print(file=f)
 
 
+# Yields the (targets, columns) of each sentence as write_srl_eval writes them, for srl_eval.evaluate with
+# converter.load_args, each column a row of the converted role label ids
+def srl_eval_sentences(converter, words, predicates, sent_lens, role_label_ids):
+  tag_ids, closes = convert_batch_roles(converter, predicates, sent_lens, role_label_ids)
+  role_labels_start_idx = 0
+  num_predicates_per_sent = np.sum(predicates, -1)
+
+  words = util.batch_str_decode(words)
+
+  for sent_words, sent_predicates, sent_len, sent_num_predicates in zip(words, predicates, sent_lens,
+                                                                        num_predicates_per_sent):
+    rows = range(role_labels_start_idx, min(role_labels_start_idx + sent_num_predicates, len(tag_ids)))
+    role_labels_start_idx += sent_num_predicates
+
+    targets = [str(word) if predicate else '-' for word, predicate in zip(sent_words[:sent_len],
+                                                                         sent_predicates[:sent_len])]
+    yield targets, [(tag_ids[row, :sent_len], closes[row, :sent_len]) for row in rows]
+
+
 # Write targets file w/ format:
 # 0	The	_	_	DET	DET	_	_	2	2	det	det	_	_	_	_	_	_
 # 1	economy	_	_	NOUN	NOUN	_	_	4	4	nmod:poss	nmod:poss	_	_	A1	_	_	_
 # 2	's	_	_	PART	PART	_	_	2	2	case	case	_	_	_	_	_	_
 # 3	temperature	_	_	NOUN	NOUN	_	_	7	7	nsubjpass	nsubjpass	Y	temperature.01	A2	A1	_	_
+def format_srl_eval_09(words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense):
+  '''
+  The text write_srl_eval_09 writes for a batch, built a column at a time over the whole batch
+  '''
+  return ''.join(format_srl_eval_09_sentences(words, predicates, sent_lens, role_labels, parse_heads, parse_labels,
+                                              pos_tags, sense))
+
+
+def format_srl_eval_09_sentences(words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags,
+                                 sense):
+  '''
+  The text of format_srl_eval_09 as a list of the text of each sentence
+  '''
+  to_str = np.frompyfunc(str, 1, 1)
+  predicates = util.batch_str_decode(predicates)
+  words = to_str(util.batch_str_decode(words))
+  parse_heads = to_str(np.asarray(parse_heads))
+  parse_labels = to_str(util.batch_str_decode(parse_labels))
+  pos_tags = to_str(util.batch_str_decode(pos_tags))
+  role_labels = to_str(util.batch_str_decode(role_labels))
+  batch_size, batch_seq_len = np.shape(predicates)
+
+  predicate_strs = np.where(predicates == 'True', "Y\t" + words + ':' + to_str(np.asarray(sense)), '_\t_')
+
+  # the role labels of a sentence's predicates, tab-separated, a sentence's first role row following all
+  # predicates of the preceding sentences
+  num_predicates_per_sent = np.sum(predicates == 'True', -1)
+  role_labels_start_idx = np.cumsum(num_predicates_per_sent) - num_predicates_per_sent
+  num_rows = np.clip(len(role_labels) - role_labels_start_idx, 0, num_predicates_per_sent)
+  roles_strs = np.full([batch_size, batch_seq_len], '', dtype=object)
+  for k in range(int(np.max(num_rows, initial=0))):
+    has_row = num_rows > k
+    rows = role_labels[role_labels_start_idx[has_row] + k]
+    roles_strs[has_row] = roles_strs[has_row] + ('\t' if k else '') + rows
+
+  token_ids = to_str(np.arange(batch_seq_len))
+  lines = (token_ids + '\t' + words + '\t_\t_\t' + pos_tags + '\t' + pos_tags + '\t_\t_\t' + parse_heads + '\t' +
+           parse_heads + '\t' + parse_labels + '\t' + parse_labels + '\t' + predicate_strs + '\t' + roles_strs)
+  return [''.join(line + '\n' for line in sent_lines[:sent_len]) + '\n'
+          for sent_lines, sent_len in zip(lines, sent_lens)]
+
+
 def write_srl_eval_09(filename, words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense):
   with open(filename, 'w') as f:
-    role_labels_start_idx = 0
+    f.write(format_srl_eval_09(words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense))
 
-    predicates = util.batch_str_decode(predicates)
-    words = util.batch_str_decode(words)
-    parse_labels = util.batch_str_decode(parse_labels)
-    pos_tags = util.batch_str_decode(pos_tags)
-    role_labels = util.batch_str_decode(role_labels)
 
-    # print("predicates:", predicates)
-    # todo pretty sure this assumes that 0 == '_'
-    num_predicates_per_sent = np.sum(predicates == 'True', -1)
-
-    # for each sentence in the batch
-    for sent_words, sent_predicates, sent_len, sent_num_predicates, \
-        sent_parse_heads, sent_parse_labels, sent_pos_tags, sent_sense in zip(words, predicates, sent_lens, num_predicates_per_sent,
-                                                                  parse_heads, parse_labels, pos_tags, sense):
-      # grab predicates and convert to conll format from bio
-      # this is a sent_num_predicates x batch_seq_len array
-      sent_role_labels = np.transpose(role_labels[role_labels_start_idx: role_labels_start_idx + sent_num_predicates])
+SIDECAR_SUFFIX = '.npy'
+SIDECAR_FIELDS = ['words', 'predicates', 'sent_lens', 'role_labels', 'parse_heads', 'parse_labels', 'pos_tags',
+                  'sense']
 
-      # this is a list of sent_num_predicates lists of srl role labels
-      role_labels_start_idx += sent_num_predicates
 
-      # for each token in the sentence
-      for j, (word, predicate, parse_head, parse_label, pos_tag, sense) in enumerate(zip(sent_words[:sent_len],
-                                                                                  sent_predicates[:sent_len],
-                                                                                  sent_parse_heads[:sent_len],
-                                                                                  sent_parse_labels[:sent_len],
-                                                                                  sent_pos_tags[:sent_len],
-                                                                                  sent_sense[:sent_len])):
-        tok_role_labels = sent_role_labels[j] if len(sent_role_labels) > 0 else []
-        predicate_str = "Y\t%s:%s" % (word, str(sense)) if predicate == 'True' else '_\t_'
-        roles_str = '\t'.join(tok_role_labels)
-        outputs = (j, word, pos_tag, pos_tag, parse_head, parse_head, parse_label, parse_label, predicate_str, roles_str)
-        print("%s\t%s\t_\t_\t%s\t%s\t_\t_\t%s\t%s\t%s\t%s\t%s\t%s" % outputs, file=f)
-      print(file=f)
-def write_srl_eval_09_a(filename, words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags,sense, input_source):
+class Conll09Writer(object):
+  '''
+  Appends batches to a CoNLL-2009 file through one buffered handle kept open across batches, writing each
+  batch's text at once. With sidecar, each batch's arrays are also appended with np.save to
+  filename + SIDECAR_SUFFIX, which read_srl_eval_09_sidecar reads back for scoring without parsing the text.
+  With sentence_order, the position in the input files of each sentence in the order they are written, the text
+  is kept until close and written in file order; the sidecar keeps the batches as written
+  '''
+  def __init__(self, filename, sidecar=False, sentence_order=None):
+    self.filename = filename
+    self.f = open(filename, 'a')
+    self.sidecar = open(filename + SIDECAR_SUFFIX, 'ab') if sidecar else None
+    self.sentence_order = sentence_order
+    self.sentences = []
+
+  def write(self, words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense):
+    batch = [words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense]
+    if self.sentence_order is None:
+      self.f.write(format_srl_eval_09(*batch))
+    else:
+      self.sentences.extend(format_srl_eval_09_sentences(*batch))
+    if self.sidecar is not None:
+      for field in batch:
+        field = np.asarray(field)
+        np.save(self.sidecar, util.batch_str_decode(field).astype(str) if field.dtype.kind in 'SUO' else field,
+                allow_pickle=False)
+
+  def close(self):
+    if self.sentence_order is not None:
+      self.f.write(''.join(text for _, text in sorted(zip(self.sentence_order, self.sentences),
+                                                      key=lambda sentence: sentence[0])))
+    self.f.close()
+    if self.sidecar is not None:
+      self.sidecar.close()
+
+
+_conll09_writers = {}
+_conll09_sentence_orders = {}
+_conll09_writers_lock = threading.Lock()
+
+
+def input_source_suffix(input_source):
+  return ntpath.basename(input_source).split('.')[0]
+
+
+def get_conll09_writer(filename, sidecar=False):
+  with _conll09_writers_lock:
+    if filename not in _conll09_writers:
+      sentence_order = next((order for suffix, order in _conll09_sentence_orders.items()
+                             if filename.endswith('.' + suffix)), None)
+      _conll09_writers[filename] = Conll09Writer(filename, sidecar, sentence_order)
+    return _conll09_writers[filename]
+
+
+'''
+Makes the writers of input_source write its sentences in file order when its batches are evaluated out of
+order: sentence_order is the position in the input files of each sentence in the order the batches are written
+'''
+def set_conll09_sentence_order(input_source, sentence_order):
+  with _conll09_writers_lock:
+    _conll09_sentence_orders[input_source_suffix(input_source)] = sentence_order
+
+
+'''
+Closes the writers write_srl_eval_09_a opened, which keep their files open until then; with input_source,
+only those of that input source, so files evaluated concurrently are not closed under each other
+'''
+def close_conll09_writers(input_source=None):
+  with _conll09_writers_lock:
+    for filename in list(_conll09_writers):
+      if input_source is None or filename.endswith('.' + input_source_suffix(input_source)):
+        _conll09_writers.pop(filename).close()
+    for suffix in list(_conll09_sentence_orders):
+      if input_source is None or suffix == input_source_suffix(input_source):
+        del _conll09_sentence_orders[suffix]
+
+
+atexit.register(close_conll09_writers)
+
+
+def write_srl_eval_09_a(filename, words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags,sense, input_source, sidecar=False):
   try:
     filename = filename.decode('utf-8')
   except (UnicodeDecodeError, AttributeError):
     pass
 
-  # tf.logging.log(tf.logging.INFO, "log input source  {}".format(input_source))
-  with open(filename+'.'+ntpath.basename(input_source).split('.')[0], 'a') as f:
-    role_labels_start_idx = 0
+  writer = get_conll09_writer(filename + '.' + input_source_suffix(input_source), sidecar)
+  writer.write(words, predicates, sent_lens, role_labels, parse_heads, parse_labels, pos_tags, sense)
 
-    predicates = util.batch_str_decode(predicates)
-    words = util.batch_str_decode(words)
-    parse_labels = util.batch_str_decode(parse_labels)
-    pos_tags = util.batch_str_decode(pos_tags)
-    role_labels = util.batch_str_decode(role_labels)
-
-    # print("predicates:", predicates)
-    # todo pretty sure this assumes that 0 == '_'
-    num_predicates_per_sent = np.sum(predicates == 'True', -1)
 
-    # for each sentence in the batch
-    for sent_words, sent_predicates, sent_len, sent_num_predicates, \
-        sent_parse_heads, sent_parse_labels, sent_pos_tags, sent_sense in zip(words, predicates, sent_lens, num_predicates_per_sent,
-                                                                  parse_heads, parse_labels, pos_tags, sense):
-      # grab predicates and convert to conll format from bio
-      # this is a sent_num_predicates x batch_seq_len array
-      sent_role_labels = np.transpose(role_labels[role_labels_start_idx: role_labels_start_idx + sent_num_predicates])
+def read_srl_eval_09_sidecar(filename):
+  '''
+  Yields the batches written to a Conll09Writer sidecar, as dicts of SIDECAR_FIELDS
+  '''
+  with open(filename, 'rb') as f:
+    size = os.fstat(f.fileno()).st_size
+    while f.tell() < size:
+      yield {field: np.load(f, allow_pickle=False) for field in SIDECAR_FIELDS}
 
-      # this is a list of sent_num_predicates lists of srl role labels
-      role_labels_start_idx += sent_num_predicates
 
-      # for each token in the sentence
-      for j, (word, predicate, parse_head, parse_label, pos_tag, sense) in enumerate(zip(sent_words[:sent_len],
-                                                                                  sent_predicates[:sent_len],
-                                                                                  sent_parse_heads[:sent_len],
-                                                                                  sent_parse_labels[:sent_len],
-                                                                                  sent_pos_tags[:sent_len],
-                                                                                  sent_sense[:sent_len])):
-        tok_role_labels = sent_role_labels[j] if len(sent_role_labels) > 0 else []
-        predicate_str = "Y\t%s:%s" % (word, str(sense)) if predicate == 'True' else '_\t_'
-        roles_str = '\t'.join(tok_role_labels)
-        outputs = (j, word, pos_tag, pos_tag, parse_head, parse_head, parse_label, parse_label, predicate_str, roles_str)
-        print("%s\t%s\t_\t_\t%s\t%s\t_\t_\t%s\t%s\t%s\t%s\t%s\t%s" % outputs, file=f)
-      print(file=f)
+def conll09_sidecar_counts(gold_filename, pred_filename):
+  '''
+  eval09.pl semantic counts for the batches of a gold and a predicted sidecar written in the same eval pass
+  '''
+  counts = srl_eval09.new_counts()
+  for gold, pred in zip(read_srl_eval_09_sidecar(gold_filename), read_srl_eval_09_sidecar(pred_filename)):
+    srl_eval09.merge_counts(counts, srl_eval09.evaluate(gold['words'], gold['sent_lens'], gold['predicates'],
+                                                        gold['role_labels'], gold['sense'], pred['predicates'],
+                                                        pred['role_labels'], pred['sense']))
+  return counts
 
 # Write to this format for eval.pl:
 # 1       The             _       DT      _       _       2       det
@@ -400,7 +600,7 @@ def write_srl_debug(filename, words, predicates, sent_lens, role_labels, pos_pre
 
 
 def conll_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targets, predicate_targets,
-                      pred_srl_eval_file, gold_srl_eval_file, pos_predictions=None, pos_targets=None):
+                      pred_srl_eval_file, gold_srl_eval_file, pos_predictions=None, pos_targets=None, converter=None):
 
   # predictions: num_predicates_in_batch x batch_seq_len tensor of ints
   # predicate predictions: batch_size x batch_seq_len [ x 1?] tensor of ints (0/1)
@@ -413,27 +613,19 @@ def conll_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targ
   # debug_fname = pred_srl_eval_file.decode('utf-8') + str(time.time())
   # write_srl_debug(debug_fname, words, predicate_targets, sent_lens, srl_targets, pos_predictions, pos_targets)
 
-  # write gold labels
-  write_srl_eval(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets)
-
-  # write predicted labels
-  write_srl_eval(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions)
+  # srl predictions and targets are label ids of the converter's labels if one is given
+  if converter is None:
+    labels, (srl_predictions, srl_targets) = encode_labels(srl_predictions, srl_targets)
+    converter = get_bilou_converter(tuple(labels))
 
-  # run eval script
+  # score the props write_srl_eval would write, in-process rather than with bin/srl-eval.pl
+  gold_sentences = srl_eval_sentences(converter, words, predicate_targets, sent_lens, srl_targets)
+  pred_sentences = srl_eval_sentences(converter, words, predicate_predictions, sent_lens, srl_predictions)
   correct, excess, missed = 0, 0, 0
-  with open(os.devnull, 'w') as devnull:
-    try:
-      srl_eval = check_output(["perl", "bin/srl-eval.pl", gold_srl_eval_file, pred_srl_eval_file], stderr=devnull)
-      srl_eval = srl_eval.decode('utf-8')
-      # print(" debug <srl_eval>: ", srl_eval)
-      # print(srl_eval)
-      correct, excess, missed = map(int, srl_eval.split('\n')[6].split()[1:4])
-      # vc, ve, vm = map(int, srl_eval.split('\n')[-3].split()[1:4])
-      # assert ve == 0
-      # assert  vm == 0
-      # print("correct, excess")
-    except CalledProcessError as e:
-      tf.logging.log(tf.logging.ERROR, "Call to srl-eval.pl (conll srl eval) failed.")
+  try:
+    correct, excess, missed = srl_eval.evaluate(gold_sentences, pred_sentences, converter.load_args)
+  except srl_eval.SRLEvalFormatError as e:
+    tf.logging.log(tf.logging.ERROR, "conll srl eval failed: %s" % e)
 
   # print( "debug <SRL correct {}, excess {}, missed {}>".format(correct, excess, missed))
   return correct, excess, missed
@@ -441,58 +633,78 @@ def conll_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targ
 
 
 def conll_srl_eval_with_transformation(srl_predictions, predicate_predictions, words, mask, srl_targets, predicate_targets,
-                      pred_srl_eval_file, gold_srl_eval_file, pos_predictions=None, pos_targets=None):
-
-  def run_eval_script(pred_srl_eval_file, gold_srl_eval_file):
-    correct, excess, missed = 0, 0, 0
-    # print("run eval on {} {}".format(pred_srl_eval_file, gold_srl_eval_file))
-    with open(os.devnull, 'w') as devnull:
-      try:
-        srl_eval = check_output(["perl", "bin/srl-eval.pl", gold_srl_eval_file, pred_srl_eval_file], stderr=devnull)
-        srl_eval = srl_eval.decode('utf-8')
-        # print(" debug <srl_eval>: ", srl_eval)
-        # print(srl_eval)
-        correct, excess, missed = map(int, srl_eval.split('\n')[6].split()[1:4])
-      except CalledProcessError as e:
-        tf.logging.log(tf.logging.ERROR, "Call to srl-eval.pl (conll srl eval) failed.")
-    return {'correct': correct, 'missed': missed, 'excess': excess}
-
-  # print( "debug <SRL correct {}, excess {}, missed {}>".format(correct, excess, missed))
+                      pred_srl_eval_file, gold_srl_eval_file, pos_predictions=None, pos_targets=None, num_workers=1):
+  '''
+  Scores the batch as conll_srl_eval does ('original'), and again after each transformation in
+  transformation_list, applied cumulatively to the predicted arguments by srl_transformations in
+  num_workers processes. Returns the correct, excess and missed counts of each
+  '''
 
   # predictions: num_predicates_in_batch x batch_seq_len tensor of ints
   # predicate predictions: batch_size x batch_seq_len [ x 1?] tensor of ints (0/1)
   # words: batch_size x batch_seq_len tensor of ints (0/1)
 
-  # need to print for every word in every sentence
-
   sent_lens = np.sum(mask, -1).astype(np.int32)
-  # import time
-  # debug_fname = pred_srl_eval_file.decode('utf-8') + str(time.time())
-  # write_srl_debug(debug_fname, words, predicate_targets, sent_lens, srl_targets, pos_predictions, pos_targets)
+  labels, (srl_predictions, srl_targets) = encode_labels(srl_predictions, srl_targets)
+  converter = get_bilou_converter(tuple(labels))
 
-  # write gold labels
-  write_srl_eval(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets)
+  correct, excess, missed = conll_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targets,
+                                           predicate_targets, pred_srl_eval_file, gold_srl_eval_file,
+                                           converter=converter)
+  transformation_count_map = OrderedDict({'original': {'correct': correct, 'missed': missed, 'excess': excess}})
+
+  sentences = []
+  try:
+    for (gold_targets, gold_columns), (pred_targets, pred_columns) in \
+        zip(srl_eval_sentences(converter, words, predicate_targets, sent_lens, srl_targets),
+            srl_eval_sentences(converter, words, predicate_predictions, sent_lens, srl_predictions)):
+      sentences.append((gold_targets, srl_transformations.load_props(gold_targets, map(converter.brackets, gold_columns)),
+                        pred_targets, srl_transformations.load_props(pred_targets, map(converter.brackets, pred_columns))))
+    stage_counts = srl_transformations.evaluate(sentences, transformation_list, num_workers)
+  except srl_eval.SRLEvalFormatError as e:
+    tf.logging.log(tf.logging.ERROR, "conll srl eval with transformation failed: %s" % e)
+    stage_counts = {t_name: None for t_name in transformation_list}
 
-  # print(predicate_targets)
-  # print(predicate_predictions)
-  # print(predicate_predictions == predicate_targets)
+  for t_name in transformation_list:
+    correct, excess, missed = stage_counts[t_name] or (0, 0, 0)
+    if stage_counts[t_name] is None:
+      tf.logging.log(tf.logging.ERROR, "conll srl eval after %s failed" % t_name)
+    transformation_count_map[t_name] = {'correct': correct, 'missed': missed, 'excess': excess}
+  return transformation_count_map
 
-  # write predicted labels
-  write_srl_eval(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions)
 
-  subprocess.run(["python", "bin/make_srl_transformation.py", pred_srl_eval_file, gold_srl_eval_file])
+def conll09_srl_counts(srl_predictions, predicate_predictions, words, sent_lens, srl_targets, predicate_targets,
+                       pred_sense, gold_sense):
+  '''
+  Scores the batch in-process with the semantic scoring of bin/eval09.pl, from the same arrays
+  write_srl_eval_09 writes. Returns all-zero counts, like a failed call to eval09.pl, on malformed input
+  '''
+  try:
+    return srl_eval09.evaluate(words, sent_lens, predicate_targets, srl_targets, gold_sense, predicate_predictions,
+                               srl_predictions, pred_sense)
+  except srl_eval09.SRLEval09FormatError as e:
+    tf.logging.log(tf.logging.ERROR, "conll09 srl eval failed: %s" % e)
+    return srl_eval09.new_counts()
 
-  transformation_count_map = {'original': run_eval_script(pred_srl_eval_file, gold_srl_eval_file)}
 
-  for t_name in transformation_list:
-    transformation_count_map[t_name] = run_eval_script("{}.t.{}".format(pred_srl_eval_file, t_name), "{}.t.{}".format(gold_srl_eval_file, t_name))
-    # print("{}".format(t_name), transformation_count_map[t_name])
-  return transformation_count_map
+def conll09_labeled_counts(counts, srl_only=False):
+  '''
+  Labeled correct, excess and missed semantic dependencies from eval09 counts; unless srl_only, predicate
+  senses count as dependencies on the virtual root, like eval09.pl's labeled precision and recall
+  '''
+  labeled_correct = counts['corl_arg']
+  labeled_predicted = counts['pred_arg']
+  labeled_total = counts['tot_arg']
+  if not srl_only:
+    labeled_correct += counts['corl_prop']
+    labeled_predicted += counts['pred_prop']
+    labeled_total += counts['tot_prop']
+  return labeled_correct, labeled_predicted - labeled_correct, labeled_total - labeled_correct
 
 
 def conll09_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targets, predicate_targets,
                      parse_label_predictions, parse_head_predictions, parse_label_targets, parse_head_targets,
-                     pos_targets, pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense, input_source="INVALID"):
+                     pos_targets, pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense, input_source="INVALID", sidecar=False):
 
   # predictions: num_predicates_in_batch x batch_seq_len tensor of ints
   # predicate predictions: batch_size x batch_seq_len [ x 1?] tensor of ints (0/1)
@@ -507,95 +719,20 @@ def conll09_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_ta
   # debug_fname = pred_srl_eval_file.decode('utf-8') + str(time.time())
   # write_srl_debug(debug_fname, words, predicate_targets, sent_lens, srl_targets, pos_predictions, pos_targets)
 
-  # write gold labels
-  write_srl_eval_09(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
-                    parse_label_targets, pos_targets, gold_sense)
-  if not input_source == "INVALID":
-   write_srl_eval_09_a(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
-                    parse_label_targets, pos_targets, gold_sense, input_source)
-
-  # write predicted labels
-  write_srl_eval_09(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions,
-                    parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense)
   if not input_source == "INVALID":
+    write_srl_eval_09_a(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
+                        parse_label_targets, pos_targets, gold_sense, input_source, sidecar)
     write_srl_eval_09_a(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions,
-                      parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense,input_source)
+                        parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense, input_source,
+                        sidecar)
 
-
-  # run eval script
-  labeled_correct, labeled_excess, labeled_missed, prop_correct, prop_excess, prop_missed = 0, 0, 0, 0, 0, 0
-  attempts = 0
-  with open(os.devnull, 'w') as devnull:
-    # Adding retry attempts
-    while attempts<5:
-      try:
-        srl_eval = check_output(["perl", "bin/eval09.pl", "-g", gold_srl_eval_file, "-s", pred_srl_eval_file],
-                                stderr=devnull)
-        # print("succeed getting output!")
-        srl_eval = srl_eval.decode('utf-8')
-        # Looks like this:
-        #   SYNTACTIC SCORES:
-        #   Labeled   attachment score: 2793 / 3125 * 100 = 89.38 %
-        #   Unlabeled attachment score: 2894 / 3125 * 100 = 92.61 %
-        #   Label accuracy score:       2921 / 3125 * 100 = 93.47 %
-        #   Exact syntactic match:      115 / 256 * 100 = 44.92 %
-        #
-        #   SEMANTIC SCORES:
-        #   Labeled precision:          (20 + 486) / (200 + 607) * 100 = 62.70 %
-        #   Labeled recall:             (20 + 486) / (220 + 621) * 100 = 60.17 %
-        #   Labeled F1:                 61.41
-        #   Unlabeled precision:        (51 + 544) / (200 + 607) * 100 = 73.73 %
-        #   Unlabeled recall:           (51 + 544) / (220 + 621) * 100 = 70.75 %
-        #   Unlabeled F1:               72.21
-        #   Proposition precision:      429 / 607 * 100 = 70.68 %
-        #   Proposition recall:         429 / 621 * 100 = 69.08 %
-        #   Proposition F1:             69.87
-        #   Exact semantic match:       110 / 256 * 100 = 42.97 %
-        #
-        #   OVERALL MACRO SCORES (Wsem = 0.50):
-        #   Labeled macro precision:    76.04 %
-        #   Labeled macro recall:       74.77 %
-        #   Labeled macro F1:           75.40 %
-        #   Unlabeled macro precision:  83.17 %
-        #   Unlabeled macro recall:     81.68 %
-        #   Unlabeled macro F1:         82.42 %
-        #   Exact overall match:        56 / 256 * 100 = 21.88 %
-        #
-        #   OVERALL MICRO SCORES:
-        #   Labeled micro precision:    (2793 + 20 + 486) / (3125 + 200 + 607) * 100 = 83.90 %
-        #   Labeled micro recall:       (2793 + 20 + 486) / (3125 + 220 + 621) * 100 = 83.18 %
-        #   Labeled micro F1:           83.54
-        #   Unlabeled micro precision:  (2894 + 51 + 544) / (3125 + 200 + 607) * 100 = 88.73 %
-        #   Unlabeled micro recall:     (2894 + 51 + 544) / (3125 + 220 + 621) * 100 = 87.97 %
-        #   Unlabeled micro F1:         88.35
-        eval_lines = srl_eval.split('\n')
-        # print(eval_lines[7])
-        labeled_precision_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[7]).split()))
-        # print(eval_lines[8])
-        labeled_recall_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[8]).split()))
-        prop_precision_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[13]).split()))
-        prop_recall_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[14]).split()))
-
-        labeled_correct = labeled_precision_ints[0] + labeled_precision_ints[1]
-        labeled_excess = labeled_precision_ints[2] + labeled_precision_ints[3] - labeled_correct
-        labeled_missed = labeled_recall_ints[2] + labeled_recall_ints[3] - labeled_correct
-
-        prop_correct = prop_precision_ints[0]
-        prop_excess = prop_precision_ints[1] - prop_correct
-        prop_missed = prop_recall_ints[1] - prop_correct
-        attempts = 10
-
-      except CalledProcessError as e:
-        tf.logging.log(tf.logging.ERROR, "Call to eval09.pl (conll09 srl eval) failed. retry {}".format(attempts))
-        attempts+=1
-    if attempts<10:
-      tf.logging.log(tf.logging.ERROR, "Call to eval09.pl (conll09 srl eval) failed.")
-
-  return labeled_correct, labeled_excess, labeled_missed
+  counts = conll09_srl_counts(srl_predictions, predicate_predictions, words, sent_lens, srl_targets,
+                              predicate_targets, pred_sense, gold_sense)
+  return conll09_labeled_counts(counts)
 
 def conll09_srl_eval_srl_only(srl_predictions, predicate_predictions, words, mask, srl_targets, predicate_targets,
                      parse_label_predictions, parse_head_predictions, parse_label_targets, parse_head_targets,
-                     pos_targets, pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,  input_source="INVALID"):
+                     pos_targets, pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,  input_source="INVALID", sidecar=False):
 
   # predictions: num_predicates_in_batch x batch_seq_len tensor of ints
   # predicate predictions: batch_size x batch_seq_len [ x 1?] tensor of ints (0/1)
@@ -610,91 +747,16 @@ def conll09_srl_eval_srl_only(srl_predictions, predicate_predictions, words, mas
   # debug_fname = pred_srl_eval_file.decode('utf-8') + str(time.time())
   # write_srl_debug(debug_fname, words, predicate_targets, sent_lens, srl_targets, pos_predictions, pos_targets)
 
-  # write gold labels
-  write_srl_eval_09(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
-                    parse_label_targets, pos_targets, gold_sense)
-  if not input_source == "INVALID":
-   write_srl_eval_09_a(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
-                    parse_label_targets, pos_targets, gold_sense, input_source)
-
-  # write predicted labels
-  write_srl_eval_09(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions,
-                    parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense)
   if not input_source == "INVALID":
+    write_srl_eval_09_a(gold_srl_eval_file, words, predicate_targets, sent_lens, srl_targets, parse_head_targets,
+                        parse_label_targets, pos_targets, gold_sense, input_source, sidecar)
     write_srl_eval_09_a(pred_srl_eval_file, words, predicate_predictions, sent_lens, srl_predictions,
-                      parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense, input_source)
+                        parse_head_predictions, parse_label_predictions, pos_predictions, pred_sense, input_source,
+                        sidecar)
 
-
-  # run eval script
-  labeled_correct, labeled_excess, labeled_missed, prop_correct, prop_excess, prop_missed = 0, 0, 0, 0, 0, 0
-  attempts = 0
-  with open(os.devnull, 'w') as devnull:
-    # Adding retry attempts
-    while attempts<5:
-      try:
-        srl_eval = check_output(["perl", "bin/eval09.pl", "-g", gold_srl_eval_file, "-s", pred_srl_eval_file],
-                                stderr=devnull)
-        # print("succeed getting output!")
-        srl_eval = srl_eval.decode('utf-8')
-        # Looks like this:
-        #   SYNTACTIC SCORES:
-        #   Labeled   attachment score: 2793 / 3125 * 100 = 89.38 %
-        #   Unlabeled attachment score: 2894 / 3125 * 100 = 92.61 %
-        #   Label accuracy score:       2921 / 3125 * 100 = 93.47 %
-        #   Exact syntactic match:      115 / 256 * 100 = 44.92 %
-        #
-        #   SEMANTIC SCORES:
-        #   Labeled precision:          (20 + 486) / (200 + 607) * 100 = 62.70 %
-        #   Labeled recall:             (20 + 486) / (220 + 621) * 100 = 60.17 %
-        #   Labeled F1:                 61.41
-        #   Unlabeled precision:        (51 + 544) / (200 + 607) * 100 = 73.73 %
-        #   Unlabeled recall:           (51 + 544) / (220 + 621) * 100 = 70.75 %
-        #   Unlabeled F1:               72.21
-        #   Proposition precision:      429 / 607 * 100 = 70.68 %
-        #   Proposition recall:         429 / 621 * 100 = 69.08 %
-        #   Proposition F1:             69.87
-        #   Exact semantic match:       110 / 256 * 100 = 42.97 %
-        #
-        #   OVERALL MACRO SCORES (Wsem = 0.50):
-        #   Labeled macro precision:    76.04 %
-        #   Labeled macro recall:       74.77 %
-        #   Labeled macro F1:           75.40 %
-        #   Unlabeled macro precision:  83.17 %
-        #   Unlabeled macro recall:     81.68 %
-        #   Unlabeled macro F1:         82.42 %
-        #   Exact overall match:        56 / 256 * 100 = 21.88 %
-        #
-        #   OVERALL MICRO SCORES:
-        #   Labeled micro precision:    (2793 + 20 + 486) / (3125 + 200 + 607) * 100 = 83.90 %
-        #   Labeled micro recall:       (2793 + 20 + 486) / (3125 + 220 + 621) * 100 = 83.18 %
-        #   Labeled micro F1:           83.54
-        #   Unlabeled micro precision:  (2894 + 51 + 544) / (3125 + 200 + 607) * 100 = 88.73 %
-        #   Unlabeled micro recall:     (2894 + 51 + 544) / (3125 + 220 + 621) * 100 = 87.97 %
-        #   Unlabeled micro F1:         88.35
-        eval_lines = srl_eval.split('\n')
-        # print(eval_lines[7])
-        labeled_precision_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[7]).split()))
-        # print(eval_lines[8])
-        labeled_recall_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[8]).split()))
-        prop_precision_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[13]).split()))
-        prop_recall_ints = list(map(int, re.sub('[^0-9 ]', '', eval_lines[14]).split()))
-
-        labeled_correct = labeled_precision_ints[0]
-        labeled_excess = labeled_precision_ints[2] - labeled_correct
-        labeled_missed = labeled_recall_ints[2] - labeled_correct
-
-        prop_correct = prop_precision_ints[0]
-        prop_excess = prop_precision_ints[1] - prop_correct
-        prop_missed = prop_recall_ints[1] - prop_correct
-        attempts = 10
-
-      except CalledProcessError as e:
-        tf.logging.log(tf.logging.ERROR, "Call to eval09.pl (conll09 srl eval) failed. retry {}".format(attempts))
-        attempts+=1
-    if attempts<10:
-      tf.logging.log(tf.logging.ERROR, "Call to eval09.pl (conll09 srl eval) failed.")
-
-  return labeled_correct, labeled_excess, labeled_missed
+  counts = conll09_srl_counts(srl_predictions, predicate_predictions, words, sent_lens, srl_targets,
+                              predicate_targets, pred_sense, gold_sense)
+  return conll09_labeled_counts(counts, srl_only=True)
 
 def conll_parse_eval(parse_label_predictions, parse_head_predictions, words, mask, parse_label_targets,
                         parse_head_targets, pred_eval_file, gold_eval_file, pos_targets):
@@ -728,6 +790,96 @@ def conll_parse_eval(parse_label_predictions, parse_head_predictions, words, mas
   return total, np.array([labeled_correct, unlabeled_correct, label_correct])
 
 
+def reverse_map_tables(reverse_maps):
+  '''
+  Arrays indexed by id for each reverse map, the numpy counterpart of nn_utils.int_to_str_lookup_table
+  '''
+  return {map_name: np.array(list(reverse_map.values())) for map_name, reverse_map in reverse_maps.items()}
+
+
+def conll_srl_eval_ints(tables, predictions, targets, predicate_predictions, words, mask, predicate_targets):
+  return conll_srl_eval(predictions, predicate_predictions, tables['word'][words], mask, targets, predicate_targets,
+                        None, None, converter=get_bilou_converter(tuple(tables['srl'])))
+
+
+def conll09_srl_eval_ints(tables, predictions, targets, predicate_predictions, words, mask, predicate_targets,
+                          pred_sense, gold_sense, srl_only=False):
+  sent_lens = np.sum(mask, -1).astype(np.int32)
+  counts = conll09_srl_counts(tables['srl'][predictions], tables['predicate'][predicate_predictions],
+                              tables['word'][words], sent_lens, tables['srl'][targets],
+                              tables['predicate'][predicate_targets], pred_sense, gold_sense)
+  return conll09_labeled_counts(counts, srl_only)
+
+
+def conll_parse_eval_ints(tables, pred_parse_eval_file, gold_parse_eval_file, predictions, targets,
+                          parse_head_predictions, words, mask, parse_head_targets, pos_targets, has_root_token=False):
+  str_words = tables['word'][words]
+  str_predictions = tables['parse_label'][predictions]
+  str_targets = tables['parse_label'][targets]
+  str_pos_targets = tables['gold_pos'][pos_targets]
+  if has_root_token:
+    str_words, str_predictions, str_targets, str_pos_targets = \
+      str_words[:, 1:], str_predictions[:, 1:], str_targets[:, 1:], str_pos_targets[:, 1:]
+  total, corrects = conll_parse_eval(str_predictions, parse_head_predictions, str_words, mask, str_targets,
+                                     parse_head_targets, pred_parse_eval_file, gold_parse_eval_file, str_pos_targets)
+  return np.concatenate([[total], corrects])
+
+
+class DeferredEval(object):
+  '''
+  Buffers the int arrays of each eval batch and scores them with score_fn, which returns a vector of counts
+  for one batch, only when the result is requested at the end of the eval pass. With background=True
+  batches are instead scored on a worker thread as they arrive, overlapping scoring with the forward passes.
+  Batches are scored one at a time either way, so the summed counts match scoring them in the update op
+  '''
+  def __init__(self, score_fn, num_counts, background=False):
+    self.score_fn = score_fn
+    self.counts = np.zeros(num_counts, dtype=np.int64)
+    self.background = background
+    self.pending = []
+    self.queue = None
+    self.worker = None
+    self.errors = []
+
+  def score(self, batch):
+    self.counts += np.array(self.score_fn(*batch), dtype=np.int64).reshape(self.counts.shape)
+
+  def score_queued(self):
+    while True:
+      batch = self.queue.get()
+      if batch is None:
+        break
+      try:
+        self.score(batch)
+      except Exception as e:
+        self.errors.append(e)
+
+  def append(self, *batch):
+    # copy, since the arrays py_func passes in may share memory with the batch's tensors
+    batch = [np.array(a) for a in batch]
+    if self.background:
+      if self.worker is None:
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self.score_queued, daemon=True)
+        self.worker.start()
+      self.queue.put(batch)
+    else:
+      self.pending.append(batch)
+    return np.int64(len(batch[0]))
+
+  def result(self):
+    if self.worker is not None:
+      self.queue.put(None)
+      self.worker.join()
+      self.worker = None
+    pending, self.pending = self.pending, []
+    for batch in pending:
+      self.score(batch)
+    if self.errors:
+      raise self.errors.pop(0)
+    return self.counts.copy()
+
+
 def conll_srl_eval_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
                    gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, accumulator):
 
@@ -779,7 +931,7 @@ def conll_srl_all_eval_np(predictions, targets, predicate_predictions, words, ma
 
 
 def conll_srl_eval_with_transformation_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
-                   gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, accumulator):
+                   gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, accumulator, num_workers=1):
   # print(accumulator)
   def compute_f1(correct, excess, missed):
     # print("<correct: {}, excess: {}, missed: {}>".format(correct, excess, missed))
@@ -794,7 +946,8 @@ def conll_srl_eval_with_transformation_np(predictions, targets, predicate_predic
   str_srl_targets = [list(map(reverse_maps['srl'].get, s)) for s in targets]
 
   transformation_count_map = conll_srl_eval_with_transformation(str_srl_predictions, predicate_predictions, str_words, mask, str_srl_targets,
-                                           predicate_targets, pred_srl_eval_file, gold_srl_eval_file)
+                                           predicate_targets, pred_srl_eval_file, gold_srl_eval_file,
+                                           num_workers=num_workers)
 
 
   for item_name, item_value in accumulator.items():
@@ -810,7 +963,7 @@ def conll_srl_eval_with_transformation_np(predictions, targets, predicate_predic
 
 def conll09_srl_eval_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
                         gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, parse_head_predictions,
-                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense, input_source="INVALID"):
+                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense, input_source="INVALID", sidecar=False):
 
   # first, use reverse maps to convert ints to strings
   str_srl_predictions = [list(map(reverse_maps['srl'].get, s)) for s in predictions]
@@ -826,7 +979,7 @@ def conll09_srl_eval_np(predictions, targets, predicate_predictions, words, mask
   correct, excess, missed = conll09_srl_eval(str_srl_predictions, str_predicate_predictions, str_words, mask,
                                              str_srl_targets, str_predicate_targets, str_parse_label_predictions,
                                              parse_head_predictions, str_parse_label_targets, parse_head_targets,
-                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,input_source)
+                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,input_source, sidecar)
 
   accumulator['correct'] += correct
   accumulator['excess'] += excess
@@ -840,7 +993,7 @@ def conll09_srl_eval_np(predictions, targets, predicate_predictions, words, mask
 
 def conll09_srl_eval_srl_only_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
                         gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, parse_head_predictions,
-                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense, input_source="INVALID"):
+                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense, input_source="INVALID", sidecar=False):
 
   # first, use reverse maps to convert ints to strings
   str_srl_predictions = [list(map(reverse_maps['srl'].get, s)) for s in predictions]
@@ -856,7 +1009,7 @@ def conll09_srl_eval_srl_only_np(predictions, targets, predicate_predictions, wo
   correct, excess, missed = conll09_srl_eval_srl_only(str_srl_predictions, str_predicate_predictions, str_words, mask,
                                              str_srl_targets, str_predicate_targets, str_parse_label_predictions,
                                              parse_head_predictions, str_parse_label_targets, parse_head_targets,
-                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,input_source)
+                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense,input_source, sidecar)
 
   accumulator['correct'] += correct
   accumulator['excess'] += excess
@@ -871,7 +1024,7 @@ def conll09_srl_eval_srl_only_np(predictions, targets, predicate_predictions, wo
 
 def conll09_srl_eval_all_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
                         gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, parse_head_predictions,
-                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense,input_source="INVALID"):
+                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense,input_source="INVALID", sidecar=False):
 
   # first, use reverse maps to convert ints to strings
   str_srl_predictions = [list(map(reverse_maps['srl'].get, s)) for s in predictions]
@@ -887,7 +1040,7 @@ def conll09_srl_eval_all_np(predictions, targets, predicate_predictions, words,
   correct, excess, missed = conll09_srl_eval(str_srl_predictions, str_predicate_predictions, str_words, mask,
                                              str_srl_targets, str_predicate_targets, str_parse_label_predictions,
                                              parse_head_predictions, str_parse_label_targets, parse_head_targets,
-                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense, input_source)
+                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file, pred_sense, gold_sense, input_source, sidecar)
 
   accumulator['correct'] += correct
   accumulator['excess'] += excess
@@ -901,7 +1054,7 @@ def conll09_srl_eval_all_np(predictions, targets, predicate_predictions, words,
 
 def conll09_srl_eval_all_srl_only_np(predictions, targets, predicate_predictions, words, mask, predicate_targets, reverse_maps,
                         gold_srl_eval_file, pred_srl_eval_file, pos_predictions, pos_targets, parse_head_predictions,
-                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense,input_source="INVALID"):
+                        parse_head_targets, parse_label_predictions, parse_label_targets, accumulator, pred_sense,gold_sense,input_source="INVALID", sidecar=False):
 
   # first, use reverse maps to convert ints to strings
   str_srl_predictions = [list(map(reverse_maps['srl'].get, s)) for s in predictions]
@@ -917,7 +1070,7 @@ def conll09_srl_eval_all_srl_only_np(predictions, targets, predicate_predictions
   correct, excess, missed = conll09_srl_eval_srl_only(str_srl_predictions, str_predicate_predictions, str_words, mask,
                                              str_srl_targets, str_predicate_targets, str_parse_label_predictions,
                                              parse_head_predictions, str_parse_label_targets, parse_head_targets,
-                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file,pred_sense,gold_sense, input_source)
+                                             str_pos_targets, str_pos_predictions, pred_srl_eval_file, gold_srl_eval_file,pred_sense,gold_sense, input_source, sidecar)
 
   accumulator['correct'] += correct
   accumulator['excess'] += excess
@@ -0,0 +1,443 @@
+'''
+Exports a trained model, from its checkpoints or an exported SavedModel in --save_dir, as an inference-optimized
+SavedModel in --export_dir that evaluate_exported, predict and serve load as any other.
+
+The graph is frozen to the predicted outputs, so that the loss, metric and training ops and the outputs that only
+compare against gold labels are dropped. tf.Print, Assert and CheckNumerics debug nodes are stripped, constants
+are folded, which collapses batch and layer normalization with moving statistics into their scales and shifts,
+and tf.cond branches on the frozen global step are pruned down to the branch inference takes. The op counts,
+load times and per-batch latencies of the original and the optimized models are written to
+optimization_report.json in --export_dir, along with the largest difference between their outputs.
+
+With --quantize, the weights of the bilinear classifiers, the transformer feed-forward kernels and the embedding
+tables are stored as float16, or as int8 with a scale per output channel (per label of a bilinear classifier, per
+row of an embedding table), and are dequantized in the graph. int8 weights are calibrated on the gold-labeled
+sentences of --calibration_file: while the labeled SRL F1 drops by more than --max_f1_drift, the half of the int8
+weights quantized least accurately is stored as float16 instead. The SRL F1 before and after quantization on the
+held-out sentences of --report_file is added to the report.
+'''
+import argparse
+import contextlib
+import json
+import os
+import re
+import shutil
+import sys
+import time
+from collections import Counter
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import predictor
+from tensorflow.core.protobuf import config_pb2
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.grappler import tf_optimizer
+from tensorflow.python.framework import tensor_util
+from tensorflow.tools.graph_transforms import TransformGraph
+
+import inference
+import util
+
+
+arg_parser = argparse.ArgumentParser(description='')
+inference.add_model_args(arg_parser)
+arg_parser.add_argument('--export_dir', required=True,
+                        help='Directory to write the optimized SavedModel and its report to')
+arg_parser.add_argument('--report_file',
+                        help='CoNLL-2009 file whose sentences are predicted by both models to measure their latency '
+                             'and compare their outputs')
+arg_parser.add_argument('--report_batches', type=int, default=10,
+                        help='Number of batches of --report_file to measure')
+arg_parser.add_argument('--max_batch_tokens', type=int, default=4096,
+                        help='Maximum number of tokens in a batch of --report_file, counting padding')
+arg_parser.add_argument('--quantize', choices=['int8', 'float16'],
+                        help='Whether to store the large weights as int8 with per-channel scales or as float16')
+arg_parser.add_argument('--quantize_min_elements', type=int, default=4096,
+                        help='Number of elements from which a weight matrix or embedding table is quantized')
+arg_parser.add_argument('--calibration_file',
+                        help='CoNLL-2009 file of gold-labeled sentences, other than --report_file, to calibrate '
+                             'int8 weights on')
+arg_parser.add_argument('--calibration_batches', type=int, default=50,
+                        help='Number of batches of --calibration_file to calibrate int8 weights on, and of '
+                             '--report_file to measure the SRL F1 drift on')
+arg_parser.add_argument('--max_f1_drift', type=float, default=0.005,
+                        help='Largest drop in labeled SRL F1 that int8 quantization may cause before calibration '
+                             'stores the least accurately quantized weights as float16')
+
+arg_parser.set_defaults(debug=False)
+
+GRAPH_TRANSFORMS = ['fold_constants(ignore_errors=true)', 'fold_batch_norms', 'fold_old_batch_norms',
+                    'sort_by_execution_order']
+
+# no remapper: its fused kernels are specific to the devices of the exporting host
+GRAPPLER_OPTIMIZERS = ['pruning', 'constfold', 'arithmetic', 'dependency', 'loop', 'constfold']
+
+
+def strip_debug_nodes(graph_def):
+  '''
+  Replaces the pass-through debug ops by identities of their input and removes the ones that only run as
+  control dependencies, with the control inputs on them
+  '''
+  removed = set(node.name for node in graph_def.node if node.op in ['PrintV2', 'Assert'])
+  stripped = tf.GraphDef()
+  stripped.versions.CopyFrom(graph_def.versions)
+  stripped.library.CopyFrom(graph_def.library)
+  for node in graph_def.node:
+    if node.name in removed:
+      continue
+    new_node = stripped.node.add()
+    new_node.CopyFrom(node)
+    if node.op in ['Print', 'CheckNumerics']:
+      new_node.op = 'Identity'
+      del new_node.input[:]
+      new_node.input.extend([node.input[0]] + [i for i in node.input[1:] if i.startswith('^')])
+      dtype = node.attr['T']
+      new_node.ClearField('attr')
+      new_node.attr['T'].CopyFrom(dtype)
+    inputs = [i for i in new_node.input if not (i.startswith('^') and i[1:] in removed)]
+    del new_node.input[:]
+    new_node.input.extend(inputs)
+  return stripped
+
+
+def grappler_optimize(graph_def, output_names):
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name='')
+    meta_graph = tf.train.export_meta_graph(graph_def=graph.as_graph_def(), graph=graph)
+  # grappler keeps what the train_op collection fetches
+  fetch_collection = meta_graph.collection_def['train_op']
+  fetch_collection.node_list.value.extend(output_names)
+
+  config = config_pb2.ConfigProto()
+  rewrite_options = config.graph_options.rewrite_options
+  rewrite_options.optimizers.extend(GRAPPLER_OPTIMIZERS)
+  rewrite_options.meta_optimizer_iterations = rewriter_config_pb2.RewriterConfig.TWO
+  return tf_optimizer.OptimizeGraph(config, meta_graph)
+
+
+def optimize_graph(predict_fn):
+  '''
+  Freezes, strips and folds the graph of a predictor. Returns the optimized GraphDef with the names of its input
+  and output tensors, and the op counts of the graph before and after
+  '''
+  input_name = predict_fn.feed_tensors['input'].name
+  output_names = {k: v.name for k, v in predict_fn.fetch_tensors.items() if not k.endswith("loss")}
+  output_ops = sorted(set(name.split(':')[0] for name in output_names.values()))
+
+  graph_def = predict_fn.graph.as_graph_def()
+  ops_before = Counter(node.op for node in graph_def.node)
+
+  graph_def = tf.graph_util.convert_variables_to_constants(predict_fn.session, graph_def, output_ops)
+  graph_def = strip_debug_nodes(graph_def)
+  graph_def = tf.graph_util.extract_sub_graph(graph_def, output_ops)
+  graph_def = TransformGraph(graph_def, [input_name.split(':')[0]], output_ops, GRAPH_TRANSFORMS)
+  graph_def = grappler_optimize(graph_def, output_ops)
+
+  ops_after = Counter(node.op for node in graph_def.node)
+  return graph_def, input_name, output_names, ops_before, ops_after
+
+
+def save_optimized_model(graph_def, input_name, output_names, export_dir):
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name='')
+    signature = tf.saved_model.signature_def_utils.predict_signature_def(
+      inputs={'input': graph.get_tensor_by_name(input_name)},
+      outputs={k: graph.get_tensor_by_name(v) for k, v in output_names.items()})
+    with tf.Session(graph=graph) as sess:
+      builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+      builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING], signature_def_map={
+        tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+      builder.save()
+
+
+# the frozen weights that are quantized, by the name of their variable, with the axis of their output channels:
+# the labels of the bilinear classifiers' [inputs1, labels, inputs2] weights, the output channels of the
+# transformer feed-forward kernels, and the rows of the embedding tables
+QUANTIZED_WEIGHTS = [(re.compile(r'(^|/)Bilinear/Weights$'), 1),
+                     (re.compile(r'(^|/)conv_hidden_relu/ff\d+$'), -1),
+                     (re.compile(r'(^|/)(\w+_embeddings/embeddings(_table)?|cwr_embedding)$'), 0)]
+
+
+def gather_params(graph_def):
+  '''
+  The names of the nodes gathered from, through the Identity chains, such as the /read of a variable, between
+  them and the gathers
+  '''
+  nodes = {node.name: node for node in graph_def.node}
+  gathered = set()
+  for node in graph_def.node:
+    if node.op not in ['Gather', 'GatherV2']:
+      continue
+    name = node.input[0].split(':')[0]
+    while name in nodes and nodes[name].op == 'Identity':
+      name = nodes[name].input[0].split(':')[0]
+    gathered.add(name)
+  return gathered
+
+
+def quantizable_weights(graph_def, min_elements):
+  '''
+  The float constants of the layers of QUANTIZED_WEIGHTS with at least min_elements elements, with the axis to
+  scale them along. Tables that are gathered from are scaled by row, whatever their layer
+  '''
+  gathered = gather_params(graph_def)
+  weights = {}
+  for node in graph_def.node:
+    if node.op != 'Const' or node.attr['dtype'].type != tf.float32.as_datatype_enum:
+      continue
+    shape = [d.size for d in node.attr['value'].tensor.tensor_shape.dim]
+    axes = [axis for pattern, axis in QUANTIZED_WEIGHTS if pattern.search(node.name)]
+    if axes and len(shape) >= 2 and np.prod(shape) >= min_elements:
+      weights[node.name] = 0 if node.name in gathered else axes[0] % len(shape)
+  return weights
+
+
+def quantize_int8(value, axis):
+  '''
+  Symmetric int8 quantization of value with a scale per slice along axis
+  '''
+  reduce_axes = tuple(i for i in range(value.ndim) if i != axis)
+  scales = np.max(np.abs(value), axis=reduce_axes, keepdims=True) / 127.
+  scales[scales == 0.] = 1.
+  return np.round(value / scales).astype(np.int8), scales.astype(np.float32)
+
+
+def int8_error(value, axis):
+  '''
+  Relative error of the int8 quantization of value
+  '''
+  quantized, scales = quantize_int8(value, axis)
+  norm = np.linalg.norm(value)
+  return float(np.linalg.norm(quantized * scales - value) / norm) if norm else 0.
+
+
+def const_node(name, value):
+  node = tf.NodeDef(name=name, op='Const')
+  node.attr['dtype'].type = tf.as_dtype(value.dtype).as_datatype_enum
+  node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(value))
+  return node
+
+
+def quantize_weights(graph_def, int8_weights, float16_weights):
+  '''
+  Stores the weights of int8_weights, a map from their names to their scale axes, as int8 and those of
+  float16_weights as float16. Each weight node becomes the dequantization of its stored value, so that its
+  consumers are unchanged
+  '''
+  quantized = tf.GraphDef()
+  quantized.versions.CopyFrom(graph_def.versions)
+  quantized.library.CopyFrom(graph_def.library)
+  for node in graph_def.node:
+    if node.name not in int8_weights and node.name not in float16_weights:
+      quantized.node.add().CopyFrom(node)
+      continue
+    value = tensor_util.MakeNdarray(node.attr['value'].tensor)
+    if node.name in int8_weights:
+      value, scales = quantize_int8(value, int8_weights[node.name])
+      quantized.node.extend([const_node(node.name + '/quantized', value),
+                             const_node(node.name + '/scales', scales)])
+      cast = quantized.node.add(name=node.name + '/dequantized', op='Cast', input=[node.name + '/quantized'])
+      cast.attr['SrcT'].type = tf.int8.as_datatype_enum
+      cast.attr['DstT'].type = tf.float32.as_datatype_enum
+      dequantize = quantized.node.add(name=node.name, op='Mul', input=[cast.name, node.name + '/scales'],
+                                      device=node.device)
+      dequantize.attr['T'].type = tf.float32.as_datatype_enum
+    else:
+      quantized.node.extend([const_node(node.name + '/quantized', value.astype(np.float16))])
+      cast = quantized.node.add(name=node.name, op='Cast', input=[node.name + '/quantized'], device=node.device)
+      cast.attr['SrcT'].type = tf.float16.as_datatype_enum
+      cast.attr['DstT'].type = tf.float32.as_datatype_enum
+  return quantized
+
+
+def const_bytes(graph_def):
+  return sum(len(node.attr['value'].tensor.tensor_content) for node in graph_def.node if node.op == 'Const')
+
+
+def graph_predict_fn(graph_def, input_name, output_names):
+  '''
+  A predict fn, like a predictor's, running a GraphDef in a session of its own
+  '''
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name='')
+  sess = tf.Session(graph=graph)
+  input_tensor = graph.get_tensor_by_name(input_name)
+  output_tensors = {k: graph.get_tensor_by_name(v) for k, v in output_names.items()}
+  return lambda feed: sess.run(output_tensors, {input_tensor: feed['input']})
+
+
+def srl_f1(model, predict_fn, batches):
+  return model.srl_f1([(input_np, predict_fn({'input': input_np})) for input_np in batches])
+
+
+def calibrate_quantization(model, graph_def, input_name, output_names, weights, mode, batches, max_f1_drift):
+  '''
+  Quantizes weights, storing int8 weights as float16 instead, least accurate half first, while the labeled SRL
+  F1 on the calibration batches drops by more than max_f1_drift. Returns the quantized GraphDef and its
+  quantization report
+  '''
+  f1_before = srl_f1(model, model.predict_fn, batches)
+  if mode == 'int8':
+    errors = {name: int8_error(tensor_util.MakeNdarray(node.attr['value'].tensor), weights[name])
+              for node in graph_def.node for name in [node.name] if name in weights}
+    int8_names = sorted(weights, key=lambda name: errors[name])
+  else:
+    int8_names = []
+
+  calibration_rounds = 0
+  while True:
+    int8_weights = {name: weights[name] for name in int8_names}
+    float16_weights = set(weights) - set(int8_weights)
+    quantized = quantize_weights(graph_def, int8_weights, float16_weights)
+    predict_fn = graph_predict_fn(quantized, input_name, output_names)
+    f1_after = srl_f1(model, predict_fn, batches)
+    calibration_rounds += 1
+    tf.logging.log(tf.logging.INFO, "%d int8 and %d float16 weights: SRL F1 %2.4f -> %2.4f" %
+                   (len(int8_weights), len(float16_weights), f1_before, f1_after))
+    if f1_before - f1_after <= max_f1_drift or not int8_names:
+      break
+    int8_names = int8_names[:len(int8_names) // 2]
+
+  if f1_before - f1_after > max_f1_drift:
+    tf.logging.log(tf.logging.WARNING, "SRL F1 drops by %2.4f with all quantized weights stored as float16" %
+                   (f1_before - f1_after))
+  return quantized, {
+    'mode': mode,
+    'int8_weights': len(int8_weights),
+    'float16_weights': len(float16_weights),
+    'weight_bytes_before': const_bytes(graph_def),
+    'weight_bytes_after': const_bytes(quantized),
+    'calibration_batches': len(batches),
+    'calibration_rounds': calibration_rounds,
+    'calibration_srl_f1_before': f1_before,
+    'calibration_srl_f1_after': f1_after,
+  }
+
+
+def read_batches(model, filename, max_batch_tokens, num_batches):
+  '''
+  The model inputs of the first num_batches batches of a CoNLL-2009 file
+  '''
+  with open(filename, 'r') as f:
+    sentences = [(split_lines, model.prepare_sentence(split_lines)) for split_lines in inference.read_sentences(f)]
+  batches = []
+  for batch in inference.token_budget_batches(sentences, max_batch_tokens,
+                                              sentence_len=lambda sentence: len(sentence[1])):
+    if len(batches) == num_batches:
+      break
+    batches.append(model.batch_input(batch)[0])
+  return batches
+
+
+def time_batches(predict_fn, batches):
+  '''
+  Mean seconds per batch, after a first warm-up batch, and the outputs of each batch
+  '''
+  outputs = [predict_fn({'input': batches[0]})]
+  start_time = time.time()
+  for input_np in batches[1:]:
+    outputs.append(predict_fn({'input': input_np}))
+  return (time.time() - start_time) / max(1, len(batches) - 1), outputs
+
+
+def compare_outputs(original_outputs, optimized_outputs):
+  '''
+  The largest absolute difference between the two models' values of each output, None for outputs whose
+  shapes differ, such as SRL predictions over differently predicted predicates
+  '''
+  max_diffs = {}
+  for original, optimized in zip(original_outputs, optimized_outputs):
+    for k, v in optimized.items():
+      if original[k].shape != v.shape or max_diffs.get(k, 0.) is None:
+        max_diffs[k] = None
+        continue
+      diff = float(np.max(np.abs(original[k].astype(np.float64) - v.astype(np.float64)))) if v.size else 0.
+      max_diffs[k] = max(max_diffs.get(k, 0.), diff)
+  return max_diffs
+
+
+if __name__ == '__main__':
+  args, leftovers = arg_parser.parse_known_args()
+
+  util.init_logging(tf.logging.INFO)
+
+  if os.path.exists(args.export_dir):
+    util.fatal_error("Export dir already exists: %s" % args.export_dir)
+
+  with contextlib.redirect_stdout(sys.stderr):
+    model = inference.InferenceModel(args)
+  if util.streams_cwr(model.hparams):
+    util.fatal_error("Streamed cached embeddings are gathered in a tf.py_func, which an exported model can't run")
+
+  tf.logging.log(tf.logging.INFO, "Optimizing the inference graph")
+  graph_def, input_name, output_names, ops_before, ops_after = optimize_graph(model.predict_fn)
+  quantization_report = None
+  if args.quantize:
+    if not args.calibration_file or not args.report_file:
+      util.fatal_error("--quantize needs gold-labeled sentences in --calibration_file to calibrate on and in "
+                       "--report_file to measure the SRL F1 drift on")
+    if os.path.abspath(args.calibration_file) == os.path.abspath(args.report_file):
+      util.fatal_error("--calibration_file and --report_file must differ, so that the SRL F1 drift is measured on "
+                       "sentences that were not calibrated on")
+    weights = quantizable_weights(graph_def, args.quantize_min_elements)
+    tf.logging.log(tf.logging.INFO, "Quantizing %d weights to %s" % (len(weights), args.quantize))
+    calibration_batches = read_batches(model, args.calibration_file, args.max_batch_tokens,
+                                       args.calibration_batches)
+    graph_def, quantization_report = calibrate_quantization(model, graph_def, input_name, output_names, weights,
+                                                            args.quantize, calibration_batches, args.max_f1_drift)
+    heldout_batches = read_batches(model, args.report_file, args.max_batch_tokens, args.calibration_batches)
+    quantization_report['heldout_batches'] = len(heldout_batches)
+    quantization_report['srl_f1_before'] = srl_f1(model, model.predict_fn, heldout_batches)
+    quantization_report['srl_f1_after'] = srl_f1(model, graph_predict_fn(graph_def, input_name, output_names),
+                                                 heldout_batches)
+  save_optimized_model(graph_def, input_name, output_names, args.export_dir)
+  shutil.copytree(os.path.join(args.save_dir, 'assets.extra'), os.path.join(args.export_dir, 'assets.extra'))
+  tf.logging.log(tf.logging.INFO, "Exported the optimized model: %s" % args.export_dir)
+
+  start_time = time.time()
+  optimized_predict_fn = predictor.from_saved_model(args.export_dir)
+  optimized_load_secs = time.time() - start_time
+
+  report = {
+    'ops_before': sum(ops_before.values()),
+    'ops_after': sum(ops_after.values()),
+    'ops_by_type_before': dict(ops_before),
+    'ops_by_type_after': dict(ops_after),
+    'dropped_outputs': sorted(k for k in model.predict_fn.fetch_tensors if k not in output_names),
+    'load_secs_before': model.load_secs,
+    'load_secs_after': optimized_load_secs,
+  }
+
+  if quantization_report:
+    report['quantization'] = quantization_report
+
+  if args.report_file:
+    batches = read_batches(model, args.report_file, args.max_batch_tokens, args.report_batches)
+    if batches:
+      report['report_batches'] = len(batches)
+      report['batch_secs_before'], original_outputs = time_batches(model.predict_fn, batches)
+      report['batch_secs_after'], optimized_outputs = time_batches(optimized_predict_fn, batches)
+      report['max_abs_output_diff'] = compare_outputs(original_outputs, optimized_outputs)
+
+  with open(os.path.join(args.export_dir, 'optimization_report.json'), 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+
+  tf.logging.log(tf.logging.INFO, "Ops: %d -> %d" % (report['ops_before'], report['ops_after']))
+  tf.logging.log(tf.logging.INFO, "Load time: %2.3fs -> %2.3fs" % (report['load_secs_before'],
+                                                                   report['load_secs_after']))
+  if 'report_batches' in report:
+    tf.logging.log(tf.logging.INFO, "Batch latency over %d batches: %2.4fs -> %2.4fs" %
+                   (report['report_batches'], report['batch_secs_before'], report['batch_secs_after']))
+    for k, diff in sorted(report['max_abs_output_diff'].items()):
+      if diff is None:
+        tf.logging.log(tf.logging.INFO, "Shapes of %s differ" % k)
+      else:
+        tf.logging.log(tf.logging.INFO, "Max abs diff of %s: %g" % (k, diff))
+  if quantization_report:
+    tf.logging.log(tf.logging.INFO, "Weight bytes: %d -> %d" % (quantization_report['weight_bytes_before'],
+                                                                quantization_report['weight_bytes_after']))
+    tf.logging.log(tf.logging.INFO, "Held-out SRL F1: %2.4f -> %2.4f" % (quantization_report['srl_f1_before'],
+                                                                         quantization_report['srl_f1_after']))
@@ -0,0 +1,336 @@
+'''
+Prediction on raw CoNLL-2009 sentences with a trained model, outside of the evaluation input pipeline.
+
+Sentences are given in the column layout of the data config, as lists of split lines. They are converted and
+int-mapped on the host as data_generator compiles them, padded into batches, run through the model loaded once,
+decoded as evaluate_exported decodes them and formatted as the CoNLL-2009 lines the conll09 eval fns write.
+'''
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.contrib import predictor
+
+import constants
+import data_converters
+import data_generator
+import evaluation_fns_np as eval_fns
+import srl_eval09
+import train_utils
+import util
+from model import LISAModel
+from vocab import Vocab
+
+
+def add_model_args(arg_parser):
+  arg_parser.add_argument('--save_dir', required=True,
+                          help='Directory containing the exported SavedModel or the saved model checkpoints')
+  arg_parser.add_argument('--transition_stats',
+                          help='Transition statistics between labels')
+  arg_parser.add_argument('--data_config', required=True,
+                          help='Path to data configuration json')
+  arg_parser.add_argument('--hparams', type=str,
+                          help='Comma separated list of "name=value" hyperparameter settings.')
+  arg_parser.add_argument('--model_configs', required=True,
+                          help='Comma-separated list of paths to model configuration json.')
+  arg_parser.add_argument('--task_configs', required=True,
+                          help='Comma-separated list of paths to task configuration json.')
+  arg_parser.add_argument('--layer_configs', required=True,
+                          help='Comma-separated list of paths to layer configuration json.')
+  arg_parser.add_argument('--attention_configs',
+                          help='Comma-separated list of paths to attention configuration json.')
+  arg_parser.add_argument('--debug', dest='debug', action='store_true',
+                          help='Whether to run in debug mode: a little faster and smaller')
+  arg_parser.add_argument('--okazaki_discounting', dest='okazaki_discounting', action='store_true',
+                          help='whether to use okazaki style of discounting method')
+  arg_parser.add_argument('--output_attention_weight', dest='output_attention_weight', action='store_true',
+                          help='whether to print out attention weight')
+  arg_parser.add_argument('--parser_dropout', dest='parser_dropout', action='store_true',
+                          help='whether to add a dropout layer for parser aggregation')
+  arg_parser.add_argument('--aggregator_mlp_bn', dest='aggregator_mlp_bn', action='store_true',
+                          help='whether to use batch normalization on aggregator mlp')
+
+
+def read_sentences(lines):
+  '''
+  Yields the sentences of CoNLL lines as lists of split lines, sentences separated by blank lines
+  '''
+  buf = []
+  for line in lines:
+    line = line.strip()
+    if line:
+      buf.append(line.split())
+    elif buf:
+      yield buf
+      buf = []
+  if buf:
+    yield buf
+
+
+'''
+Splits sentences into batches of at most max_batch_tokens tokens once padded to their longest sentence, and with
+max_batch_pairs, of at most that many token pairs, the quadratic cost of attention and dependency scores, keeping
+their order; a sentence over the budget is batched alone. sentence_len gives the length of a sentence
+'''
+def token_budget_batches(sentences, max_batch_tokens, sentence_len=len, max_batch_pairs=None):
+  batch = []
+  batch_seq_len = 0
+  for sentence in sentences:
+    seq_len = max(batch_seq_len, sentence_len(sentence))
+    if batch and (seq_len * (len(batch) + 1) > max_batch_tokens or
+                  max_batch_pairs and seq_len * seq_len * (len(batch) + 1) > max_batch_pairs):
+      yield batch
+      batch = []
+      seq_len = sentence_len(sentence)
+    batch.append(sentence)
+    batch_seq_len = seq_len
+  if batch:
+    yield batch
+
+
+def pad_batch(int_sents):
+  '''
+  Pads the int matrices of sentences into a batch of model input
+  '''
+  batch_seq_len = max(len(int_sent) for int_sent in int_sents)
+  width = max(int_sent.shape[1] for int_sent in int_sents)
+  input_np = np.full([len(int_sents), batch_seq_len, width], constants.PAD_VALUE, dtype=np.int32)
+  for i, int_sent in enumerate(int_sents):
+    input_np[i, :int_sent.shape[0], :int_sent.shape[1]] = int_sent
+  return input_np
+
+
+def length_sorted_batches(int_sents, max_batch_tokens, max_batch_pairs=None):
+  '''
+  Sorts the int matrices of sentences, given in file order, by length, longest first, and pads them into
+  batches under the budgets of token_budget_batches. Returns the batches and the file position of each sentence
+  in their order
+  '''
+  # a stable sort, so sentences of a length keep their file order
+  sentence_order = sorted(range(len(int_sents)), key=lambda i: -len(int_sents[i]))
+  batches = [pad_batch([int_sents[i] for i in batch])
+             for batch in token_budget_batches(sentence_order, max_batch_tokens,
+                                               sentence_len=lambda i: len(int_sents[i]),
+                                               max_batch_pairs=max_batch_pairs)]
+  return batches, sentence_order
+
+
+def _is_gold_param(param_name):
+  # params that only take gold labels for training and scoring, rather than as model input
+  return param_name.endswith('targets') or 'train' in param_name or param_name.startswith('gold')
+
+
+def find_input_columns(data_config, model_config, task_config, attention_config):
+  '''
+  The data config entries, other than token ids and words, that a model reads from its input when predicting:
+  the inputs of its model config, and the labels its task and attention configs take other than as targets,
+  such as gold predicates, POS or parses. Unlabeled sentences have to give these columns
+  '''
+  names = set(model_config.get('inputs', {}))
+
+  def add_labels(config):
+    if isinstance(config, dict):
+      for param_name, value in config.items():
+        if isinstance(value, dict) and isinstance(value.get('label'), str) and not _is_gold_param(param_name):
+          names.add(value['label'])
+        add_labels(value)
+
+  add_labels(task_config)
+  add_labels(attention_config)
+  text_columns = {data_config[d]['conll_idx'] for d in ['id', 'word'] if d in data_config}
+  return sorted(d for d in names if d in data_config and
+                set(np.ravel(data_config[d]['conll_idx'])) - text_columns - {-1})
+
+
+class SentenceConverter(object):
+  '''
+  Converts sentences, given as lists of split lines in the column layout of the data config, into the int
+  matrices a model takes, as data_generator compiles them. input_columns are the data config entries the model
+  reads from the input, which every sentence has to give
+  '''
+  def __init__(self, data_config, vocab, input_columns=()):
+    self.data_config = data_config
+    self.feature_label_names = data_generator.get_feature_label_names(data_config)
+    self.int_mappers = data_generator._int_mappers(data_config, self.feature_label_names, vocab)
+    # sentences are padded with '_' up to the last column the data config reads, so that unlabeled
+    # sentences without the trailing label columns can be converted
+    self.num_columns = 1 + max(max(np.ravel(d['conll_idx'])) for d in data_config.values())
+    self.word_idx = data_config['word']['conll_idx']
+    self.id_idx = data_config['id']['conll_idx'] if 'id' in data_config else None
+    self.input_columns = list(input_columns)
+    self.num_input_columns = 1 + max([self.word_idx] + [max(np.ravel(data_config[d]['conll_idx']))
+                                                        for d in self.input_columns])
+    # the columns of a pre-tokenized sentence other than ids and words: '0' where they are read as numbers
+    numeric_converters = [None, 'default_converter', 'idx_list_converter', 'parse_roots_self_loop',
+                          'parse_roots_unmodified', 'parse_roots_with_root_token']
+    self.empty_line = ['_'] * self.num_columns
+    for datum_config in data_config.values():
+      converter_name = datum_config['converter']['name'] if 'converter' in datum_config else None
+      if 'vocab' not in datum_config and converter_name in numeric_converters:
+        for idx in np.ravel(datum_config['conll_idx']):
+          if idx >= 0:
+            self.empty_line[idx] = '0'
+
+  def text_sentence(self, tokens):
+    '''
+    Lays out a pre-tokenized sentence as split lines in the columns of the data config. Only token ids and words
+    are filled in, so this suits models without input_columns
+    '''
+    split_lines = []
+    for i, token in enumerate(tokens):
+      line = list(self.empty_line)
+      if self.id_idx is not None:
+        line[self.id_idx] = str(i)
+      line[self.word_idx] = token
+      split_lines.append(line)
+    return split_lines
+
+  def prepare_sentence(self, split_lines):
+    '''
+    Converts a sentence, a list of split lines, into the int matrix the model takes. Raises ValueError if a line
+    is missing one of the input columns
+    '''
+    width = min(len(line) for line in split_lines)
+    if width < self.num_input_columns:
+      raise ValueError("A line has %d columns, but the model reads %s from the input, which takes %d columns"
+                       % (width, ', '.join(['word'] + self.input_columns), self.num_input_columns))
+    num_columns = max(self.num_columns, max(len(line) for line in split_lines))
+    split_lines = [line + ['_'] * (num_columns - len(line)) for line in split_lines]
+    sent = data_converters.convert_sentence(split_lines, self.data_config, self.feature_label_names)
+    return data_generator.map_sentence_to_ints(sent, self.data_config, self.feature_label_names, self.int_mappers)
+
+
+class InferenceModel(object):
+  '''
+  A trained model with its configs and vocabs, loaded once to predict any number of batches
+  '''
+  def __init__(self, args):
+    data_config = train_utils.load_json_configs(args.data_config)
+    self.data_config = OrderedDict(sorted(data_config.items(), key=lambda x: x[1]['conll_idx']
+                                          if isinstance(x[1]['conll_idx'], int) else x[1]['conll_idx'][0]))
+    model_config = train_utils.load_json_configs(args.model_configs)
+    self.task_config = train_utils.load_json_configs(args.task_configs, args)
+    layer_config = train_utils.load_json_configs(args.layer_configs)
+    attention_config = train_utils.load_json_configs(args.attention_configs)
+    layer_task_config, layer_attention_config = util.combine_attn_maps(layer_config, attention_config,
+                                                                       self.task_config)
+
+    hparams = train_utils.load_hparams(args, model_config)
+    hparams.mode = 'predict'
+    self.hparams = hparams
+
+    self.vocab = Vocab(self.data_config, args.save_dir)
+    self.feature_idx_map, self.label_idx_map = util.load_feat_label_idx_maps(self.data_config)
+    self.transition_params = util.load_transition_params(layer_task_config, self.vocab)
+    self.input_columns = find_input_columns(self.data_config, model_config, self.task_config, attention_config)
+    if getattr(args, 'input_format', None) == 'text' and self.input_columns:
+      util.fatal_error("Pre-tokenized text only gives token ids and words, but the model also reads %s from the "
+                       "input; give CoNLL-2009 sentences with those columns instead" % ', '.join(self.input_columns))
+    self.converter = SentenceConverter(self.data_config, self.vocab, self.input_columns)
+    self.output_task, self.output_eval_map = self.find_output_eval_map()
+
+    start_time = time.time()
+    if os.path.isfile(os.path.join(args.save_dir, 'saved_model.pb')):
+      if util.streams_cwr(hparams):
+        util.fatal_error("Streamed cached embeddings are gathered in a tf.py_func, which the exported model in %s "
+                         "can't run; give the directory of the model's checkpoints instead" % args.save_dir)
+      tf.logging.log(tf.logging.INFO, "Loading exported model: %s" % args.save_dir)
+      self.predict_fn = predictor.from_saved_model(args.save_dir)
+    else:
+      tf.logging.log(tf.logging.INFO, "Loading model checkpoints: %s" % args.save_dir)
+      model = LISAModel(hparams, model_config, layer_task_config, layer_attention_config, self.feature_idx_map,
+                        self.label_idx_map, self.vocab)
+      estimator = tf.estimator.Estimator(model_fn=model.model_fn, model_dir=args.save_dir)
+      self.predict_fn = predictor.from_estimator(estimator,
+                                                 serving_input_receiver_fn=train_utils.serving_input_receiver_fn)
+    self.load_secs = time.time() - start_time
+
+  def find_output_eval_map(self):
+    '''
+    The conll09 srl eval fn of the task configs, whose params say which outputs make up the CoNLL-2009 lines
+    '''
+    for task, task_map in self.task_config.items():
+      for eval_map in task_map['eval_fns'].values():
+        if eval_map['name'].startswith('conll09_srl_eval'):
+          return task, eval_map
+    util.fatal_error("No conll09_srl_eval eval fn in the task configs to take the predicted outputs from")
+
+  def text_sentence(self, tokens):
+    return self.converter.text_sentence(tokens)
+
+  def prepare_sentence(self, split_lines):
+    return self.converter.prepare_sentence(split_lines)
+
+  def batch_input(self, sentences):
+    '''
+    Pads a batch of sentences, each a (split lines, int matrix) pair, into the model input and its words
+    '''
+    input_np = pad_batch([int_sent for _, int_sent in sentences])
+    words = np.full(input_np.shape[:2], '_', dtype=object)
+    for i, (split_lines, _) in enumerate(sentences):
+      words[i, :len(split_lines)] = [line[self.converter.word_idx] for line in split_lines]
+    return input_np, words
+
+  def eval_params(self, input_np, outputs):
+    '''
+    Decodes the outputs of a batch into the params of the conll09 srl eval fn, and the tokens to keep
+    '''
+    predictions, feats, labels, tokens_to_keep = \
+      util.decode_predictions(input_np, outputs, self.feature_idx_map, self.label_idx_map, self.task_config,
+                              self.transition_params)
+    params = eval_fns.get_params(self.output_task, self.output_eval_map, predictions, feats, labels,
+                                 self.vocab.reverse_maps, tokens_to_keep)
+    return params, tokens_to_keep
+
+  def srl_f1(self, batches):
+    '''
+    Labeled SRL F1 of the conll09 srl eval fn over batches of gold-labeled sentences, given as (input, outputs)
+    pairs. No eval files are written
+    '''
+    accumulator = eval_fns.get_accumulator(self.output_eval_map['name'])
+    f1 = 0.
+    for input_np, outputs in batches:
+      params, _ = self.eval_params(input_np, outputs)
+      params['accumulator'] = accumulator
+      try:
+        f1 = eval_fns.dispatch(self.output_eval_map['name'])(**params)
+      except ZeroDivisionError:
+        f1 = 0.
+    return f1
+
+  def predict(self, sentences):
+    '''
+    Predicts a batch of sentences, each a (split lines, int matrix) pair. Returns the CoNLL-2009 lines of
+    each sentence, as written by the conll09 eval fns
+    '''
+    input_np, words = self.batch_input(sentences)
+    params, tokens_to_keep = self.eval_params(input_np, self.predict_fn({'input': input_np}))
+
+    def to_str(vocab_name, values):
+      return [list(map(self.vocab.reverse_maps[vocab_name].get, s)) for s in values]
+
+    text = eval_fns.format_srl_eval_09(words, to_str('predicate', params['predicate_predictions']),
+                                       np.sum(tokens_to_keep, -1), to_str('srl', params['predictions']),
+                                       params['parse_head_predictions'],
+                                       to_str('parse_label', params['parse_label_predictions']),
+                                       to_str('gold_pos', params['pos_predictions']), params['pred_sense'])
+    return [sent_text.split('\n') for sent_text in text.split('\n\n')[:len(sentences)]]
+
+
+'''
+The predictions in the CoNLL-2009 lines of a sentence as a dict: each token's word, POS, head and dependency
+label, and each predicate's frame, its sense and its arguments' token ids and labels
+'''
+def sentence_frames(lines):
+  rows = [line.split('\t') for line in lines]
+  tokens = [{'id': int(row[0]), 'word': row[1], 'pos': row[4], 'head': int(row[8]), 'deprel': row[10]}
+            for row in rows]
+  predicates = [row for row in rows if row[12] == 'Y']
+  frames = []
+  for k, row in enumerate(predicates):
+    arguments = [{'id': int(arg_row[0]), 'label': arg_row[14 + k]} for arg_row in rows
+                 if len(arg_row) > 14 + k and arg_row[14 + k] not in srl_eval09.EMPTY_LABELS]
+    frames.append({'id': int(row[0]), 'sense': row[13][len(row[1]) + 1:], 'arguments': arguments})
+  return {'conll09': '\n'.join(lines), 'tokens': tokens, 'frames': frames}
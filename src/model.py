@@ -30,7 +30,11 @@ class LISAModel:
     self.vocab = vocab
     self.not_load_transition = not_load_transition
 
-    if hparams.cwr != 'None':
+    if hparams.cwr != 'None' and hparams.cwr_streaming:
+      self.cwr_provider = util.CachedCWRProvider([embedding_map['cached_embeddings'] for embedding_map in
+                                                  self.model_config['cached_cwr'].values()], hparams.cwr)
+      tf.logging.log(tf.logging.INFO, "Streaming %d rows of cached embeddings." % self.cwr_provider.num_rows)
+    elif hparams.cwr != 'None':
       cwr_embeddings = []
       for embedding_name, embedding_map in self.model_config['cached_cwr'].items():
         embedding_dim = embedding_map['embedding_dim']
@@ -66,6 +70,10 @@ class LISAModel:
         initializer = tf.random_normal_initializer()
         if pretrained_fname:
           pretrained_embeddings = util.load_pretrained_embeddings(pretrained_fname)
+          pruned_rows = self.vocab.get_pruned_embedding_rows(pretrained_fname)
+          if pruned_rows is not None:
+            # ids come from the pruned vocab; all kept rows are used, with the OOV id right after them
+            pretrained_embeddings = pretrained_embeddings[pruned_rows]
 
           pretrained_num_embeddings, pretrained_embedding_dim = pretrained_embeddings.shape
           if pretrained_embedding_dim != embedding_dim:
@@ -75,13 +83,16 @@ class LISAModel:
             util.fatal_error("Number of pre-trained %s embeddings does not match specified "
                              "number of embeddings (%d vs %d)." % (name, pretrained_num_embeddings, num_embeddings))
           num_embeddings = pretrained_num_embeddings
-          if not cwr_ood:
+          if not cwr_ood and pruned_rows is None:
             num_embeddings-=1
             pretrained_embeddings = pretrained_embeddings[:-1, :]
-          initializer = tf.constant_initializer(pretrained_embeddings)
+          # fed from the memory-mapped matrix by the scaffold init_fn, rather than stored in the graph
+          initializer = tf.zeros_initializer()
 
         embedding_table = tf.get_variable(name="embeddings", shape=[num_embeddings, embedding_dim],
                                           initializer=initializer)
+        if pretrained_fname:
+          self.embedding_init_values.append((embedding_table, pretrained_embeddings))
 
         if include_oov:
           oov_embedding = tf.get_variable(name="oov_embedding", shape=[1, embedding_dim],
@@ -96,12 +107,31 @@ class LISAModel:
       pretrained_embeddings = util.load_cached_pretrained_embedding(pretrained_fname, cwr_type)
       return pretrained_embeddings
 
+  def cached_cwr_lookup(self, hparams, cached_cwr_embeddings, input_values):
+    if not hparams.cwr_streaming:
+      return tf.nn.embedding_lookup(cached_cwr_embeddings, input_values)
+
+    # read only this batch's rows from the memory-mapped cached embeddings
+    provider = self.cwr_provider
+    input_embedding_lookup = tf.py_func(provider.gather, [input_values], tf.float32, stateful=False)
+    input_embedding_lookup.set_shape(input_values.shape.concatenate([provider.embedding_dim]))
+    if hparams.cwr_ood:
+      # the id after the last cached row gets its own (fixed, checkpointed) random embedding
+      ood_embedding = tf.get_variable("cwr_ood_embedding", shape=[provider.embedding_dim], trainable=False,
+                                      initializer=tf.random_normal_initializer(stddev=0.05))
+      is_ood = tf.cast(tf.equal(input_values, provider.num_rows), tf.float32)
+      input_embedding_lookup += tf.expand_dims(is_ood, -1) * ood_embedding
+    return input_embedding_lookup
+
   def model_fn(self, features, mode):
 
     # todo can estimators handle dropout for us or do we need to do it on our own?
     hparams = self.hparams(mode)
     tf.logging.log(tf.logging.INFO, "Running in {} mode.".format(mode))
 
+    # (variable, value) pairs for variables initialized from pre-trained embeddings by the scaffold init_fn
+    self.embedding_init_values = []
+
 
     with tf.variable_scope("LISA", reuse=tf.AUTO_REUSE):
       # features = tf.Print(features, [features, tf.shape(features)], 'input features')
@@ -176,12 +206,16 @@ class LISAModel:
       inputs_list = []
       gp_embs = []
       with tf.device("CPU:0"):
-        if hparams.cwr != "None" or hparams.glove_300d:
-          if hparams.cwr != "None":
-            cached_cwr_embeddings = tf.get_variable("cwr_embedding", shape=self.cwr_embedding.shape, trainable=False)
+        cached_cwr_embeddings = None
+        if hparams.cwr != "None" and not hparams.cwr_streaming:
+          cached_cwr_embeddings = tf.get_variable("cwr_embedding", shape=self.cwr_embedding.shape, trainable=False)
+          self.embedding_init_values.append((cached_cwr_embeddings, self.cwr_embedding))
+        scaffold = None
+        if self.embedding_init_values:
+          embedding_init_values = list(self.embedding_init_values)
           def init_fn(scaffold, sess):
-            if hparams.cwr != "None":
-              sess.run(cached_cwr_embeddings.initializer, {cached_cwr_embeddings.initial_value: self.cwr_embedding})
+            for variable, initial_value in embedding_init_values:
+              sess.run(variable.initializer, {variable.initial_value: initial_value})
           scaffold = tf.train.Scaffold(init_fn=init_fn)
 
 
@@ -195,7 +229,7 @@ class LISAModel:
             #   cached_cwr_embeddings_oov = tf.concat([cached_cwr_embeddings, ROOT_emb], axis=0)
             #   input_embedding_lookup = tf.nn.embedding_lookup(cached_cwr_embeddings_oov, input_values)
             # else:
-            input_embedding_lookup = tf.nn.embedding_lookup(cached_cwr_embeddings, input_values)
+            input_embedding_lookup = self.cached_cwr_lookup(hparams, cached_cwr_embeddings, input_values)
             with tf.variable_scope("cwr_assembly"):
               num_layers = 3#input_embedding_lookup.get_shape()[2]
               weight = tf.get_variable("cwr_weight", shape=[num_layers])
@@ -203,7 +237,7 @@ class LISAModel:
               input_embedding_lookup = scale * tf.math.reduce_sum(
               tf.split(input_embedding_lookup, axis=-1, num_or_size_splits=num_layers) * tf.reshape(tf.nn.softmax(weight), shape=[num_layers, 1, 1, 1]), axis=0)
           elif input_transformation_name == "bert_embeddings":
-            input_embedding_lookup = tf.nn.embedding_lookup(cached_cwr_embeddings, input_values)
+            input_embedding_lookup = self.cached_cwr_lookup(hparams, cached_cwr_embeddings, input_values)
           elif input_transformation_name == "embeddings":
             print("embeddings", input_name, embeddings[input_name])
             input_embedding_lookup = tf.nn.embedding_lookup(embeddings[input_name], input_values)
@@ -245,6 +279,10 @@ class LISAModel:
       loss = tf.constant(0.)
       items_to_log = {}
 
+      # input pipeline stall statistics, if enabled with log_input_stalls
+      for input_stat in tf.get_collection(constants.INPUT_STATS_COLLECTION):
+        items_to_log[input_stat.op.name.split('/')[-1]] = input_stat
+
 
       num_layers = max(self.task_config.keys()) + 1
       tf.logging.log(tf.logging.INFO, "Creating transformer model with %d layers" % num_layers)
@@ -386,7 +424,12 @@ class LISAModel:
                                                              task_labels, self.vocab.reverse_maps, tokens_to_keep)
                   if eval_name == 'parse_eval' and hparams.using_input_with_root:
                     eval_fn_params['has_root_token']=True
-                  eval_result = evaluation_fns.dispatch(eval_map['name'])(**eval_fn_params)
+                  eval_fn_name = eval_map['name']
+                  deferred_eval_fn_name = '%s_deferred' % eval_fn_name
+                  if hparams.deferred_eval and deferred_eval_fn_name in evaluation_fns.dispatcher:
+                    eval_fn_name = deferred_eval_fn_name
+                    eval_fn_params['background'] = hparams.deferred_eval_background
+                  eval_result = evaluation_fns.dispatch(eval_fn_name)(**eval_fn_params)
                   eval_metric_ops[eval_name] = eval_result
 
                 # get the individual task loss and apply penalty
@@ -501,11 +544,11 @@ class LISAModel:
 
         if mode == tf.estimator.ModeKeys.TRAIN:
           return tf.estimator.EstimatorSpec(mode, flat_predictions, loss, train_op, eval_metric_ops,
-                                          training_hooks=[logging_hook, summary_hook], export_outputs=export_outputs, scaffold=scaffold if hparams.cwr!='None' else None)
+                                          training_hooks=[logging_hook, summary_hook], export_outputs=export_outputs, scaffold=scaffold)
         elif mode == tf.estimator.ModeKeys.EVAL:
           return tf.estimator.EstimatorSpec(mode, flat_predictions, loss, train_op, eval_metric_ops,
-                                            training_hooks=[logging_hook], export_outputs=export_outputs, scaffold=scaffold if hparams.cwr!='None' else None)
+                                            training_hooks=[logging_hook], export_outputs=export_outputs, scaffold=scaffold)
         elif mode == tf.estimator.ModeKeys.PREDICT:
           return tf.estimator.EstimatorSpec(mode, flat_predictions, loss, tf.no_op(), eval_metric_ops,
                                             export_outputs=export_outputs,
-                                            scaffold=scaffold if hparams.cwr != 'None' else None)
+                                            scaffold=scaffold)
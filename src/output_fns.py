@@ -891,7 +891,7 @@ def srl_bilinear(mode, hparams, model_config, inputs, targets, num_labels, token
     seq_lens = tf.cast(tf.reduce_sum(mask, 1), tf.int32)
 
     if transition_params is not None and (mode == ModeKeys.PREDICT or mode == ModeKeys.EVAL):
-      predictions, score = tf.contrib.crf.crf_decode(srl_logits_transposed, transition_params, seq_lens)
+      predictions, score = tf_utils.viterbi_decode(srl_logits_transposed, seq_lens, transition_params)
       log_likelihood, transition_params = tf.contrib.crf.crf_log_likelihood(tf.stop_gradient(srl_logits_transposed),
                                                                             srl_targets_predicted_predicates,
                                                                             seq_lens,
@@ -5119,7 +5119,7 @@ def srl_bilinear_dep_prior_bilinear(mode, hparams, model_config, inputs, targets
     if hparams.conll05 and (mode == ModeKeys.PREDICT or mode == ModeKeys.EVAL):
       srl_logits_transposed = tf.reduce_sum(tf.nn.softmax(srl_logits_transposed, axis=-1) * z_prob, axis=-2)
       srl_logits_transposed = tf.math.log(srl_logits_transposed)
-      predictions, score = tf.contrib.crf.crf_decode(srl_logits_transposed, transition_params, seq_lens)
+      predictions, score = tf_utils.viterbi_decode(srl_logits_transposed, seq_lens, transition_params)
       log_likelihood, transition_params = tf.contrib.crf.crf_log_likelihood(tf.stop_gradient(srl_logits_transposed),
                                                                             srl_targets_predicted_predicates,
                                                                             seq_lens,
@@ -5137,6 +5137,18 @@ def srl_bilinear_dep_prior_bilinear(mode, hparams, model_config, inputs, targets
     return output
 
 
+def decodes_viterbi_in_graph(output_fn_name, hparams):
+  '''
+  Whether the output fn's predictions are already Viterbi decoded in-graph with its transition params,
+  rather than the argmax of its scores
+  '''
+  if output_fn_name == 'srl_bilinear':
+    return True
+  if output_fn_name == 'srl_bilinear_dep_prior_bilinear':
+    return bool(hparams.conll05)
+  return False
+
+
 dispatcher = {
   'srl_bilinear': srl_bilinear,
   'srl_bilinear_dep_prior': srl_bilinear_dep_prior,
@@ -0,0 +1,87 @@
+'''
+Streaming prediction with a trained model: reads unlabeled CoNLL-2009 sentences, in the column layout of
+--data_config, or pre-tokenized text, one sentence per line, from a file or stdin, and writes the predicted
+CoNLL-2009 lines, as the conll09 eval fns write them, in input order.
+
+Sentences are read, batched by --max_batch_tokens and written one batch at a time, with reading and prediction
+overlapped through bounded queues, so memory stays constant however large the input.
+'''
+import argparse
+import contextlib
+import sys
+
+import tensorflow as tf
+
+import inference
+import util
+
+
+arg_parser = argparse.ArgumentParser(description='')
+inference.add_model_args(arg_parser)
+arg_parser.add_argument('--input', default='-',
+                        help='File to read sentences from, - for stdin')
+arg_parser.add_argument('--output', default='-',
+                        help='File to write predictions to, - for stdout')
+arg_parser.add_argument('--input_format', choices=['conll09', 'text'], default='conll09',
+                        help='Whether the input is CoNLL-2009 sentences separated by blank lines, or pre-tokenized '
+                             'text with one sentence per line and tokens separated by whitespace')
+arg_parser.add_argument('--max_batch_tokens', type=int, default=4096,
+                        help='Maximum number of tokens in a batch, counting padding to its longest sentence')
+arg_parser.add_argument('--pipeline_queue_size', type=int, default=2,
+                        help='Number of batches that may wait between reading and prediction; 0 runs them serially')
+
+arg_parser.set_defaults(debug=False)
+
+
+def read_input(f, model, input_format):
+  if input_format == 'text':
+    return (model.text_sentence(line.split()) for line in f if line.strip())
+  return inference.read_sentences(f)
+
+
+def prepare_sentences(sentences, model):
+  for i, split_lines in enumerate(sentences):
+    try:
+      yield split_lines, model.prepare_sentence(split_lines)
+    except Exception as e:
+      raise ValueError("Could not read sentence %d: %s" % (i + 1, e))
+
+
+def predict_stream(model, input_file, output_file, input_format, max_batch_tokens, pipeline_queue_size):
+  '''
+  Predicts the sentences of input_file in batches and writes their CoNLL-2009 lines to output_file in input
+  order, one batch at a time. Returns the number of sentences predicted
+  '''
+  num_sentences = 0
+  batches = inference.token_budget_batches(prepare_sentences(read_input(input_file, model, input_format), model),
+                                           max_batch_tokens, sentence_len=lambda sentence: len(sentence[1]))
+  for sentences_lines in util.pipeline(batches, [model.predict], pipeline_queue_size):
+    output_file.write(''.join('\n'.join(lines) + '\n\n' for lines in sentences_lines))
+    output_file.flush()
+    num_sentences += len(sentences_lines)
+  return num_sentences
+
+
+if __name__ == '__main__':
+  args, leftovers = arg_parser.parse_known_args()
+
+  util.init_logging(tf.logging.INFO)
+
+  # keep stdout for the predictions
+  with contextlib.redirect_stdout(sys.stderr):
+    model = inference.InferenceModel(args)
+  input_file = sys.stdin if args.input == '-' else open(args.input, 'r')
+  output_file = sys.stdout if args.output == '-' else open(args.output, 'w')
+
+  try:
+    num_sentences = predict_stream(model, input_file, output_file, args.input_format, args.max_batch_tokens,
+                                   args.pipeline_queue_size)
+  except ValueError as e:
+    util.fatal_error(str(e))
+  finally:
+    if input_file is not sys.stdin:
+      input_file.close()
+    if output_file is not sys.stdout:
+      output_file.close()
+
+  tf.logging.log(tf.logging.INFO, "Predicted %d sentences" % num_sentences)
@@ -0,0 +1,189 @@
+'''
+Local HTTP inference service for a trained model.
+
+The model is loaded once. POST /predict takes one or more CoNLL-2009 sentences, in the column layout of
+--data_config and separated by blank lines, as the request body (or as the "conll09" field of a JSON body).
+Sentences of concurrent requests are grouped into batches of at most --max_batch_tokens padded tokens, waiting
+at most --max_latency_ms for a batch to fill. Each sentence is answered with its predicted CoNLL-2009 lines and
+its tokens' POS and parse and its predicates' senses and SRL frames as JSON. GET /health reports that the
+service is up.
+'''
+import argparse
+import http.server
+import json
+import queue
+import socketserver
+import threading
+import time
+
+import tensorflow as tf
+
+import inference
+import util
+
+
+arg_parser = argparse.ArgumentParser(description='')
+inference.add_model_args(arg_parser)
+arg_parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to serve on')
+arg_parser.add_argument('--port', type=int, default=8000,
+                        help='Port to serve on')
+arg_parser.add_argument('--max_batch_tokens', type=int, default=4096,
+                        help='Maximum number of tokens in a batch, counting padding to its longest sentence')
+arg_parser.add_argument('--max_latency_ms', type=float, default=10.,
+                        help='Maximum time to wait for more sentences to fill a batch once one is pending')
+
+arg_parser.set_defaults(debug=False)
+
+
+class PendingRequest(object):
+  def __init__(self, num_sentences):
+    self.results = [None] * num_sentences
+    self.remaining = num_sentences
+    self.error = None
+    self.done = threading.Event()
+
+  def set_result(self, i, result):
+    self.results[i] = result
+    self.remaining -= 1
+    if not self.remaining:
+      self.done.set()
+
+  def set_error(self, error):
+    self.error = error
+    self.done.set()
+
+
+class DynamicBatcher(object):
+  '''
+  Predicts the sentences of concurrent requests in shared batches, in a thread of its own. A batch is
+  started by the first pending sentence and takes the sentences that follow it until it would exceed
+  max_batch_tokens or max_latency_secs have passed
+  '''
+  def __init__(self, model, max_batch_tokens, max_latency_secs):
+    self.model = model
+    self.max_batch_tokens = max_batch_tokens
+    self.max_latency_secs = max_latency_secs
+    self.queue = queue.Queue()
+    self.next_item = None
+    self.worker = threading.Thread(target=self.run, daemon=True)
+    self.worker.start()
+
+  def submit(self, sentences):
+    request = PendingRequest(len(sentences))
+    for i, sentence in enumerate(sentences):
+      self.queue.put((sentence, request, i))
+    return request
+
+  def next_batch(self):
+    batch = [self.next_item if self.next_item is not None else self.queue.get()]
+    self.next_item = None
+    batch_seq_len = len(batch[0][0][1])
+    deadline = time.time() + self.max_latency_secs
+    while True:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        break
+      try:
+        item = self.queue.get(timeout=timeout)
+      except queue.Empty:
+        break
+      seq_len = max(batch_seq_len, len(item[0][1]))
+      if seq_len * (len(batch) + 1) > self.max_batch_tokens:
+        # starts the next batch
+        self.next_item = item
+        break
+      batch.append(item)
+      batch_seq_len = seq_len
+    return batch
+
+  def predict(self, batch):
+    '''
+    Predicts a batch and answers its sentences. If the batch fails, its sentences are predicted again one at a
+    time, so that a sentence the model can't predict only fails its own request
+    '''
+    try:
+      results = self.model.predict([sentence for sentence, _, _ in batch])
+    except Exception as e:
+      if len(batch) == 1:
+        tf.logging.log(tf.logging.ERROR, "Failed to predict a sentence: %s" % e)
+        batch[0][1].set_error(e)
+        return
+      tf.logging.log(tf.logging.WARN, "Failed to predict a batch of %d sentences, predicting them one at a time: %s"
+                     % (len(batch), e))
+      for item in batch:
+        if item[1].error is None:
+          self.predict([item])
+      return
+    for (_, request, i), lines in zip(batch, results):
+      if request.error is None:
+        request.set_result(i, inference.sentence_frames(lines))
+
+  def run(self):
+    while True:
+      self.predict(self.next_batch())
+
+
+class PredictHandler(http.server.BaseHTTPRequestHandler):
+  batcher = None
+
+  def send_json(self, status, obj):
+    body = json.dumps(obj).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if self.path == '/health':
+      self.send_json(200, {'status': 'ok'})
+    else:
+      self.send_json(404, {'error': 'Not found: %s' % self.path})
+
+  def do_POST(self):
+    if self.path != '/predict':
+      self.send_json(404, {'error': 'Not found: %s' % self.path})
+      return
+    try:
+      body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+      if self.headers.get('Content-Type', '').startswith('application/json'):
+        body = json.loads(body)['conll09']
+      sentences = [(split_lines, self.batcher.model.prepare_sentence(split_lines))
+                   for split_lines in inference.read_sentences(body.splitlines())]
+    except Exception as e:
+      self.send_json(400, {'error': 'Could not read the sentences: %s' % e})
+      return
+    if not sentences:
+      self.send_json(400, {'error': 'No sentences given'})
+      return
+
+    request = self.batcher.submit(sentences)
+    request.done.wait()
+    if request.error is not None:
+      self.send_json(500, {'error': 'Prediction failed: %s' % request.error})
+    else:
+      self.send_json(200, {'sentences': request.results})
+
+  def log_message(self, format, *args):
+    tf.logging.log(tf.logging.DEBUG, "%s - %s" % (self.address_string(), format % args))
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+  daemon_threads = True
+
+
+if __name__ == '__main__':
+  args, leftovers = arg_parser.parse_known_args()
+
+  util.init_logging(tf.logging.INFO)
+
+  PredictHandler.batcher = DynamicBatcher(inference.InferenceModel(args), args.max_batch_tokens,
+                                          args.max_latency_ms / 1000.)
+  server = ThreadingHTTPServer((args.host, args.port), PredictHandler)
+  tf.logging.log(tf.logging.INFO, "Serving predictions on http://%s:%d/predict" % (args.host, args.port))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  server.server_close()
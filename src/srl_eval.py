@@ -0,0 +1,210 @@
+'''
+In-process port of the CoNLL-2005 scorer bin/srl-eval.pl.
+
+Propositions are scored exactly as srl-eval.pl scores them, including its handling of nested phrases,
+continuation (C-X) arguments and the exclusion of V from the counts, so that correct/excess/missed
+match the perl script's "Overall" line without spawning a process per eval batch.
+'''
+import re
+
+
+EXCLUDED_TYPES = {'V'}
+
+_OPEN_RE = re.compile(r'^\(((\\\*|[^*(])+)')
+_CLOSE_RE = re.compile(r'^([^)]*)\)')
+_FIELD_SEP_RE = re.compile(r'[ \t\n\r\f\v]+')
+
+
+class SRLEvalFormatError(ValueError):
+  '''
+  Raised wherever srl-eval.pl would die on malformed input
+  '''
+  pass
+
+
+class Phrase(object):
+
+  def __init__(self, start, end=None, type=None):
+    self.start = start
+    self.end = end
+    self.type = type
+    self.phrases = []
+
+  def single(self):
+    return not self.phrases
+
+  def dfs(self):
+    return [self] + [p for sub in self.phrases for p in sub.dfs()]
+
+
+'''
+Parses one Start-End tag into the types of the phrases it opens and of those it closes ('' if untyped)
+'''
+def parse_tag(tag, wid=0):
+  open_types, close_types = [], []
+  while not tag.startswith('*'):
+    match = _OPEN_RE.match(tag)
+    if not match:
+      raise SRLEvalFormatError("opening nodes -- bad format in %s at %d-th position" % (tag, wid))
+    open_types.append(match.group(1))
+    tag = tag[match.end():]
+  tag = tag[1:]
+  while tag:
+    match = _CLOSE_RE.match(tag)
+    if not match:
+      raise SRLEvalFormatError("closing phrases -- bad format in %s at %d-th position" % (tag, wid))
+    close_types.append(match.group(1))
+    tag = tag[match.end():]
+  return open_types, close_types
+
+
+'''
+Builds phrases from (position, open types, close types) brackets, listed for every position that opens or
+closes a phrase. Phrases are returned in the order srl-eval.pl's phrase_set lists them: by start position,
+longest first, with nested phrases listed as well as attached to their parent
+'''
+def build_phrases(brackets):
+  started = []
+  phrase_set = {}
+  for wid, open_types, close_types in brackets:
+    for open_type in open_types:
+      started.append(Phrase(wid, type=open_type))
+    for close_type in close_types:
+      if not started:
+        raise SRLEvalFormatError("closing phrases -- no open phrase at %d-th position" % wid)
+      phrase = started.pop()
+      if close_type and close_type != phrase.type:
+        raise SRLEvalFormatError("types do not match at %d-th position" % wid)
+      phrase.end = wid
+      if started:
+        started[-1].phrases.append(phrase)
+      else:
+        for p in phrase.dfs():
+          phrase_set[(p.start, p.end)] = p
+  if started:
+    raise SRLEvalFormatError("some phrases are unclosed")
+  return [phrase_set[span] for span in sorted(phrase_set, key=lambda span: (span[0], -span[1]))]
+
+
+def load_phrases(tags):
+  return build_phrases((wid,) + tuple(parse_tag(tag, wid)) for wid, tag in enumerate(tags))
+
+
+'''
+Converts the phrases of a column into the arguments of a proposition, merging C-X continuation phrases
+into the preceding X argument
+'''
+def merge_continuations(phrases):
+  args = []
+  args_by_type = {}
+  for arg in phrases:
+    if arg.type.startswith('C-'):
+      arg_type = arg.type[2:]
+      if arg_type in args_by_type:
+        head = args_by_type[arg_type]
+        if head.single():
+          head.phrases.append(Phrase(head.start, head.end, arg_type))
+        head.phrases.append(arg)
+        head.end = arg.end
+        continue
+      arg.type = arg_type
+    args.append(arg)
+    args_by_type[arg.type] = arg
+  return args
+
+
+def load_args(tags):
+  return merge_continuations(load_phrases(tags))
+
+
+'''
+Splits predicted args into those matching a gold arg (ok) and those that don't (op), and returns the
+gold args left unmatched (ms)
+'''
+def discriminate_args(gold_args, pred_args):
+  gold_by_span = {}
+  for arg in gold_args:
+    gold_by_span[(arg.start, arg.end)] = arg
+
+  ok, op = [], []
+  for arg in pred_args:
+    span = (arg.start, arg.end)
+    gold = gold_by_span.get(span)
+    if gold is None or gold.type != arg.type or gold.single() != arg.single():
+      op.append(arg)
+      continue
+    if not gold.single():
+      pred_phrases = [(p.start, p.end) for p in arg.phrases]
+      if len(set(pred_phrases)) != len(pred_phrases) or \
+          set(pred_phrases) != set((p.start, p.end) for p in gold.phrases):
+        op.append(arg)
+        continue
+    ok.append(arg)
+    del gold_by_span[span]
+  return ok, op, list(gold_by_span.values())
+
+
+def evaluate_proposition(gold_args, pred_args):
+  ok, op, ms = discriminate_args(gold_args, pred_args)
+  return tuple(sum(1 for arg in args if arg.type not in EXCLUDED_TYPES) for args in (ok, op, ms))
+
+
+'''
+Builds the propositions of a sentence, a map from predicate position to (verb, args), from its target
+column (the verb or '-' for each token) and one column per predicate, by default of Start-End tags
+'''
+def load_props(targets, columns, load_column=load_args):
+  props = {}
+  columns = list(columns)
+  for i, target in enumerate(targets):
+    if target != '-':
+      props[i] = (target, load_column(columns.pop(0)) if columns else [])
+  return props
+
+
+'''
+Scores aligned sequences of gold and predicted sentences, each a (targets, columns) pair as read from
+an srl-eval.pl props file, with load_column converting each column into arguments.
+Returns the overall (correct, excess, missed) counts
+'''
+def evaluate(gold_sentences, pred_sentences, load_column=load_args):
+  correct, excess, missed = 0, 0, 0
+  pred_sentences = iter(pred_sentences)
+  for sent_idx, (gold_targets, gold_columns) in enumerate(gold_sentences):
+    # like srl-eval.pl, the first empty sentence ends the file
+    if not gold_targets:
+      break
+    gold_props = load_props(gold_targets, gold_columns, load_column)
+    pred_targets, pred_columns = next(pred_sentences, ([], []))
+    if len(pred_targets) != len(gold_targets):
+      raise SRLEvalFormatError("sentence %d : gold and pred sentences do not align correctly" % sent_idx)
+    pred_props = load_props(pred_targets, pred_columns, load_column)
+
+    for position, (verb, gold_args) in gold_props.items():
+      pred_verb, pred_args = pred_props.get(position, (None, []))
+      ok, op, ms = evaluate_proposition(gold_args, pred_args if pred_verb == verb else [])
+      correct += ok
+      excess += op
+      missed += ms
+  return correct, excess, missed
+
+
+def read_sentences(filename):
+  with open(filename, encoding='utf-8') as f:
+    while True:
+      columns = []
+      for line in f:
+        fields = [field for field in _FIELD_SEP_RE.split(line) if field]
+        if not fields:
+          break
+        for i, field in enumerate(fields):
+          if i == len(columns):
+            columns.append([])
+          columns[i].append(field)
+      if not columns:
+        return
+      yield columns[0], columns[1:]
+
+
+def evaluate_files(gold_filename, pred_filename):
+  return evaluate(read_sentences(gold_filename), read_sentences(pred_filename))
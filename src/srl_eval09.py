@@ -0,0 +1,174 @@
+'''
+In-process port of the semantic scoring of the CoNLL-2009 scorer bin/eval09.pl.
+
+Counts are computed directly from the batch arrays that write_srl_eval_09 would write out, and match the
+SEMANTIC SCORES section of eval09.pl: predicates are dependencies on a virtual root labeled with their
+sense, arguments are labeled dependencies on their predicate.
+'''
+import re
+
+import numpy as np
+import util
+
+
+EMPTY_LABELS = ('_', '-')
+
+_LEMMA_SENSE_RE = re.compile(r'^([^.]+)\.([^.]+)$')
+_NUMBER_RE = re.compile(r'^[0-9]+$')
+
+
+class SRLEval09FormatError(ValueError):
+  '''
+  Raised wherever eval09.pl would die on malformed input
+  '''
+  pass
+
+
+def split_lemma_sense(lemma_sense):
+  match = _LEMMA_SENSE_RE.match(lemma_sense)
+  lemma, sense = match.groups() if match else (lemma_sense, lemma_sense)
+  if not sense:
+    raise SRLEval09FormatError("Invalid predicate lemma: [%s]" % lemma_sense)
+  return lemma, sense
+
+
+def same_sense(gold_sense, sys_sense):
+  if _NUMBER_RE.match(gold_sense) and _NUMBER_RE.match(sys_sense):
+    return int(gold_sense) == int(sys_sense)
+  return gold_sense == sys_sense
+
+
+'''
+Returns the set of argument labels in one APRED cell, '|' separating multiple labels
+'''
+def split_label(label):
+  if label in EMPTY_LABELS:
+    return frozenset()
+  labels = label.split('|')
+  while labels and not labels[-1]:
+    labels.pop()
+  if not all(labels):
+    raise SRLEval09FormatError("Argument labels can not be empty: [%s]" % label)
+  return frozenset(labels)
+
+
+'''
+Finds the predicates write_srl_eval_09 writes for a batch and gathers their APRED columns.
+Returns the batch and token index of each predicate and a num_predicates x batch_seq_len array of its
+argument labels, '_' past the end of the sentence or where role_labels has no column for it
+'''
+def gather_props(predicates, sent_lens, role_labels):
+  batch_seq_len = predicates.shape[-1]
+  valid_tokens = np.arange(batch_seq_len)[None, :] < np.reshape(sent_lens, [-1, 1])
+  is_predicate = predicates == 'True'
+  props = is_predicate & valid_tokens
+
+  # like write_srl_eval_09, a sentence's first role row follows all predicates of the preceding sentences
+  num_predicates_per_sent = np.sum(is_predicate, -1)
+  role_labels_start_idx = np.cumsum(num_predicates_per_sent) - num_predicates_per_sent
+  rows = role_labels_start_idx[:, None] + np.cumsum(props, -1) - 1
+
+  batch_idx, token_idx = np.nonzero(props)
+  prop_rows = rows[batch_idx, token_idx]
+  prop_labels = np.full([len(batch_idx), batch_seq_len], '_', dtype=object)
+  has_column = prop_rows < len(role_labels)
+  if np.any(has_column):
+    prop_labels[has_column] = np.reshape(role_labels, [len(role_labels), -1])[prop_rows[has_column]]
+  prop_labels[~valid_tokens[batch_idx]] = '_'
+  return batch_idx, token_idx, prop_labels
+
+
+def new_counts():
+  return {'tot_prop': 0, 'pred_prop': 0, 'coru_prop': 0, 'corl_prop': 0, 'full_corl_prop': 0,
+          'tot_arg': 0, 'pred_arg': 0, 'coru_arg': 0, 'corl_arg': 0}
+
+
+'''
+Scores one batch. words, predicates and senses are batch_size x batch_seq_len, role labels are
+num_predicates x batch_seq_len, as passed to write_srl_eval_09. Returns eval09.pl's semantic counts
+'''
+def evaluate(words, sent_lens, gold_predicates, gold_role_labels, gold_sense, pred_predicates, pred_role_labels,
+             pred_sense):
+  words = util.batch_str_decode(words)
+  gold_batch_idx, gold_token_idx, gold_labels = gather_props(util.batch_str_decode(gold_predicates), sent_lens,
+                                                             util.batch_str_decode(gold_role_labels))
+  pred_batch_idx, pred_token_idx, pred_labels = gather_props(util.batch_str_decode(pred_predicates), sent_lens,
+                                                             util.batch_str_decode(pred_role_labels))
+
+  # every distinct APRED cell is split into its set of labels once
+  cells, cell_ids = np.unique(np.concatenate([gold_labels.ravel(), pred_labels.ravel()]).astype(str),
+                              return_inverse=True)
+  cell_labels = [split_label(cell) for cell in cells]
+  cell_sizes = np.array([len(labels) for labels in cell_labels], dtype=np.int64)
+  gold_ids = np.reshape(cell_ids[:gold_labels.size], gold_labels.shape)
+  pred_ids = np.reshape(cell_ids[gold_labels.size:], pred_labels.shape)
+
+  counts = new_counts()
+  counts['tot_prop'] = len(gold_batch_idx)
+  counts['pred_prop'] = len(pred_batch_idx)
+  counts['tot_arg'] = int(np.sum(cell_sizes[gold_ids]))
+  counts['pred_arg'] = int(np.sum(cell_sizes[pred_ids]))
+
+  # gold and predicted predicates at the same token
+  batch_seq_len = gold_labels.shape[-1]
+  _, gold_matched, pred_matched = np.intersect1d(gold_batch_idx * batch_seq_len + gold_token_idx,
+                                                 pred_batch_idx * batch_seq_len + pred_token_idx,
+                                                 return_indices=True)
+  if not len(gold_matched):
+    return counts
+
+  matched_gold_ids = gold_ids[gold_matched]
+  matched_pred_ids = pred_ids[pred_matched]
+  counts['coru_arg'] = int(np.sum(np.minimum(cell_sizes[matched_gold_ids], cell_sizes[matched_pred_ids])))
+
+  cell_pairs, pair_ids = np.unique(matched_gold_ids * len(cells) + matched_pred_ids, return_inverse=True)
+  pair_correct = np.array([len(cell_labels[pair // len(cells)] & cell_labels[pair % len(cells)])
+                           for pair in cell_pairs], dtype=np.int64)
+  pair_equal = np.array([cell_labels[pair // len(cells)] == cell_labels[pair % len(cells)]
+                         for pair in cell_pairs])
+  pair_ids = np.reshape(pair_ids, matched_gold_ids.shape)
+  counts['corl_arg'] = int(np.sum(pair_correct[pair_ids]))
+  same_args = np.all(pair_equal[pair_ids], -1)
+
+  gold_senses = util.batch_str_decode(gold_sense)
+  pred_senses = util.batch_str_decode(pred_sense)
+  for gold_i, pred_i, args_equal in zip(gold_matched, pred_matched, same_args):
+    batch_i, token_i = gold_batch_idx[gold_i], gold_token_idx[gold_i]
+    word = words[batch_i][token_i]
+    _, gold_prop_sense = split_lemma_sense("%s:%s" % (word, str(gold_senses[batch_i][token_i])))
+    _, pred_prop_sense = split_lemma_sense("%s:%s" % (word, str(pred_senses[batch_i][token_i])))
+    counts['coru_prop'] += 1
+    if same_sense(gold_prop_sense, pred_prop_sense):
+      counts['corl_prop'] += 1
+      counts['full_corl_prop'] += int(args_equal)
+  return counts
+
+
+def merge_counts(counts, batch_counts):
+  for name, count in batch_counts.items():
+    counts[name] += count
+  return counts
+
+
+def _prf(correct, predicted, total):
+  precision = correct / predicted if predicted else 0.
+  recall = correct / total if total else 0.
+  f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.
+  return precision, recall, f1
+
+
+'''
+Computes the SEMANTIC SCORES of eval09.pl from accumulated counts, as fractions rather than percentages
+'''
+def semantic_scores(counts):
+  scores = {}
+  predicted = counts['pred_arg'] + counts['pred_prop']
+  total = counts['tot_arg'] + counts['tot_prop']
+  scores['labeled_precision'], scores['labeled_recall'], scores['labeled_f1'] = \
+    _prf(counts['corl_arg'] + counts['corl_prop'], predicted, total)
+  scores['unlabeled_precision'], scores['unlabeled_recall'], scores['unlabeled_f1'] = \
+    _prf(counts['coru_arg'] + counts['coru_prop'], predicted, total)
+  scores['proposition_precision'], scores['proposition_recall'], scores['proposition_f1'] = \
+    _prf(counts['full_corl_prop'], counts['pred_prop'], counts['tot_prop'])
+  scores['sense_accuracy'] = counts['corl_prop'] / counts['coru_prop'] if counts['coru_prop'] else 0.
+  return scores
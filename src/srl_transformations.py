@@ -0,0 +1,294 @@
+'''
+In-memory port of bin/make_srl_transformation.py, the error analysis of --eval_with_transformation.
+
+Each proposition's arguments are a list of Argument spans, and the transformations fix one kind of error
+in the predicted arguments of a proposition given its gold arguments, in place. As in the script, they are
+applied cumulatively in the order given, and after each one the gold and transformed predicted arguments
+are written back as Start-End tags and scored with srl_eval. Unlike the script, which reads every span one
+token too long and fails on arguments that end a sentence, spans include their end token.
+'''
+import atexit
+import functools
+import multiprocessing
+import threading
+from collections import Counter, OrderedDict
+
+import srl_eval
+
+
+class Argument:
+  def __init__(self, tag, start_idx, end_idx):
+    self.tag = tag
+    self.start_idx = start_idx
+    self.end_idx = end_idx
+    self.is_gold = False
+
+  def __str__(self):
+    return "({}: {} - {})".format(self.tag, self.start_idx, self.end_idx)
+
+  def __repr__(self):
+    return self.__str__()
+
+  def _check_equality_boundary(self, rarg):
+    return self.start_idx == rarg.start_idx and self.end_idx == rarg.end_idx
+
+  def _check_equality(self, rarg):
+    return self.start_idx == rarg.start_idx and self.end_idx == rarg.end_idx and self.tag == rarg.tag
+
+  def _check_overlap(self, rarg):
+    return not (self.end_idx < rarg.start_idx or self.start_idx > rarg.end_idx)
+
+
+'''
+Arguments of one column from its (position, open types, close types) brackets, in the order the script
+lists them: as they close. Unclosed phrases and unmatched closes are skipped
+'''
+def load_arguments(brackets):
+  started = []
+  args = []
+  for wid, open_types, close_types in brackets:
+    for open_type in open_types:
+      started.append((open_type, wid))
+    for _ in close_types:
+      if started:
+        tag, start_idx = started.pop()
+        args.append(Argument(tag, start_idx, wid))
+  return args
+
+
+'''
+The propositions of a sentence as the script keys them, by predicate word and predicate index, from its
+target column (the verb or '-' for each token) and the brackets of one column per predicate
+'''
+def load_props(targets, columns):
+  props = OrderedDict()
+  columns = list(columns)
+  for pred_idx, pred in enumerate(target for target in targets if target != '-'):
+    props["{}_{}".format(pred, pred_idx)] = load_arguments(columns[pred_idx]) if pred_idx < len(columns) else []
+  return props
+
+
+def arguments2str_conversion(args, sent_len):
+  converted_str = ['*' for _ in range(sent_len)]
+  for arg in args:
+    if arg.start_idx == arg.end_idx:
+      converted_str[arg.start_idx] = "({}*)".format(arg.tag)
+    else:
+      converted_str[arg.start_idx] = "({}*".format(arg.tag)
+      converted_str[arg.end_idx] = "*)"
+  return converted_str
+
+
+def back_conversion(targets, props):
+  return targets, [arguments2str_conversion(args, len(targets)) for args in props.values()]
+
+
+def fix_labels(pred_args, gold_args):
+  for parg in pred_args:
+    for garg in gold_args:
+      if parg._check_equality_boundary(garg):
+        parg.tag = garg.tag
+  return pred_args
+
+
+core_args_tag = set(['A{}'.format(idx) for idx in range(6)])
+
+
+def move_arg(pred_args, gold_args):
+  # get unique arguments
+  def get_unique_core_arguments_as_gold(args, gold_args):
+    args_tag = map(lambda x: x.tag, args)
+    tag_args_map = {arg.tag: arg for arg in args}
+    gold_tags = [arg.tag for arg in gold_args]
+    unique_args = []
+    others = []
+    args_count = Counter(args_tag)
+    for arg_tag, count in args_count.items():
+      if count == 1 and arg_tag in core_args_tag and arg_tag in gold_tags:
+        unique_args.append(tag_args_map[arg_tag])
+      else:
+        others.append(tag_args_map[arg_tag])
+    return unique_args, others
+
+  uniqc_gold_args, _ = get_unique_core_arguments_as_gold(gold_args, gold_args)
+  uniqc_gold_args_not_overlapping = [garg for garg in uniqc_gold_args
+                                     if not any([garg._check_overlap(parg) for parg in pred_args])]
+  uniqc_pred_args, p_others = get_unique_core_arguments_as_gold(pred_args, uniqc_gold_args_not_overlapping)
+  tag_uniqc_gold_arg_map = {arg.tag: arg for arg in uniqc_gold_args}
+  removing_buffer = []
+  # args overlapping some gold arg are moved first
+  for overlapping in [True, False]:
+    for arg in uniqc_pred_args:
+      if any([arg._check_overlap(garg) for garg in gold_args]) == overlapping:
+        arg.start_idx = tag_uniqc_gold_arg_map[arg.tag].start_idx
+        arg.end_idx = tag_uniqc_gold_arg_map[arg.tag].end_idx
+        for other_arg in pred_args:
+          if not arg == other_arg and arg._check_overlap(other_arg):
+            if other_arg not in removing_buffer:
+              removing_buffer.append(other_arg)
+
+  for item in removing_buffer:
+    pred_args.remove(item)
+  return pred_args
+
+
+def merge_spans(pred_args, gold_args):
+  p_end_idx_arg_map = {arg.end_idx: arg for arg in pred_args}
+  p_start_idx_arg_map = {arg.start_idx: arg for arg in pred_args}
+  remove_buffer = []
+  for eidx, arg in p_end_idx_arg_map.items():
+    for gap in range(1, 3):
+      if eidx + gap in p_start_idx_arg_map.keys():
+        pls = p_start_idx_arg_map[eidx + gap]
+        if pls not in remove_buffer:
+          for garg in gold_args:
+            if arg.start_idx == garg.start_idx and pls.end_idx == garg.end_idx:
+              pred_args.append(Argument(garg.tag, garg.start_idx, garg.end_idx))
+              if arg not in remove_buffer:
+                remove_buffer.append(arg)
+              if pls not in remove_buffer:
+                remove_buffer.append(pls)
+  for item in remove_buffer:
+    pred_args.remove(item)
+  return pred_args
+
+
+def split_spans(pred_args, gold_args):
+  g_end_idx_arg_map = {arg.end_idx: arg for arg in gold_args}
+  g_start_idx_arg_map = {arg.start_idx: arg for arg in gold_args}
+  for eidx, arg in g_end_idx_arg_map.items():
+    for gap in range(1, 3):
+      if eidx + gap in g_start_idx_arg_map.keys():
+        gls = g_start_idx_arg_map[eidx + gap]
+        for parg in pred_args:
+          if arg.start_idx == parg.start_idx and gls.end_idx == parg.end_idx:
+            pred_args.append(Argument(arg.tag, arg.start_idx, arg.end_idx))
+            pred_args.append(Argument(gls.tag, gls.start_idx, gls.end_idx))
+            pred_args.remove(parg)
+  return pred_args
+
+
+def fix_boundary(pred_args, gold_args):
+  for parg in pred_args:
+    if parg not in pred_args:
+      continue
+    for garg in gold_args:
+      if parg.tag == garg.tag and parg._check_overlap(garg):
+        parg.start_idx = garg.start_idx
+        parg.end_idx = garg.end_idx
+        removing_buffer = []
+        for other_arg in pred_args:
+          if other_arg != parg and parg._check_overlap(other_arg):
+            removing_buffer.append(other_arg)
+        for item in removing_buffer:
+          pred_args.remove(item)
+        break
+  return pred_args
+
+
+def drop_arg(pred_args, gold_args):
+  drop_ind = [parg for parg in pred_args if not any([parg._check_overlap(garg) for garg in gold_args])]
+  for parg in drop_ind:
+    pred_args.remove(parg)
+  return pred_args
+
+
+def drop_overlapping_arg(pred_args, gold_args):
+  drop_ind = [parg for parg in pred_args
+              if any([parg._check_overlap(garg) and not parg._check_equality(garg) for garg in gold_args])]
+  for parg in drop_ind:
+    pred_args.remove(parg)
+  return pred_args
+
+
+def add_arg(pred_args, gold_args):
+  add_ind = [garg for garg in gold_args if not any([garg._check_overlap(parg) for parg in pred_args])]
+  for garg in add_ind:
+    pred_args.append(garg)
+  return pred_args
+
+
+transformations = OrderedDict({
+  'fix_labels': fix_labels,
+  'move_arg': move_arg,
+  'merge_spans': merge_spans,
+  'split_spans': split_spans,
+  'fix_boundary': fix_boundary,
+  'drop_overlapping_arg': drop_overlapping_arg,
+  'drop_arg': drop_arg,
+  'add_arg': add_arg
+})
+
+
+'''
+Applies the named transformations in order to sentences of (gold targets, gold props, pred targets,
+pred props), modifying the pred props, and scores the sentences after each one with srl_eval.
+Returns the (correct, excess, missed) counts after each transformation, None where srl-eval.pl would fail
+'''
+def transform_and_score(transformation_names, sentences):
+  gold_sentences = [back_conversion(gold_targets, gold_props) for gold_targets, gold_props, _, _ in sentences]
+  counts = OrderedDict()
+  for t_name in transformation_names:
+    t_func = transformations[t_name]
+    for _, gold_props, _, pred_props in sentences:
+      for pred, args in pred_props.items():
+        if pred in gold_props:
+          t_func(args, gold_props[pred])
+    pred_sentences = [back_conversion(pred_targets, pred_props) for _, _, pred_targets, pred_props in sentences]
+    try:
+      counts[t_name] = srl_eval.evaluate(gold_sentences, pred_sentences)
+    except srl_eval.SRLEvalFormatError:
+      counts[t_name] = None
+  return counts
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+'''
+Starts the pool of num_workers processes that evaluate uses for that many workers. The workers are forked
+from the calling process, which is only safe before it starts other threads (a tf.Session's thread pools,
+the eval pipeline's stages), so callers start the pool up front rather than on first use
+'''
+def start_pool(num_workers):
+  with _pools_lock:
+    if num_workers not in _pools:
+      _pools[num_workers] = multiprocessing.get_context('fork').Pool(num_workers)
+    return _pools[num_workers]
+
+
+def close_pools():
+  with _pools_lock:
+    pools = list(_pools.values())
+    _pools.clear()
+  for pool in pools:
+    pool.terminate()
+
+
+atexit.register(close_pools)
+
+
+'''
+transform_and_score over sentences split across the num_workers processes of the pool start_pool started,
+or in this process if there is none. Transformations only look at one proposition at a time and srl_eval
+counts add up over sentences, so the counts are those of transforming and scoring all sentences at once;
+a stage that would fail on any sentence fails (None) as a whole
+'''
+def evaluate(sentences, transformation_names, num_workers=1):
+  sentences = list(sentences)
+  num_chunks = max(1, min(num_workers, len(sentences)))
+  chunk_size = -(-len(sentences) // num_chunks)
+  chunks = [sentences[i:i + chunk_size] for i in range(0, len(sentences), chunk_size)]
+  # the pool is used under the lock, so that close_pools doesn't terminate it in the middle of a map
+  with _pools_lock:
+    pool = _pools.get(num_workers) if num_chunks > 1 else None
+    if pool is not None:
+      chunk_counts = pool.map(functools.partial(transform_and_score, transformation_names), chunks)
+  if pool is None:
+    return transform_and_score(transformation_names, sentences)
+  counts = OrderedDict()
+  for t_name in transformation_names:
+    stage_counts = [c[t_name] for c in chunk_counts]
+    counts[t_name] = None if None in stage_counts else tuple(map(sum, zip(*stage_counts)))
+  return counts
@@ -0,0 +1,149 @@
+import os
+import random
+import shutil
+import tempfile
+from collections import OrderedDict
+
+import tensorflow as tf
+import numpy as np
+import data_converters
+import data_generator
+import vocab
+
+
+class DataConvertersTests(tf.test.TestCase):
+
+  # converter name, conll_idx and params
+  converters = [('lowercase', 3, {}),
+                ('parse_roots_self_loop', [7, 2], {}),
+                ('parse_roots_unmodified', [7, 2], {}),
+                ('parse_roots_with_root_token', [7, 2], {}),
+                ('strip_conll12_domain', 14, {}),
+                ('conll12_binary_predicates', 14, {}),
+                ('conll09_binary_predicates', 12, {}),
+                ('conll09_predicate_sense', 12, {}),
+                ('conll09_spa_predicate_sense', 15, {}),
+                ('conll09_cat_predicate_sense', 13, {}),
+                ('conll09_chn_predicate_sense', 12, {}),
+                ('conll09_cze_predicate_sense', 12, {}),
+                ('joint_converter', [5, 12],
+                 {'component_converters': ['default_converter', 'conll09_binary_predicates']}),
+                ('idx_range_converter', [20, -1], {}),
+                ('idx_list_converter', [3, 5], {}),
+                ('default_converter', 3, {})]
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.rng = random.Random(1)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def random_sentence(self, num_tokens, num_predicates):
+    rows = []
+    for t in range(1, num_tokens + 1):
+      row = [self.rng.choice(['a', 'B', 'Cc', 'dD', 'é']) for _ in range(20 + num_predicates)]
+      row[2] = str(t)
+      row[7] = str(self.rng.randint(0, num_tokens))
+      row[12] = self.rng.choice(['_', 'run.01', 'go.02', 'x.XX', 'w.01'])
+      row[13] = self.rng.choice(['_', 'a.b.c12', 'q.d3'])
+      row[14] = self.rng.choice(['-', 'A/B', 'c'])
+      row[15] = self.rng.choice(['_', 'x.a1', 'y.c9'])
+      for k in range(20, 20 + num_predicates):
+        row[k] = self.rng.choice(['O', 'B-A0', 'I-A1'])
+      rows.append(row)
+    return rows
+
+  def data_config(self, name, idx, params):
+    return {'conll_idx': idx, 'converter': {'name': name, 'params': params}}
+
+  def convert_tokens(self, datum_config, split_lines):
+    name = datum_config['converter']['name']
+    return [[str(value) for value in data_converters.dispatch(name)(
+      **data_converters.get_params(datum_config, split_line, datum_config['conll_idx']))]
+            for split_line in split_lines]
+
+  def test_convert_columns(self):
+    for name, idx, params in self.converters:
+      datum_config = self.data_config(name, idx, params)
+      for _ in range(20):
+        sentence = self.random_sentence(self.rng.randint(1, 9), self.rng.randint(0, 3))
+        if name == 'conll09_predicate_sense':
+          # the per-token converter only takes numeric senses
+          for row in sentence:
+            row[12] = 'x.01' if row[12] == 'x.XX' else row[12]
+        self.assertEqual(data_converters.convert_columns(datum_config, np.array(sentence)).tolist(),
+                         self.convert_tokens(datum_config, sentence), name)
+
+  def test_convert_sentence(self):
+    data_config = OrderedDict([('word', self.data_config('lowercase', 3, {})),
+                               ('parse_head', self.data_config('parse_roots_self_loop', [7, 2], {})),
+                               ('predicate', self.data_config('conll09_binary_predicates', 12, {})),
+                               ('srl', self.data_config('idx_range_converter', [20, -1], {}))])
+    for _ in range(20):
+      sentence = self.random_sentence(self.rng.randint(1, 9), 2)
+      expected = [sum(tokens, []) for tokens in zip(*[self.convert_tokens(data_config[d], sentence)
+                                                      for d in data_config])]
+      self.assertEqual(data_converters.convert_sentence(sentence, data_config, list(data_config)).tolist(),
+                       expected)
+
+  def test_count_vocab_values(self):
+    filename = os.path.join(self.tmp_dir, 'train.txt')
+    with open(filename, 'w') as f:
+      for _ in range(30):
+        for row in self.random_sentence(self.rng.randint(1, 9), self.rng.randint(0, 3)):
+          print(' '.join(row), file=f)
+        print(file=f)
+    data_config = OrderedDict([('word', dict(self.data_config('lowercase', 3, {}), vocab='word')),
+                               ('srl', dict(self.data_config('idx_range_converter', [20, -1], {}), vocab='srl'))])
+    expected = {}
+    for d, datum_config in data_config.items():
+      expected[d] = OrderedDict({})
+      with open(filename) as f:
+        for split_line in (line.split() for line in f if line.strip()):
+          for value in self.convert_tokens(datum_config, [split_line])[0]:
+            expected[d][value] = expected[d].get(value, 0) + 1
+
+    block_lines = vocab.VOCAB_COUNT_BLOCK_LINES
+    try:
+      # blocks smaller than a sentence, so that values recur across blocks
+      vocab.VOCAB_COUNT_BLOCK_LINES = 4
+      counts = vocab.count_vocab_values(filename, data_config, list(data_config))
+    finally:
+      vocab.VOCAB_COUNT_BLOCK_LINES = block_lines
+    for d in data_config:
+      self.assertEqual(list(counts[d].items()), list(expected[d].items()))
+
+  def test_sharded_generator(self):
+    filename = os.path.join(self.tmp_dir, 'train.txt')
+    with open(filename, 'w') as f:
+      for _ in range(23):
+        for row in self.random_sentence(self.rng.randint(1, 9), 1):
+          print(' '.join(row), file=f)
+        print(file=f)
+    data_config = OrderedDict([('word', dict(self.data_config('default_converter', 3, {}), feature=True))])
+    sentences = [s.tolist() for s in data_generator.conll_data_generator([filename], data_config)]
+    self.assertEqual(len(sentences), 23)
+    for num_shards in [1, 2, 5, 40]:
+      sharded = [s.tolist() for i in range(num_shards)
+                 for s in data_generator.conll_data_generator([filename], data_config, i, num_shards)]
+      self.assertEqual(sharded, sentences)
+
+  def test_cache_prefix(self):
+    cache_dir = os.path.join(self.tmp_dir, 'dataset-key')
+    writer_prefix = data_generator.get_cache_prefix(cache_dir)
+    other_prefix = data_generator.get_cache_prefix(cache_dir)
+    # concurrent writers cache under prefixes of their own
+    self.assertNotEqual(os.path.dirname(writer_prefix), os.path.dirname(other_prefix))
+    open(other_prefix + '.lockfile', 'w').close()
+
+    for suffix in ['.data-00000-of-00001', '.index']:
+      open(writer_prefix + suffix, 'w').close()
+    reader_prefix = data_generator.get_cache_prefix(cache_dir)
+    self.assertEqual(reader_prefix, os.path.join(cache_dir, data_generator.CACHE_PREFIX))
+    self.assertTrue(os.path.exists(reader_prefix + '.data-00000-of-00001'))
+    self.assertEqual(data_generator.get_cache_prefix(cache_dir), reader_prefix)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import tempfile
+
+import tensorflow as tf
+import numpy as np
+from tensorflow.contrib import predictor
+from tensorflow.python.framework import tensor_util
+import export_inference
+
+
+class ExportInferenceTests(tf.test.TestCase):
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def save_model(self, build_fn):
+    '''
+    Exports the graph build_fn builds from an int32 [batch, length] input, with its variables initialized, as a
+    SavedModel, and loads it as a predictor
+    '''
+    export_dir = os.path.join(self.tmp_dir, 'original')
+    graph = tf.Graph()
+    with graph.as_default():
+      inputs = tf.placeholder(tf.int32, [None, None], name='input')
+      outputs = build_fn(inputs)
+      signature = tf.saved_model.signature_def_utils.predict_signature_def(inputs={'input': inputs},
+                                                                           outputs=outputs)
+      with tf.Session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+        builder.add_meta_graph_and_variables(sess, [tf.saved_model.tag_constants.SERVING], signature_def_map={
+          tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature})
+        builder.save()
+    return predictor.from_saved_model(export_dir)
+
+  def test_optimize_graph(self):
+    def build_fn(inputs):
+      # a step past the schedule, as the checkpoint of a trained model has
+      global_step = tf.get_variable('global_step', [], tf.int64, initializer=tf.constant_initializer(1000),
+                                    trainable=False)
+      embeddings = tf.get_variable('embeddings', [10, 8], initializer=tf.random_normal_initializer(seed=1))
+      kernel = tf.get_variable('kernel', [8, 3], initializer=tf.random_normal_initializer(seed=2))
+      embedded = tf.nn.embedding_lookup(embeddings, inputs)
+      embedded = tf.Print(embedded, [tf.shape(embedded)], 'embedded')
+      check = tf.Assert(tf.reduce_all(inputs >= 0), [inputs])
+      with tf.control_dependencies([check]):
+        scores = tf.tensordot(embedded, kernel, 1)
+      # a branch on the training step, as the scheduled sampling and dropout schedules take
+      scores = tf.cond(global_step > 100, lambda: scores * 2., lambda: tf.nn.relu(scores))
+      return {'scores': scores, 'predictions': tf.argmax(scores, -1), 'loss': tf.reduce_sum(scores)}
+
+    predict_fn = self.save_model(build_fn)
+    graph_def, input_name, output_names, ops_before, ops_after = export_inference.optimize_graph(predict_fn)
+    self.assertEqual(sorted(output_names), ['predictions', 'scores'])
+    for op in ['Print', 'PrintV2', 'Assert', 'Switch', 'Merge', 'VariableV2']:
+      self.assertNotIn(op, ops_after)
+    self.assertIn('Print', ops_before)
+    self.assertLess(sum(ops_after.values()), sum(ops_before.values()))
+
+    optimized_predict_fn = export_inference.graph_predict_fn(graph_def, input_name, output_names)
+    rng = np.random.RandomState(1)
+    for batch_size, length in [(1, 1), (3, 5), (7, 2)]:
+      input_np = rng.randint(0, 10, [batch_size, length]).astype(np.int32)
+      original = predict_fn({'input': input_np})
+      optimized = optimized_predict_fn({'input': input_np})
+      self.assertAllClose(optimized['scores'], original['scores'])
+      self.assertAllEqual(optimized['predictions'], original['predictions'])
+
+    # the optimized model saves and loads as any other
+    export_dir = os.path.join(self.tmp_dir, 'optimized')
+    export_inference.save_optimized_model(graph_def, input_name, output_names, export_dir)
+    saved = predictor.from_saved_model(export_dir)({'input': input_np})
+    self.assertAllClose(saved['scores'], original['scores'])
+
+  def test_quantize_int8(self):
+    rng = np.random.RandomState(1)
+    # a bilinear classifier's [inputs1, labels, inputs2] weights, with labels of very different magnitudes
+    value = (rng.randn(6, 4, 5) * np.array([1e-3, 1., 10., 0.])[None, :, None]).astype(np.float32)
+    quantized, scales = export_inference.quantize_int8(value, 1)
+    self.assertEqual(quantized.dtype, np.int8)
+    self.assertEqual(scales.shape, (1, 4, 1))
+    self.assertEqual(np.max(np.abs(quantized), axis=(0, 2)).tolist(), [127, 127, 127, 0])
+    # each label is quantized to within half a step of its own scale
+    dequantized = quantized * scales
+    self.assertTrue(np.all(np.abs(dequantized - value) <= scales / 2 + 1e-7))
+    self.assertAllClose(dequantized[:, 3], value[:, 3])
+    self.assertLess(export_inference.int8_error(value, 1), 0.01)
+    # a scale per row of an embedding table
+    table = rng.randn(10, 8).astype(np.float32) * rng.rand(10, 1)
+    quantized, scales = export_inference.quantize_int8(table, 0)
+    self.assertEqual(scales.shape, (10, 1))
+    self.assertAllClose(scales[:, 0], np.max(np.abs(table), axis=1) / 127.)
+
+  def test_quantize_weights(self):
+    rng = np.random.RandomState(1)
+    graph = tf.Graph()
+    with graph.as_default():
+      inputs = tf.placeholder(tf.int32, [None, None], name='input')
+      with tf.variable_scope('word_embeddings'):
+        table = tf.get_variable('embeddings', [50, 8])
+      with tf.variable_scope('conv_hidden_relu'):
+        kernel = tf.get_variable('ff1', [1, 1, 8, 16])
+      with tf.variable_scope('srl/Bilinear'):
+        bilinear = tf.get_variable('Weights', [16, 3, 16])
+      small = tf.get_variable('small', [8, 2])
+      other = tf.get_variable('other', [16, 16])
+      hidden = tf.squeeze(tf.nn.conv2d(tf.expand_dims(tf.nn.embedding_lookup(table, inputs), 1), kernel,
+                                       [1, 1, 1, 1], 'SAME'), 1)
+      scores = tf.einsum('bip,plq,bjq->bilj', hidden, bilinear, tf.tensordot(hidden, other, 1))
+      logits = tf.tensordot(tf.nn.embedding_lookup(table, inputs), small, 1)
+      with tf.Session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(),
+                                                                 [scores.op.name, logits.op.name])
+    output_names = {'scores': scores.name, 'logits': logits.name}
+    weights = {node.name: tensor_util.MakeNdarray(node.attr['value'].tensor) for node in graph_def.node if node.op == 'Const'}
+
+    # selected by layer rather than size, and the table by row, although it is gathered through its /read
+    self.assertEqual(export_inference.quantizable_weights(graph_def, 64),
+                     {'word_embeddings/embeddings': 0, 'conv_hidden_relu/ff1': 3, 'srl/Bilinear/Weights': 1})
+    self.assertEqual(export_inference.quantizable_weights(graph_def, 500), {'srl/Bilinear/Weights': 1})
+
+    int8_weights = {'word_embeddings/embeddings': 0, 'srl/Bilinear/Weights': 1}
+    quantized = export_inference.quantize_weights(graph_def, int8_weights, {'conv_hidden_relu/ff1'})
+    self.assertEqual(len(quantized.node), len(graph_def.node) + 3 * 2 + 1)
+    self.assertLess(export_inference.const_bytes(quantized), export_inference.const_bytes(graph_def))
+
+    # the quantized graph computes what the original does with the weights rounded
+    expected = {}
+    for name, axis in int8_weights.items():
+      value, scales = export_inference.quantize_int8(weights[name], axis)
+      expected[name] = value * scales
+    expected['conv_hidden_relu/ff1'] = weights['conv_hidden_relu/ff1'].astype(np.float16).astype(np.float32)
+    rounded_graph_def = tf.GraphDef()
+    rounded_graph_def.CopyFrom(graph_def)
+    for node in rounded_graph_def.node:
+      if node.name in expected:
+        node.attr['value'].tensor.CopyFrom(tf.make_tensor_proto(expected[node.name]))
+
+    input_np = rng.randint(0, 50, [3, 4]).astype(np.int32)
+    quantized_outputs = export_inference.graph_predict_fn(quantized, inputs.name, output_names)({'input': input_np})
+    rounded_outputs = export_inference.graph_predict_fn(rounded_graph_def, inputs.name,
+                                                        output_names)({'input': input_np})
+    original_outputs = export_inference.graph_predict_fn(graph_def, inputs.name, output_names)({'input': input_np})
+    for k in output_names:
+      self.assertAllClose(quantized_outputs[k], rounded_outputs[k], rtol=1e-5, atol=1e-5)
+      self.assertAllClose(quantized_outputs[k], original_outputs[k], rtol=0.1, atol=0.1)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -0,0 +1,202 @@
+import io
+import os
+import random
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
+
+import tensorflow as tf
+import numpy as np
+import constants
+import data_generator
+import evaluation_fns_np
+import inference
+import predict
+from vocab import Vocab
+
+
+class FakeModel(object):
+  '''
+  Predicts each sentence as a line per word after a random delay, recording the sentences of each batch
+  '''
+  def __init__(self, rng):
+    self.rng = rng
+    self.batches = []
+
+  def text_sentence(self, tokens):
+    return [['_', '_', str(i), token] for i, token in enumerate(tokens)]
+
+  def prepare_sentence(self, split_lines):
+    if split_lines[0][-1] == 'bad':
+      raise ValueError('bad sentence')
+    return np.zeros([len(split_lines), 1], dtype=np.int32)
+
+  def predict(self, sentences):
+    time.sleep(self.rng.random() * 0.002)
+    self.batches.append([len(int_sent) for _, int_sent in sentences])
+    return [[line[-1] for line in split_lines] for split_lines, _ in sentences]
+
+
+class InferenceTests(tf.test.TestCase):
+
+  data_config = OrderedDict([('id', {'conll_idx': 2}),
+                             ('word', {'conll_idx': 3, 'feature': True, 'vocab': 'word', 'oov': True}),
+                             ('gold_pos', {'conll_idx': 5, 'label': True, 'vocab': 'gold_pos'}),
+                             ('parse_gold', {'conll_idx': [7, 2], 'label': True,
+                                             'converter': {'name': 'parse_roots_self_loop'}}),
+                             ('predicate', {'conll_idx': 10, 'label': True, 'feature': True, 'vocab': 'predicate',
+                                            'converter': {'name': 'conll09_binary_predicates'}}),
+                             ('srl', {'conll_idx': [11, -1], 'type': 'range', 'label': True, 'vocab': 'srl',
+                                      'converter': {'name': 'idx_range_converter'}})])
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+    self.rng = random.Random(1)
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def random_sentence(self, num_tokens):
+    predicates = [self.rng.choice(['_', '_', 'run.01']) for _ in range(num_tokens)]
+    # at least one predicate, so that the sentence has the srl columns that unlabeled sentences are padded with
+    predicates[self.rng.randrange(num_tokens)] = 'go.02'
+    num_predicates = sum(p != '_' for p in predicates)
+    return [['a', 'b', str(t + 1), self.rng.choice(['the', 'dog', 'ran', 'Dog']), 'x',
+             self.rng.choice(['DT', 'NN', 'VB']), 'x', str(self.rng.randint(0, num_tokens)), 'x', 'x',
+             predicates[t]] + [self.rng.choice(['_', 'A0', 'A1']) for _ in range(num_predicates)]
+            for t in range(num_tokens)]
+
+  def test_read_sentences(self):
+    lines = ['1 a\n', '2 b \n', '\n', '\n', '  \n', '1 c\n', '\n', '1 d\n', '2 e']
+    self.assertEqual(list(inference.read_sentences(lines)),
+                     [[['1', 'a'], ['2', 'b']], [['1', 'c']], [['1', 'd'], ['2', 'e']]])
+    self.assertEqual(list(inference.read_sentences(['\n', '\n'])), [])
+
+  def test_token_budget_batches(self):
+    lengths = [3, 2, 4, 12, 1, 1, 5]
+    batches = list(inference.token_budget_batches(lengths, 10, sentence_len=lambda seq_len: seq_len))
+    # order is kept, and the sentence over the budget is batched alone
+    self.assertEqual(batches, [[3, 2], [4], [12], [1, 1], [5]])
+    for batch in batches:
+      self.assertTrue(len(batch) == 1 or max(batch) * len(batch) <= 10)
+
+    batches = list(inference.token_budget_batches(lengths, 10, sentence_len=lambda seq_len: seq_len,
+                                                  max_batch_pairs=16))
+    self.assertEqual(batches, [[3], [2], [4], [12], [1, 1], [5]])
+    self.assertEqual(list(inference.token_budget_batches([], 10)), [])
+
+  def test_find_input_columns(self):
+    task_config = {'srl': {'token_take_mask': {'label': 'predicate'},
+                           'output_fn': {'params': {'predicate_targets': {'label': 'predicate'},
+                                                    'predicate_preds_train': {'label': 'predicate'},
+                                                    'pos_targets': {'label': 'gold_pos'}}},
+                           'eval_fns': {'srl_f1': {'params': {'targets': {'layer': 'srl', 'output': 'targets'},
+                                                              'words': {'feature': 'word'},
+                                                              'parse_head_targets': {'label': 'parse_gold'},
+                                                              'gold_sense': {'label': 'gold_sense'}}}}}}
+    model_config = {'inputs': {'word': 'embeddings'}}
+    self.assertEqual(inference.find_input_columns(self.data_config, model_config, task_config, {}), ['predicate'])
+
+    task_config['srl']['token_take_mask'] = {'layer': 'joint_pos_predicate', 'output': 'predicate_predictions'}
+    self.assertEqual(inference.find_input_columns(self.data_config, model_config, task_config, {}), [])
+    attention_config = {'pos_attention': {'value_fns': {'pos': {'params': {
+      'train_label_scores': {'label': 'gold_pos'},
+      'eval_label_scores': {'layer': 'joint_pos_predicate', 'output': 'gold_pos_probabilities'}}}}}}
+    self.assertEqual(inference.find_input_columns(self.data_config, model_config, task_config, attention_config),
+                     [])
+    task_config['srl']['eval_fns']['srl_f1']['params']['parse_head_predictions'] = {'label': 'parse_gold'}
+    task_config['srl']['eval_fns']['srl_f1']['params']['pos_predictions'] = {'label': 'gold_pos'}
+    self.assertEqual(inference.find_input_columns(self.data_config, model_config, task_config, attention_config),
+                     ['gold_pos', 'parse_gold'])
+
+  def write_sentences(self, filename, num_sentences, max_len):
+    with open(filename, 'w') as f:
+      for _ in range(num_sentences):
+        for row in self.random_sentence(self.rng.randint(1, max_len)):
+          print('\t'.join(row), file=f)
+        print(file=f)
+
+  def test_prepare_sentence(self):
+    filename = os.path.join(self.tmp_dir, 'train.txt')
+    self.write_sentences(filename, 20, 8)
+    vocab = Vocab(self.data_config, self.tmp_dir, [filename])
+    shard_dir = data_generator.compile_conll_file(filename, self.data_config, vocab,
+                                                  os.path.join(self.tmp_dir, 'compiled'))
+    converter = inference.SentenceConverter(self.data_config, vocab, ['predicate'])
+    with open(filename) as f:
+      sentences = list(inference.read_sentences(f))
+    expected = list(data_generator.compiled_data_generator([shard_dir]))
+    self.assertEqual(len(sentences), len(expected))
+    for split_lines, int_sent in zip(sentences, expected):
+      self.assertEqual(converter.prepare_sentence(split_lines).tolist(), int_sent.tolist())
+
+    # lines without the predicate column can't be predicted
+    with self.assertRaises(ValueError):
+      converter.prepare_sentence([line[:10] for line in sentences[0]])
+    words_converter = inference.SentenceConverter(self.data_config, vocab)
+    text_sentence = words_converter.text_sentence(['the', 'dog'])
+    self.assertEqual([(line[2], line[3]) for line in text_sentence], [('0', 'the'), ('1', 'dog')])
+    self.assertEqual(words_converter.prepare_sentence(text_sentence).shape[0], 2)
+
+  def test_length_sorted_batches(self):
+    filename = os.path.join(self.tmp_dir, 'dev.txt')
+    self.write_sentences(filename, 40, 12)
+    vocab = Vocab(self.data_config, self.tmp_dir, [filename])
+    converter = inference.SentenceConverter(self.data_config, vocab)
+    with open(filename) as f:
+      int_sents = [converter.prepare_sentence(split_lines) for split_lines in inference.read_sentences(f)]
+
+    batches, sentence_order = inference.length_sorted_batches(int_sents, 24, max_batch_pairs=150)
+    self.assertEqual(sorted(sentence_order), list(range(len(int_sents))))
+    lengths = [len(int_sents[i]) for i in sentence_order]
+    self.assertEqual(lengths, sorted(lengths, reverse=True))
+    self.assertEqual(sum(len(batch) for batch in batches), len(int_sents))
+    for batch in batches:
+      self.assertTrue(len(batch) == 1 or batch.shape[0] * batch.shape[1] <= 24 and
+                      batch.shape[0] * batch.shape[1] ** 2 <= 150)
+
+    # written out of order through the conll09 writers, the sentences come back in file order
+    word_idx = data_generator.get_feature_label_names(self.data_config).index('word')
+
+    def batch_fields(input_np):
+      sent_lens = np.sum(input_np[:, :, word_idx] != constants.PAD_VALUE, -1)
+      words = input_np[:, :, word_idx].astype(str)
+      labels = np.full(words.shape, 'x')
+      return [words, np.full(words.shape, 'False'), sent_lens, np.zeros([0, words.shape[1]], dtype=str),
+              np.zeros(words.shape, dtype=np.int32), labels, labels, labels]
+
+    evaluation_fns_np.set_conll09_sentence_order(filename, sentence_order)
+    for input_np in batches:
+      evaluation_fns_np.write_srl_eval_09_a(os.path.join(self.tmp_dir, 'gold'), *batch_fields(input_np),
+                                            input_source=filename)
+    evaluation_fns_np.close_conll09_writers(filename)
+    expected = evaluation_fns_np.format_srl_eval_09(*batch_fields(inference.pad_batch(int_sents)))
+    with open(os.path.join(self.tmp_dir, 'gold.dev')) as f:
+      self.assertEqual(f.read(), expected)
+
+  def test_predict_stream(self):
+    sentences = [[str(i)] * self.rng.randint(1, 6) for i in range(40)]
+    for input_format in ['conll09', 'text']:
+      if input_format == 'text':
+        input_text = ''.join(' '.join(words) + '\n\n' for words in sentences)
+      else:
+        input_text = ''.join(''.join('_ %s\n' % word for word in words) + '\n' for words in sentences)
+      for queue_size in [0, 2]:
+        model = FakeModel(self.rng)
+        output_file = io.StringIO()
+        num_sentences = predict.predict_stream(model, io.StringIO(input_text), output_file, input_format, 8,
+                                               queue_size)
+        self.assertEqual(num_sentences, len(sentences))
+        # written in input order, from batches within the token budget
+        self.assertEqual(output_file.getvalue(), ''.join('\n'.join(words) + '\n\n' for words in sentences))
+        self.assertGreater(len(model.batches), 1)
+        for batch in model.batches:
+          self.assertTrue(len(batch) == 1 or max(batch) * len(batch) <= 8)
+
+    with self.assertRaises(ValueError):
+      predict.predict_stream(FakeModel(self.rng), io.StringIO('_ a\n\n_ bad\n\n'), io.StringIO(), 'conll09', 8, 2)
+
+
+if __name__ == '__main__':
+  tf.test.main()
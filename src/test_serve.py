@@ -0,0 +1,84 @@
+import time
+
+import tensorflow as tf
+import numpy as np
+import serve
+
+
+class FakeModel(object):
+  '''
+  Predicts each sentence as CoNLL-2009 lines of its words, recording the lengths of the batches it predicts,
+  and fails any batch with a sentence whose first word is 'bad'
+  '''
+  def __init__(self):
+    self.batches = []
+
+  def predict(self, sentences):
+    if any(split_lines[0][0] == 'bad' for split_lines, _ in sentences):
+      raise ValueError('bad sentence')
+    self.batches.append([len(int_sent) for _, int_sent in sentences])
+    return [['\t'.join([str(i + 1), line[0], '_', '_', 'NN', '_', '_', '_', '0', '_', 'ROOT', '_', '_', '_'])
+             for i, line in enumerate(split_lines)] for split_lines, _ in sentences]
+
+
+class ServeTests(tf.test.TestCase):
+
+  def sentence(self, seq_len, first_word='w'):
+    split_lines = [[first_word]] + [['w%d' % i] for i in range(1, seq_len)]
+    return split_lines, np.zeros([seq_len, 1], dtype=np.int32)
+
+  def words(self, request):
+    return [[token['word'] for token in result['tokens']] for result in request.results]
+
+  def test_token_budget(self):
+    model = FakeModel()
+    batcher = serve.DynamicBatcher(model, max_batch_tokens=10, max_latency_secs=0.2)
+    sentences = [self.sentence(seq_len) for seq_len in [4, 4, 3, 5, 2]]
+    request = batcher.submit(sentences)
+    self.assertTrue(request.done.wait(5))
+    # the sentence that would exceed the budget starts the next batch
+    self.assertEqual(model.batches, [[4, 4], [3, 5], [2]])
+    self.assertIsNone(request.error)
+    self.assertEqual(self.words(request), [[line[0] for line in split_lines] for split_lines, _ in sentences])
+
+  def test_latency_deadline(self):
+    model = FakeModel()
+    batcher = serve.DynamicBatcher(model, max_batch_tokens=100, max_latency_secs=0.05)
+    first = batcher.submit([self.sentence(2)])
+    self.assertTrue(first.done.wait(5))
+    time.sleep(0.1)
+    # sentences that arrive within the deadline share a batch, whichever request they belong to
+    second = batcher.submit([self.sentence(3)])
+    third = batcher.submit([self.sentence(4), self.sentence(1)])
+    self.assertTrue(second.done.wait(5))
+    self.assertTrue(third.done.wait(5))
+    self.assertEqual(model.batches, [[2], [3, 4, 1]])
+
+  def test_request_across_batches(self):
+    model = FakeModel()
+    batcher = serve.DynamicBatcher(model, max_batch_tokens=6, max_latency_secs=0.2)
+    first = batcher.submit([self.sentence(3), self.sentence(3), self.sentence(2)])
+    second = batcher.submit([self.sentence(1)])
+    self.assertTrue(first.done.wait(5))
+    self.assertTrue(second.done.wait(5))
+    self.assertEqual(model.batches, [[3, 3], [2, 1]])
+    self.assertEqual([len(words) for words in self.words(first)], [3, 3, 2])
+    self.assertEqual(first.remaining, 0)
+    self.assertEqual([len(words) for words in self.words(second)], [1])
+
+  def test_bad_sentence(self):
+    model = FakeModel()
+    batcher = serve.DynamicBatcher(model, max_batch_tokens=100, max_latency_secs=0.2)
+    good = batcher.submit([self.sentence(2), self.sentence(3)])
+    bad = batcher.submit([self.sentence(2), self.sentence(2, first_word='bad')])
+    self.assertTrue(good.done.wait(5))
+    self.assertTrue(bad.done.wait(5))
+    # the shared batch fails, and its sentences are retried one at a time
+    self.assertEqual(model.batches, [[2], [3], [2]])
+    self.assertIsNone(good.error)
+    self.assertEqual([len(words) for words in self.words(good)], [2, 3])
+    self.assertIsInstance(bad.error, ValueError)
+
+
+if __name__ == '__main__':
+  tf.test.main()
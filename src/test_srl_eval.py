@@ -0,0 +1,256 @@
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import tensorflow as tf
+import numpy as np
+import evaluation_fns_np
+import srl_eval
+import srl_transformations
+
+
+SRL_EVAL_PL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'srl-eval.pl')
+MAKE_SRL_TRANSFORMATION = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin',
+                                       'make_srl_transformation.py')
+
+
+class SRLEvalTests(tf.test.TestCase):
+
+  # each sentence: list of token rows, first column the target verb or '-'
+  gold_sentences = [
+    [['-', '(A0*', '*'],
+     ['-', '*)', '*'],
+     ['sold', '(V*)', '*'],
+     ['-', '(A1*', '(A0*'],
+     ['-', '*)', '*)'],
+     ['bought', '*', '(V*)'],
+     ['-', '(C-A1*)', '(AM-TMP*)']],
+    [['-', '(A0(A1*)', '*'],
+     ['-', '*)', '(A1*'],
+     ['said', '(V*)', '*)'],
+     ['claim', '(A2*)', '(V*)']],
+  ]
+
+  pred_sentences = [
+    [['-', '(A0*', '*'],
+     ['-', '*)', '*'],
+     ['sold', '(V*)', '*'],
+     ['-', '(A1*', '(A1*'],
+     ['-', '*)', '*)'],
+     ['bought', '*', '(V*)'],
+     ['-', '(C-A1*)', '*']],
+    [['-', '(A0*)', '*'],
+     ['-', '*', '*'],
+     ['said', '(V*)', '*'],
+     ['-', '(A2*)', '*']],
+  ]
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def write_props(self, name, sentences):
+    filename = os.path.join(self.tmp_dir, name)
+    with open(filename, 'w') as f:
+      for sentence in sentences:
+        for row in sentence:
+          print('\t'.join(row), file=f)
+        print(file=f)
+    return filename
+
+  def run_perl(self, gold_filename, pred_filename):
+    if not shutil.which('perl'):
+      self.skipTest("perl is not available")
+    try:
+      output = subprocess.check_output(["perl", SRL_EVAL_PL, gold_filename, pred_filename],
+                                       stderr=subprocess.DEVNULL).decode('utf-8')
+    except subprocess.CalledProcessError:
+      return None
+    return tuple(map(int, output.split('\n')[6].split()[1:4]))
+
+  def test_load_args(self):
+    args = srl_eval.load_args(['(A1*', '*)', '(V*)', '(C-A1*', '*)'])
+    self.assertEqual([(a.type, a.start, a.end, a.single()) for a in args],
+                     [('A1', 0, 4, False), ('V', 2, 2, True)])
+    self.assertEqual([(p.type, p.start, p.end) for p in args[0].phrases], [('A1', 0, 1), ('C-A1', 3, 4)])
+
+  def test_load_args_nested(self):
+    args = srl_eval.load_args(['(A0(A1*)', '*)', '(V*)'])
+    self.assertEqual([(a.type, a.start, a.end, a.single()) for a in args],
+                     [('A0', 0, 1, False), ('A1', 0, 0, True), ('V', 2, 2, True)])
+
+  def test_bad_format(self):
+    for tags in [['(*'], ['A0'], ['*)'], ['(A0*'], ['(A0*', '*A1)'], ['*x']]:
+      with self.assertRaises(srl_eval.SRLEvalFormatError):
+        srl_eval.load_args(tags)
+
+  def test_evaluate_files(self):
+    gold_filename = self.write_props('gold', self.gold_sentences)
+    pred_filename = self.write_props('pred', self.pred_sentences)
+    counts = srl_eval.evaluate_files(gold_filename, pred_filename)
+    self.assertEqual(counts, (3, 2, 5))
+    self.assertEqual(counts, self.run_perl(gold_filename, pred_filename))
+
+  def test_evaluate_misaligned(self):
+    gold_filename = self.write_props('gold', self.gold_sentences)
+    pred_filename = self.write_props('pred', self.pred_sentences[:1] + [self.pred_sentences[1][:3]])
+    with self.assertRaises(srl_eval.SRLEvalFormatError):
+      srl_eval.evaluate_files(gold_filename, pred_filename)
+    self.assertIsNone(self.run_perl(gold_filename, pred_filename))
+
+  def props(self, sentence):
+    targets = [row[0] for row in sentence]
+    columns = [[(wid,) + tuple(srl_eval.parse_tag(row[i], wid)) for wid, row in enumerate(sentence)]
+               for i in range(1, len(sentence[0]))]
+    return targets, srl_transformations.load_props(targets, columns)
+
+  def test_transformations(self):
+    sentences = [self.props(gold) + self.props(pred) for gold, pred in zip(self.gold_sentences, self.pred_sentences)]
+    counts = srl_transformations.evaluate(sentences, ['fix_labels', 'add_arg'])
+    self.assertEqual(counts, {'fix_labels': (4, 1, 3), 'add_arg': (5, 1, 2)})
+
+  def test_transformations_parity(self):
+    rng = random.Random(1)
+
+    def random_column(sent_len):
+      # no argument ends the sentence, since the script fails on those, and arguments are at least a token
+      # apart, so that they still do not overlap once the script reads them one token too long
+      column = ['*'] * sent_len
+      start = rng.randint(0, 1)
+      while start < sent_len - 1:
+        end = rng.randint(start, sent_len - 2)
+        tag = rng.choice(['A0', 'A1', 'A2', 'AM-TMP'])
+        if start == end:
+          column[start] = '(%s*)' % tag
+        else:
+          column[start], column[end] = '(%s*' % tag, '*)'
+        start = end + rng.randint(2, 3)
+      return column
+
+    gold_sentences, pred_sentences = [], []
+    for _ in range(40):
+      sent_len = rng.randint(2, 10)
+      targets = [rng.choice(['-', '-', 'ran', 'said']) for _ in range(sent_len)]
+      num_predicates = sum(target != '-' for target in targets)
+      for sentences in [gold_sentences, pred_sentences]:
+        columns = [random_column(sent_len) for _ in range(num_predicates)]
+        sentences.append([[target] + [column[wid] for column in columns] for wid, target in enumerate(targets)])
+    gold_filename = self.write_props('gold', gold_sentences)
+    pred_filename = self.write_props('pred', pred_sentences)
+    subprocess.check_output([sys.executable, MAKE_SRL_TRANSFORMATION, pred_filename, gold_filename])
+
+    def shifted_props(sentence):
+      # the script reads every span one token too long, and transforms and writes those spans
+      targets, props = self.props(sentence)
+      for args in props.values():
+        for arg in args:
+          arg.end_idx += 1
+      return targets, props
+
+    def load_sentences():
+      return [shifted_props(gold) + shifted_props(pred) for gold, pred in zip(gold_sentences, pred_sentences)]
+
+    sentences = load_sentences()
+    transformation_list = evaluation_fns_np.transformation_list
+    for t_name in transformation_list:
+      for _, gold_props, _, pred_props in sentences:
+        for pred, args in pred_props.items():
+          if pred in gold_props:
+            srl_transformations.transformations[t_name](args, gold_props[pred])
+      for filename, sentence_props in [(gold_filename, [s[:2] for s in sentences]),
+                                       (pred_filename, [s[2:] for s in sentences])]:
+        self.assertEqual(list(srl_eval.read_sentences('%s.t.%s' % (filename, t_name))),
+                         [srl_transformations.back_conversion(targets, props) for targets, props in sentence_props],
+                         t_name)
+
+    expected = {}
+    for t_name in transformation_list:
+      try:
+        expected[t_name] = srl_eval.evaluate_files('%s.t.%s' % (gold_filename, t_name),
+                                                   '%s.t.%s' % (pred_filename, t_name))
+      except srl_eval.SRLEvalFormatError:
+        expected[t_name] = None
+    self.assertEqual(srl_transformations.evaluate(load_sentences(), transformation_list), expected)
+    srl_transformations.start_pool(3)
+    self.assertEqual(srl_transformations.evaluate(load_sentences(), transformation_list, num_workers=3), expected)
+
+  def test_bilou_converter(self):
+    rng = random.Random(1)
+    labels = ['O', 'B-A0', 'I-A0', 'B-A1', 'I-A1', 'U-A2', 'L-A1', 'B-A0/I-A1', 'I-A0/I-A1']
+    for pop_last in [False, True]:
+      converter = evaluation_fns_np.BilouConverter(labels, pop_last)
+      convert_bilou = evaluation_fns_np.convert_bilou_true if pop_last else evaluation_fns_np.convert_bilou
+      for _ in range(50):
+        label_ids = np.array([[rng.randrange(len(labels)) for _ in range(8)] for _ in range(4)])
+        lens = np.array([rng.randint(0, 8) for _ in range(4)])
+        try:
+          expected = [convert_bilou([labels[i] for i in row[:row_len]]) for row, row_len in zip(label_ids, lens)]
+        except IndexError:
+          with self.assertRaises(ValueError):
+            converter.convert(label_ids, lens)
+          continue
+        tag_ids, closes = converter.convert(label_ids, lens)
+        for row, row_len, tags in zip(range(len(label_ids)), lens, expected):
+          self.assertEqual(list(converter.to_strings(tag_ids[row, :row_len], closes[row, :row_len])), tags)
+          try:
+            args = srl_eval.load_args(tags)
+          except srl_eval.SRLEvalFormatError:
+            with self.assertRaises(srl_eval.SRLEvalFormatError):
+              converter.load_args((tag_ids[row, :row_len], closes[row, :row_len]))
+            continue
+          self.assertEqual([(a.type, a.start, a.end) for a in args],
+                           [(a.type, a.start, a.end) for a in
+                            converter.load_args((tag_ids[row, :row_len], closes[row, :row_len]))])
+
+  def test_conll_srl_eval_parity(self):
+    rng = random.Random(1)
+    labels = ['A0', 'A1', 'A2', 'AM-TMP', 'C-A1', 'R-A0']
+
+    def random_bio(seq_len, noisy):
+      bio, current = [], None
+      for _ in range(seq_len):
+        r = rng.random()
+        if noisy and r < 0.1:
+          current = rng.choice(labels)
+          bio.append('I-' + current)
+        elif current and r < 0.5:
+          bio.append('I-' + current)
+        elif r < 0.75:
+          current = rng.choice(labels)
+          bio.append('B-' + current)
+        else:
+          current = None
+          bio.append('O')
+      return bio
+
+    for batch in range(50):
+      batch_size, seq_len = rng.randint(1, 5), rng.randint(1, 10)
+      sent_lens = np.array([rng.randint(1, seq_len) for _ in range(batch_size)])
+      mask = (np.arange(seq_len)[None, :] < sent_lens[:, None]).astype(np.int32)
+      words = np.array([[rng.choice(['a', 'b', 'c', '-']) for _ in range(seq_len)] for _ in range(batch_size)])
+      predicate_targets = np.array([[int(rng.random() < 0.3) for _ in range(seq_len)]
+                                    for _ in range(batch_size)]) * mask
+      predicate_predictions = predicate_targets if batch % 2 else \
+        np.array([[int(rng.random() < 0.3) for _ in range(seq_len)] for _ in range(batch_size)]) * mask
+      srl_targets = np.array([random_bio(seq_len, False) for _ in range(np.sum(predicate_targets))] or
+                             np.zeros([0, seq_len], dtype=str))
+      srl_predictions = np.array([random_bio(seq_len, True) for _ in range(np.sum(predicate_predictions))] or
+                                 np.zeros([0, seq_len], dtype=str))
+
+      gold_filename = os.path.join(self.tmp_dir, 'gold')
+      pred_filename = os.path.join(self.tmp_dir, 'pred')
+      evaluation_fns_np.write_srl_eval(gold_filename, words, predicate_targets, sent_lens, srl_targets)
+      evaluation_fns_np.write_srl_eval(pred_filename, words, predicate_predictions, sent_lens, srl_predictions)
+
+      counts = evaluation_fns_np.conll_srl_eval(srl_predictions, predicate_predictions, words, mask, srl_targets,
+                                                predicate_targets, pred_filename, gold_filename)
+      self.assertEqual(counts, self.run_perl(gold_filename, pred_filename) or (0, 0, 0))
+
+
+if __name__ == '__main__':
+  tf.test.main()
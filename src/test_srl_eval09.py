@@ -0,0 +1,215 @@
+import functools
+import os
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import OrderedDict
+
+import tensorflow as tf
+import numpy as np
+import evaluation_fns
+import evaluation_fns_np
+import srl_eval09
+
+
+EVAL09_PL = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin', 'eval09.pl')
+
+
+class SRLEval09Tests(tf.test.TestCase):
+
+  words = np.array([['The', 'economy', 'grew', 'and', 'prices', 'rose'],
+                    ['He', 'said', 'so', '_', '_', '_']])
+  sent_lens = np.array([6, 3])
+
+  gold_predicates = np.array([['False', 'False', 'True', 'False', 'False', 'True'],
+                              ['False', 'True', 'False', 'False', 'False', 'False']])
+  gold_role_labels = np.array([['_', 'A1', '_', '_', '_', '_'],
+                               ['_', '_', '_', '_', 'A1', '_'],
+                               ['A0', '_', 'A1|AM-MNR', '_', '_', '_']])
+  gold_sense = np.array([['_', '_', '01', '_', '_', '01'],
+                         ['_', '01', '_', '_', '_', '_']])
+
+  pred_predicates = np.array([['False', 'False', 'True', 'False', 'True', 'True'],
+                              ['False', 'True', 'False', 'False', 'False', 'False']])
+  pred_role_labels = np.array([['_', 'A1', '_', '_', '_', '_'],
+                               ['_', '_', '_', '_', '_', '_'],
+                               ['_', '_', '_', '_', 'A0', '_'],
+                               ['A0', '_', 'A1', '_', '_', '_']])
+  pred_sense = np.array([['_', '_', '01', '_', '01', '02'],
+                         ['_', '01', '_', '_', '_', '_']])
+
+  def setUp(self):
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp_dir)
+
+  def run_perl(self, words, sent_lens, gold_predicates, gold_role_labels, gold_sense, pred_predicates,
+               pred_role_labels, pred_sense):
+    if not shutil.which('perl'):
+      self.skipTest("perl is not available")
+    heads = np.zeros(words.shape, dtype=np.int32)
+    labels = np.full(words.shape, 'dep')
+    gold_filename = os.path.join(self.tmp_dir, 'gold')
+    pred_filename = os.path.join(self.tmp_dir, 'pred')
+    evaluation_fns_np.write_srl_eval_09(gold_filename, words, gold_predicates, sent_lens, gold_role_labels, heads,
+                                        labels, labels, gold_sense)
+    evaluation_fns_np.write_srl_eval_09(pred_filename, words, pred_predicates, sent_lens, pred_role_labels, heads,
+                                        labels, labels, pred_sense)
+    try:
+      output = subprocess.check_output(["perl", EVAL09_PL, "-g", gold_filename, "-s", pred_filename],
+                                       stderr=subprocess.DEVNULL).decode('utf-8')
+    except subprocess.CalledProcessError:
+      return None
+    eval_lines = output.split('\n')
+    labeled_precision, labeled_recall, unlabeled_precision, prop_precision = \
+      [list(map(int, re.sub('[^0-9 ]', '', eval_lines[i]).split())) for i in [7, 8, 10, 13]]
+    return {'corl_arg': labeled_precision[0], 'corl_prop': labeled_precision[1],
+            'pred_arg': labeled_precision[2], 'pred_prop': labeled_precision[3],
+            'tot_arg': labeled_recall[2], 'tot_prop': labeled_recall[3],
+            'coru_arg': unlabeled_precision[0], 'coru_prop': unlabeled_precision[1],
+            'full_corl_prop': prop_precision[0]}
+
+  def test_same_sense(self):
+    self.assertTrue(srl_eval09.same_sense('01', '1'))
+    self.assertFalse(srl_eval09.same_sense('01', '02'))
+    self.assertFalse(srl_eval09.same_sense('a01', 'a1'))
+    self.assertEqual(srl_eval09.split_lemma_sense('grow.01'), ('grow', '01'))
+    self.assertEqual(srl_eval09.split_lemma_sense('grew:01'), ('grew:01', 'grew:01'))
+
+  def test_split_label(self):
+    self.assertEqual(srl_eval09.split_label('_'), frozenset())
+    self.assertEqual(srl_eval09.split_label('A1|AM-MNR|A1'), frozenset(['A1', 'AM-MNR']))
+    self.assertEqual(srl_eval09.split_label('A1|'), frozenset(['A1']))
+    with self.assertRaises(srl_eval09.SRLEval09FormatError):
+      srl_eval09.split_label('|A1')
+
+  def test_evaluate(self):
+    args = [self.words, self.sent_lens, self.gold_predicates, self.gold_role_labels, self.gold_sense,
+            self.pred_predicates, self.pred_role_labels, self.pred_sense]
+    counts = srl_eval09.evaluate(*args)
+    expected = {'tot_prop': 3, 'pred_prop': 4, 'coru_prop': 3, 'corl_prop': 2, 'full_corl_prop': 1,
+                'tot_arg': 5, 'pred_arg': 4, 'coru_arg': 4, 'corl_arg': 3}
+    self.assertEqual(counts, expected)
+    self.assertEqual(counts, self.run_perl(*args))
+
+    scores = srl_eval09.semantic_scores(counts)
+    self.assertAllClose([scores['labeled_precision'], scores['labeled_recall'], scores['sense_accuracy']],
+                        [5. / 8., 5. / 8., 2. / 3.])
+
+  def test_sidecar_counts(self):
+    heads = np.zeros(self.words.shape, dtype=np.int32)
+    labels = np.full(self.words.shape, 'dep')
+    for name, predicates, role_labels, sense in [('gold', self.gold_predicates, self.gold_role_labels, self.gold_sense),
+                                                 ('pred', self.pred_predicates, self.pred_role_labels, self.pred_sense)]:
+      for _ in range(2):
+        evaluation_fns_np.write_srl_eval_09_a(os.path.join(self.tmp_dir, name), self.words, predicates, self.sent_lens,
+                                              role_labels, heads, labels, labels, sense, 'test.txt', sidecar=True)
+    evaluation_fns_np.close_conll09_writers()
+
+    counts = srl_eval09.evaluate(self.words, self.sent_lens, self.gold_predicates, self.gold_role_labels,
+                                 self.gold_sense, self.pred_predicates, self.pred_role_labels, self.pred_sense)
+    sidecar_counts = evaluation_fns_np.conll09_sidecar_counts(os.path.join(self.tmp_dir, 'gold.test.npy'),
+                                                              os.path.join(self.tmp_dir, 'pred.test.npy'))
+    self.assertEqual(sidecar_counts, srl_eval09.merge_counts(dict(counts), counts))
+
+    gold_filename = os.path.join(self.tmp_dir, 'gold_once')
+    evaluation_fns_np.write_srl_eval_09(gold_filename, self.words, self.gold_predicates, self.sent_lens,
+                                        self.gold_role_labels, heads, labels, labels, self.gold_sense)
+    with open(gold_filename) as f, open(os.path.join(self.tmp_dir, 'gold.test')) as f_a:
+      self.assertEqual(f_a.read(), f.read() * 2)
+
+  def test_sentence_order(self):
+    heads = np.zeros(self.words.shape, dtype=np.int32)
+    labels = np.full(self.words.shape, 'dep')
+    evaluation_fns_np.set_conll09_sentence_order('test.txt', [1, 0])
+    # the second sentence is written first, each sentence with its own predicates' role rows
+    for i, role_labels in [(1, self.gold_role_labels[2:]), (0, self.gold_role_labels[:2])]:
+      evaluation_fns_np.write_srl_eval_09_a(os.path.join(self.tmp_dir, 'gold'), self.words[i:i + 1],
+                                            self.gold_predicates[i:i + 1], self.sent_lens[i:i + 1], role_labels,
+                                            heads[i:i + 1], labels[i:i + 1], labels[i:i + 1],
+                                            self.gold_sense[i:i + 1], 'test.txt')
+    evaluation_fns_np.close_conll09_writers('test.txt')
+
+    gold_filename = os.path.join(self.tmp_dir, 'gold_once')
+    evaluation_fns_np.write_srl_eval_09(gold_filename, self.words, self.gold_predicates, self.sent_lens,
+                                        self.gold_role_labels, heads, labels, labels, self.gold_sense)
+    with open(gold_filename) as f, open(os.path.join(self.tmp_dir, 'gold.test')) as f_a:
+      self.assertEqual(f_a.read(), f.read())
+
+  def test_evaluate_parity(self):
+    rng = random.Random(1)
+    labels = ['A0', 'A1', 'A2', 'AM-TMP', 'A0|A1', '_', '_', '_', '-']
+    senses = ['01', '1', '02', 'x.01', '2.5']
+
+    for batch in range(50):
+      batch_size, seq_len = rng.randint(1, 5), rng.randint(1, 9)
+      sent_lens = np.array([rng.randint(1, seq_len) for _ in range(batch_size)])
+      words = np.array([[rng.choice(['a', 'b.c', '1.2']) for _ in range(seq_len)] for _ in range(batch_size)])
+
+      def random_array(values, num_rows):
+        return np.array([[rng.choice(values) for _ in range(seq_len)] for _ in range(num_rows)],
+                        dtype=str).reshape([num_rows, seq_len])
+
+      gold_predicates = random_array(['True', 'False', 'False'], batch_size)
+      pred_predicates = gold_predicates if batch % 2 else random_array(['True', 'False', 'False'], batch_size)
+      args = [words, sent_lens,
+              gold_predicates, random_array(labels, np.sum(gold_predicates == 'True')),
+              random_array(senses, batch_size),
+              pred_predicates, random_array(labels, np.sum(pred_predicates == 'True')),
+              random_array(senses, batch_size)]
+      self.assertEqual(srl_eval09.evaluate(*args), self.run_perl(*args))
+
+  def test_deferred_eval(self):
+    rng = random.Random(2)
+    reverse_maps = {'srl': OrderedDict(enumerate(['_', 'A0', 'A1', 'A0|A1', 'AM-TMP'])),
+                    'predicate': OrderedDict(enumerate(['False', 'True'])),
+                    'word': OrderedDict(enumerate(['a', 'b', 'c']))}
+    tables = evaluation_fns_np.reverse_map_tables(reverse_maps)
+
+    batches = []
+    for _ in range(30):
+      batch_size, seq_len = rng.randint(1, 4), rng.randint(1, 8)
+      mask = np.array([[int(t < rng.randint(1, seq_len)) for t in range(seq_len)] for _ in range(batch_size)])
+
+      def random_ints(num_values, num_rows):
+        return np.array([[rng.randrange(num_values) for _ in range(seq_len)] for _ in range(num_rows)],
+                        dtype=np.int32).reshape([num_rows, seq_len])
+
+      def random_senses():
+        return np.array([[rng.choice(['_', '01', '02']) for _ in range(seq_len)] for _ in range(batch_size)])
+
+      predicate_predictions, predicate_targets = random_ints(2, batch_size), random_ints(2, batch_size)
+      batches.append([random_ints(5, np.sum(predicate_predictions)), random_ints(5, np.sum(predicate_targets)),
+                      predicate_predictions, random_ints(3, batch_size), mask, predicate_targets,
+                      random_senses(), random_senses()])
+
+    # counts of the eager eval fn, which scores the string arrays of each batch in the update op
+    expected = np.zeros(3, dtype=np.int64)
+    for predictions, targets, predicate_predictions, words, mask, predicate_targets, pred_sense, gold_sense in batches:
+      expected += evaluation_fns_np.conll09_srl_eval(
+        tables['srl'][predictions], tables['predicate'][predicate_predictions], tables['word'][words], mask,
+        tables['srl'][targets], tables['predicate'][predicate_targets], None, None, None, None, None, None,
+        None, None, pred_sense, gold_sense)
+
+    score_fn = functools.partial(evaluation_fns_np.conll09_srl_eval_ints, tables)
+    for background in [False, True]:
+      deferred_eval = evaluation_fns_np.DeferredEval(score_fn, 3, background)
+      for batch in batches:
+        self.assertEqual(deferred_eval.append(*batch), len(batch[0]))
+      self.assertEqual(deferred_eval.result().tolist(), expected.tolist())
+
+  def test_srl_scores_from_counts(self):
+    with self.test_session():
+      for counts, scores in [([3, 1, 2], [0.75, 0.6, 2 * 0.75 * 0.6 / 1.35]),
+                             ([0, 0, 0], [0., 0., 0.]),
+                             ([0, 2, 0], [0., 0., 0.]),
+                             ([0, 0, 2], [0., 0., 0.])]:
+        precision, recall, f1 = evaluation_fns.srl_scores_from_counts(tf.constant(counts, dtype=tf.int64))
+        self.assertAllClose([precision.eval(), recall.eval(), f1.eval()], scores)
+
+
+if __name__ == '__main__':
+  tf.test.main()
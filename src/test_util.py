@@ -0,0 +1,98 @@
+import itertools
+import random
+import threading
+import time
+
+import tensorflow as tf
+import numpy as np
+import util
+
+
+class UtilTests(tf.test.TestCase):
+
+  def test_viterbi_decode_batch(self):
+    rng = np.random.RandomState(1)
+    for trial in range(50):
+      num_rows, seq_len, num_labels = rng.randint(1, 6), rng.randint(1, 9), rng.randint(1, 5)
+      if trial % 2:
+        # small integer scores, so that many paths tie
+        scores = rng.randint(0, 2, [num_rows, seq_len, num_labels]).astype(np.float32)
+        transition_params = rng.randint(-1, 1, [num_labels, num_labels]).astype(np.float32)
+      else:
+        scores = rng.randn(num_rows, seq_len, num_labels).astype(np.float32)
+        transition_params = rng.randn(num_labels, num_labels).astype(np.float32)
+      # including padded rows, which have no tokens at all
+      sent_lens = rng.randint(0, seq_len + 1, [num_rows])
+
+      tags, best_scores = util.viterbi_decode_batch(scores, sent_lens, transition_params)
+      self.assertEqual(tags.shape, (num_rows, seq_len))
+      for row, sent_len in enumerate(sent_lens):
+        if sent_len == 0:
+          self.assertEqual(tags[row].tolist(), [0] * seq_len)
+          continue
+        expected_tags, expected_score = tf.contrib.crf.viterbi_decode(scores[row, :sent_len], transition_params)
+        self.assertEqual(tags[row].tolist(), list(expected_tags) + [0] * (seq_len - sent_len))
+        self.assertAllClose(best_scores[row], expected_score)
+
+  def pipeline_threads_exit(self, threads_before):
+    # the stage threads poll a stop event, so they exit shortly after the pipeline is closed
+    deadline = time.time() + 5
+    while set(threading.enumerate()) - threads_before and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertEqual(set(threading.enumerate()) - threads_before, set())
+
+  def test_pipeline_order(self):
+    rng = random.Random(1)
+
+    def slow(fn):
+      def stage_fn(item):
+        time.sleep(rng.random() * 0.002)
+        return fn(item)
+      return stage_fn
+
+    stage_fns = [slow(lambda x: x + 1), slow(lambda x: x * 2), slow(str)]
+    expected = [str((x + 1) * 2) for x in range(100)]
+    for queue_size in [0, 1, 3]:
+      threads_before = set(threading.enumerate())
+      self.assertEqual(list(util.pipeline(range(100), stage_fns, queue_size)), expected)
+      self.pipeline_threads_exit(threads_before)
+
+  def test_pipeline_errors(self):
+    def items():
+      yield 1
+      yield 2
+      raise KeyError('items')
+
+    def stage_fn(item):
+      if item == 3:
+        raise ValueError('stage')
+      return item
+
+    for queue_size in [0, 2]:
+      threads_before = set(threading.enumerate())
+      results = []
+      with self.assertRaises(KeyError):
+        for item in util.pipeline(items(), [stage_fn], queue_size):
+          results.append(item)
+      self.assertEqual(results, [1, 2])
+
+      results = []
+      with self.assertRaises(ValueError):
+        for item in util.pipeline(range(10), [lambda x: x, stage_fn], queue_size):
+          results.append(item)
+      self.assertEqual(results, [0, 1, 2])
+      self.pipeline_threads_exit(threads_before)
+
+  def test_pipeline_early_break(self):
+    threads_before = set(threading.enumerate())
+    # an endless source, and stages that would block on full queues if they didn't stop
+    results = util.pipeline(itertools.count(), [lambda x: x, lambda x: x * 2], queue_size=1)
+    for item in results:
+      if item == 10:
+        break
+    results.close()
+    self.pipeline_threads_exit(threads_before)
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -10,6 +10,17 @@ def get_num_trainable_parameters():
   return np.sum([np.prod(v.shape) for v in tf.trainable_variables()])
 
 
+def viterbi_decode(scores, sequence_lengths, transition_params):
+  '''
+  In-graph counterpart of util.viterbi_decode_batch, so that decoding can be exported with the model:
+  decodes batch_size x seq_len x num_labels scores in one op, with tags past each sequence length set to 0.
+  Returns the tags and the score of each row's best sequence
+  '''
+  tags, best_scores = tf.contrib.crf.crf_decode(scores, transition_params, sequence_lengths)
+  valid_tags = tf.sequence_mask(sequence_lengths, tf.shape(tags)[1])
+  return tf.where(valid_tags, tags, tf.zeros_like(tags)), best_scores
+
+
 def flip_gradient(x, lam=1.0):
   """Gradient reversal layer
      From: https://github.com/tachitachi/GradientReversal
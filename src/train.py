@@ -117,19 +117,27 @@ embedding_files = [embeddings_map['pretrained_embeddings'] for embeddings_map in
 if "glove_300d" in model_config and hparams.glove_300d:
   embedding_files.append(model_config["glove_300d"]["glove_300d_embeddings"])
 
+# keep only the embeddings of words in the train/dev data; evaluation picks the pruning up from the vocab dir
+if hparams.prune_embeddings:
+  vocab.prune_embeddings(embedding_files, train_filenames + dev_filenames)
+else:
+  vocab.clear_pruned_embeddings(embedding_files)
+
 
 def train_input_fn():
   return train_utils.get_input_fn(vocab, data_config, train_filenames, hparams.batch_size,
                                   num_epochs=hparams.num_train_epochs, shuffle=True,
                                   is_token_based_batching = hparams.is_token_based_batching,
                                   embedding_files=embedding_files,
-                                  shuffle_buffer_multiplier=hparams.shuffle_buffer_multiplier)
+                                  shuffle_buffer_multiplier=hparams.shuffle_buffer_multiplier,
+                                  hparams=hparams)
 
 
 def dev_input_fn():
   return train_utils.get_input_fn(vocab, data_config, dev_filenames, hparams.batch_size,
                                   num_epochs=1, shuffle=False,
-                                  embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching)
+                                  embedding_files=embedding_files, is_token_based_batching = hparams.is_token_based_batching,
+                                  hparams=hparams)
 
 
 # Generate mappings from feature/label names to indices in the model_fn inputs
@@ -168,6 +176,7 @@ estimator = tf.estimator.Estimator(model_fn=model.model_fn, model_dir=args.save_
 # Set up early stopping -- always keep the model with the best F1
 export_assets = {"%s.txt" % vocab_name: "%s/assets.extra/%s.txt" % (args.save_dir, vocab_name)
                  for vocab_name in vocab.vocab_names_sizes.keys()}
+export_assets.update(vocab.get_pruned_embeddings_assets(embedding_files))
 srl_early_stop_hook = tf.estimator.experimental.stop_if_no_increase_hook(estimator, 'srl_f1', max_steps_without_increase=24000,  min_steps=hparams.training_min_steps if not args.debug else 40000)
 tf.logging.log(tf.logging.INFO, "Exporting assets: %s" % str(export_assets))
 save_best_exporter = tf.estimator.BestExporter(compare_fn=partial(train_utils.best_model_compare_fn,
@@ -187,8 +196,15 @@ best_copier = BestCheckpointCopier(
 
 # Train forever until killed
 train_spec = tf.estimator.TrainSpec(input_fn=train_input_fn, hooks=[srl_early_stop_hook] if args.early_stopping else None)
+if util.streams_cwr(hparams):
+  tf.logging.log(tf.logging.WARNING, "Not exporting the best models: streamed cached embeddings are gathered in a "
+                                     "tf.py_func, which an exported SavedModel can't run. Predict from the "
+                                     "checkpoints in %s instead" % args.save_dir)
+  exporters = []
+else:
+  exporters = [save_best_exporter, best_copier]
 eval_spec = tf.estimator.EvalSpec(input_fn=dev_input_fn, throttle_secs=hparams.eval_throttle_secs,
-                                  exporters=[save_best_exporter, best_copier])
+                                  exporters=exporters)
 
 # Run training
 
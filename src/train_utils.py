@@ -5,6 +5,7 @@ import json
 import re
 import sys
 import dataset
+import data_generator
 import constants
 from pathlib import Path
 import numpy as np
@@ -71,12 +72,18 @@ def load_hparams(args, model_config, neptune_handler = None):
 
 
 def get_input_fn(vocab, data_config, data_files, batch_size, num_epochs, shuffle, is_token_based_batching,
-                 shuffle_buffer_multiplier=1, embedding_files=None):
-  # this needs to be created from here (lazily) so that it ends up in the same tf.Graph as everything else
-  vocab_lookup_ops = vocab.create_vocab_lookup_ops(embedding_files)
+                 shuffle_buffer_multiplier=1, embedding_files=None, hparams=None):
+  compiled_shards = data_generator.find_compiled_shards(data_files, data_config, vocab)
+  # this needs to be created from here (lazily) so that it ends up in the same tf.Graph as everything else;
+  # compiled shards are already int-mapped and don't need them
+  vocab_lookup_ops = vocab.get_lookup_ops(embedding_files) if not compiled_shards else None
   # print("debug <create vocab_lookup ops>: ", vocab_lookup_ops)
+  cache_filename = None
+  if hparams is not None and hparams.input_cache_dir:
+    cache_filename = data_generator.get_cache_filename(hparams.input_cache_dir, data_files, data_config, vocab)
   return dataset.get_data_iterator(data_files, data_config, vocab_lookup_ops, batch_size, num_epochs, shuffle,
-                                   shuffle_buffer_multiplier, is_token_based_batching = is_token_based_batching)
+                                   shuffle_buffer_multiplier, is_token_based_batching = is_token_based_batching,
+                                   compiled_shards=compiled_shards, cache_filename=cache_filename, hparams=hparams)
 
 
 def load_json_configs(config_file_list, args=None):
@@ -1,10 +1,15 @@
 from collections import OrderedDict
 
+import queue
+import threading
 import h5py
 import numpy as np
 import tensorflow as tf
+import hashlib
 import os
 import sys
+import tempfile
+import constants
 
 
 def fatal_error(message):
@@ -54,23 +59,117 @@ def load_transitions(transition_statistics, num_classes, vocab_map):
   return transition_statistics_np
 
 
-def load_pretrained_embeddings(pretrained_fname):
-  tf.logging.log(tf.logging.INFO, "Loading pre-trained embedding file: %s" % pretrained_fname)
+def get_converted_embeddings_paths(pretrained_fname):
+  '''
+  The converted embeddings live next to the text file, or, when its directory is read-only and they are not
+  there already, in a directory of the system temp dir named after the file's path
+  '''
+  npy_fname = pretrained_fname + '.npy'
+  if not os.path.exists(npy_fname) and not os.access(os.path.dirname(os.path.abspath(pretrained_fname)), os.W_OK):
+    path_hash = hashlib.sha1(os.path.abspath(pretrained_fname).encode('utf-8')).hexdigest()[:16]
+    converted_dir = os.path.join(tempfile.gettempdir(), 'converted_embeddings', path_hash)
+    os.makedirs(converted_dir, exist_ok=True)
+    npy_fname = os.path.join(converted_dir, os.path.basename(pretrained_fname) + '.npy')
+  return npy_fname, npy_fname[:-len('.npy')] + '.vocab'
+
+
+def _temp_path(fname):
+  # unique to this conversion and in the same directory, so that os.replace is atomic
+  fd, tmp_fname = tempfile.mkstemp(prefix=os.path.basename(fname) + '.', suffix='.tmp', dir=os.path.dirname(fname))
+  os.close(fd)
+  os.chmod(tmp_fname, 0o644)
+  return tmp_fname
+
+
+def is_converted_embeddings_fresh(pretrained_fname):
+  source_mtime = os.path.getmtime(pretrained_fname)
+  return all(os.path.exists(f) and os.path.getmtime(f) >= source_mtime
+             for f in get_converted_embeddings_paths(pretrained_fname))
 
-  # TODO: np.loadtxt refuses to work for some reason
-  # pretrained_embeddings = np.loadtxt(self.args.word_embedding_file, usecols=range(1, word_embedding_size+1))
-  pretrained_embeddings = []
+
+def convert_pretrained_embeddings(pretrained_fname):
+  '''
+  Converts a GloVe/FastText style text embedding file into a float32 .npy matrix, already divided by its std,
+  plus a sidecar .vocab file with the word of each row, one per line. The matrix is written row by row into a
+  memory-mapped file, so conversion never holds more than one copy of it.
+  '''
+  tf.logging.log(tf.logging.INFO, "Converting pre-trained embedding file: %s" % pretrained_fname)
+  npy_fname, vocab_fname = get_converted_embeddings_paths(pretrained_fname)
+
+  num_embeddings = 0
+  embedding_dim = None
   with open(pretrained_fname, 'r', encoding="utf-8") as f:
     for line in f:
-      split_line = line.split(' ')
-      try:
-        embedding = list(map(float, split_line[1:]))
-      except Exception:
-        print(split_line[1:])
-      pretrained_embeddings.append(embedding)
-  pretrained_embeddings = np.array(pretrained_embeddings)
-  pretrained_embeddings /= np.std(pretrained_embeddings)
-  return pretrained_embeddings
+      if embedding_dim is None:
+        embedding_dim = len(line.rstrip().split(' ')) - 1
+      num_embeddings += 1
+
+  npy_tmp_fname = _temp_path(npy_fname)
+  vocab_tmp_fname = _temp_path(vocab_fname)
+  try:
+    _write_converted_embeddings(pretrained_fname, npy_tmp_fname, vocab_tmp_fname, num_embeddings, embedding_dim)
+    os.replace(npy_tmp_fname, npy_fname)
+    os.replace(vocab_tmp_fname, vocab_fname)
+  finally:
+    for tmp_fname in [npy_tmp_fname, vocab_tmp_fname]:
+      if os.path.exists(tmp_fname):
+        os.remove(tmp_fname)
+  tf.logging.log(tf.logging.INFO, "Converted %d pre-trained embeddings of dim %d to: %s" %
+                 (num_embeddings, embedding_dim or 0, npy_fname))
+
+
+def _write_converted_embeddings(pretrained_fname, npy_fname, vocab_fname, num_embeddings, embedding_dim):
+  pretrained_embeddings = np.lib.format.open_memmap(npy_fname, mode='w+', dtype=np.float32,
+                                                    shape=(num_embeddings, embedding_dim or 0))
+  total = 0.
+  total_squares = 0.
+  with open(pretrained_fname, 'r', encoding="utf-8") as f, open(vocab_fname, 'w', encoding="utf-8") as vocab_f:
+    for i, line in enumerate(f):
+      word, _, values = line.rstrip().partition(' ')
+      embedding = np.fromstring(values, dtype=np.float64, sep=' ')
+      if embedding.shape[0] != embedding_dim:
+        fatal_error("Malformed line %d in pre-trained embedding file %s (expected %d values, got %d)" %
+                    (i + 1, pretrained_fname, embedding_dim, embedding.shape[0]))
+      pretrained_embeddings[i] = embedding
+      total += np.sum(embedding)
+      total_squares += np.sum(np.square(embedding))
+      print(word, file=vocab_f)
+
+  num_values = max(pretrained_embeddings.size, 1)
+  std = np.sqrt(total_squares / num_values - (total / num_values) ** 2)
+  chunk_size = 1 << 16
+  for start in range(0, num_embeddings, chunk_size):
+    pretrained_embeddings[start:start + chunk_size] /= std
+  pretrained_embeddings.flush()
+  del pretrained_embeddings
+
+
+def ensure_converted_embeddings(pretrained_fname):
+  if not is_converted_embeddings_fresh(pretrained_fname):
+    try:
+      convert_pretrained_embeddings(pretrained_fname)
+    except OSError as e:
+      fatal_error("Failed to convert pre-trained embedding file: %s; %s" % (pretrained_fname, e.strerror))
+  return get_converted_embeddings_paths(pretrained_fname)
+
+
+def load_pretrained_embeddings(pretrained_fname):
+  '''
+  Returns the std-normalized pre-trained embeddings in pretrained_fname as a read-only memory-mapped float32
+  matrix, converting the text file to the binary format first if that hasn't been done yet.
+  '''
+  npy_fname, _ = ensure_converted_embeddings(pretrained_fname)
+  tf.logging.log(tf.logging.INFO, "Loading pre-trained embedding file: %s" % npy_fname)
+  return np.load(npy_fname, mmap_mode='r')
+
+
+def load_pretrained_embeddings_vocab(pretrained_fname):
+  '''
+  Returns the words of the rows of the pre-trained embeddings in pretrained_fname, in order.
+  '''
+  _, vocab_fname = ensure_converted_embeddings(pretrained_fname)
+  with open(vocab_fname, 'r', encoding="utf-8") as f:
+    return [line.rstrip('\n') for line in f]
 
 def load_cached_pretrained_embedding(pretrained_fname, cwr_type):
   table = []
@@ -96,6 +195,93 @@ def load_cached_pretrained_embedding(pretrained_fname, cwr_type):
   return np.concatenate(table, axis=0)
 
 
+def get_converted_cwr_path(pretrained_fname, cwr_type):
+  return "%s.%s.npy" % (pretrained_fname, cwr_type)
+
+
+def _cached_cwr_sentence_table(sentence, cwr_type):
+  if cwr_type == 'ELMo':
+    return np.concatenate([sentence[idx] for idx in range(3)], -1)
+  elif cwr_type == 'BERT':
+    return sentence[()]
+  fatal_error("Unknown CWR type: %s" % cwr_type)
+
+
+def convert_cached_pretrained_embedding(pretrained_fname, cwr_type):
+  '''
+  Converts an HDF5 file of cached contextual embeddings (one group per sentence, as read by
+  load_cached_pretrained_embedding) into a single contiguous float32 .npy matrix with one row per token.
+  Sentences are written one at a time into a memory-mapped file, so the corpus never has to fit in memory.
+  '''
+  npy_fname = get_converted_cwr_path(pretrained_fname, cwr_type)
+  tf.logging.log(tf.logging.INFO, "Converting cached embedding file: %s" % pretrained_fname)
+  with h5py.File(pretrained_fname, 'r') as fin:
+    num_sents = len(fin)
+    # ELMo sentences are [layers, tokens, dim], BERT sentences [tokens, dim]
+    shapes = [fin[str(idx)].shape for idx in range(num_sents)]
+    if cwr_type == 'ELMo':
+      num_tokens = [shape[1] for shape in shapes]
+      embedding_dim = 3 * shapes[0][2] if shapes else 0
+    else:
+      num_tokens = [shape[0] for shape in shapes]
+      embedding_dim = shapes[0][1] if shapes else 0
+
+    table = np.lib.format.open_memmap(npy_fname + '.tmp', mode='w+', dtype=np.float32,
+                                      shape=(sum(num_tokens), embedding_dim))
+    offset = 0
+    for idx in range(num_sents):
+      table[offset:offset + num_tokens[idx]] = _cached_cwr_sentence_table(fin[str(idx)], cwr_type)
+      offset += num_tokens[idx]
+    table.flush()
+    del table
+  os.replace(npy_fname + '.tmp', npy_fname)
+  tf.logging.log(tf.logging.INFO, "Converted %d sentences (%d tokens) of cached embeddings to: %s" %
+                 (num_sents, offset, npy_fname))
+  return npy_fname
+
+
+def load_cached_pretrained_embedding_memmap(pretrained_fname, cwr_type):
+  npy_fname = get_converted_cwr_path(pretrained_fname, cwr_type)
+  if not os.path.exists(npy_fname) or os.path.getmtime(npy_fname) < os.path.getmtime(pretrained_fname):
+    convert_cached_pretrained_embedding(pretrained_fname, cwr_type)
+  return np.load(npy_fname, mmap_mode='r')
+
+
+class CachedCWRProvider:
+  '''
+  Serves rows of the concatenation of several cached contextual embedding files without loading them: each
+  file is converted once to a contiguous .npy matrix, and only the rows requested for a batch are read from the
+  memory-mapped matrices. Ids outside of [0, num_rows) get zero vectors.
+  '''
+
+  def __init__(self, pretrained_fnames, cwr_type):
+    self.tables = [load_cached_pretrained_embedding_memmap(f, cwr_type) for f in pretrained_fnames]
+    self.offsets = np.cumsum([0] + [table.shape[0] for table in self.tables])
+    self.num_rows = int(self.offsets[-1])
+    self.embedding_dim = self.tables[0].shape[1]
+
+  def gather(self, ids):
+    flat_ids = np.reshape(ids, [-1]).astype(np.int64)
+    gathered = np.zeros([flat_ids.shape[0], self.embedding_dim], dtype=np.float32)
+    valid = np.logical_and(flat_ids >= 0, flat_ids < self.num_rows)
+    table_idx = np.searchsorted(self.offsets, flat_ids, side='right') - 1
+    for t in np.unique(table_idx[valid]):
+      selected = np.logical_and(valid, table_idx == t)
+      rows = flat_ids[selected] - self.offsets[t]
+      # read the rows in file order; memmap fancy indexing only touches the pages it needs
+      order = np.argsort(rows, kind='stable')
+      gathered[np.flatnonzero(selected)[order]] = self.tables[t][rows[order]]
+    return np.reshape(gathered, list(np.shape(ids)) + [self.embedding_dim])
+
+
+def streams_cwr(hparams):
+  '''
+  Whether the model gathers its cached embeddings through CachedCWRProvider in a tf.py_func, which a loaded
+  SavedModel can't run: such models are only predicted with from their checkpoints
+  '''
+  return hparams.cwr != 'None' and hparams.cwr_streaming
+
+
 def get_token_take_mask(task, task_config, outputs, labels = None):
   ## Hard patch here!
   task_map = task_config[task]
@@ -139,6 +325,145 @@ def load_transition_params(task_config, vocab, train_with_crf = False):
   return transition_params
 
 
+def viterbi_decode_batch(scores, sent_lens, transition_params):
+  '''
+  Viterbi-decodes a num_rows x seq_len x num_labels array of scores in one pass, each row up to its length
+  in sent_lens. Every row is decoded exactly as tf.contrib.crf.viterbi_decode would decode it on its own;
+  tags past a row's length are 0. Returns the tags and the score of each row's best sequence
+  '''
+  scores = np.asarray(scores)
+  num_rows, seq_len, num_labels = scores.shape
+  sent_lens = np.minimum(np.asarray(sent_lens, dtype=np.int64), seq_len)
+  tags = np.zeros([num_rows, seq_len], dtype=np.int32)
+  if num_rows == 0 or seq_len == 0:
+    return tags, np.zeros([num_rows], dtype=scores.dtype)
+
+  # with rows sorted by decreasing length, the rows still being decoded at each step are a prefix
+  order = np.argsort(-sent_lens, kind='stable')
+  sorted_scores = scores[order]
+  num_active = np.sum(sent_lens[:, None] > np.arange(seq_len)[None, :], 0)
+  trellis = sorted_scores[:, 0].copy()
+  backpointers = np.zeros([num_rows, seq_len, num_labels], dtype=np.int32)
+  # rows that have ended point back to the same tag, so backtracking passes through their padding
+  backpointers[:, :] = np.arange(num_labels)
+  for t in range(1, seq_len):
+    n = num_active[t]
+    if n == 0:
+      break
+    # n x previous tag x tag
+    v = np.expand_dims(trellis[:n], -1) + transition_params
+    best_previous = np.argmax(v, 1)
+    trellis[:n] = sorted_scores[:n, t] + np.take_along_axis(v, best_previous[:, None, :], 1)[:, 0]
+    backpointers[:n, t] = best_previous
+
+  rows = np.arange(num_rows)
+  sorted_tags = np.zeros([num_rows, seq_len], dtype=np.int32)
+  sorted_tags[:, -1] = np.argmax(trellis, -1)
+  for t in range(seq_len - 1, 0, -1):
+    sorted_tags[:, t - 1] = backpointers[rows, t, sorted_tags[:, t]]
+  tags[order] = sorted_tags
+  tags[np.arange(seq_len)[None, :] >= sent_lens[:, None]] = 0
+  best_scores = np.zeros([num_rows], dtype=trellis.dtype)
+  best_scores[order] = np.max(trellis, -1)
+  return tags, best_scores
+
+
+ENSEMBLE_RULES = ['product', 'mean']
+
+
+def _log_normalize(log_p):
+  log_p = log_p - np.max(log_p, -1, keepdims=True)
+  return log_p - np.log(np.sum(np.exp(log_p), -1, keepdims=True))
+
+
+def ensemble_outputs(member_outputs, rule='product'):
+  '''
+  Combines the output dicts of the ensemble members run on one batch. Each _scores and _probabilities output
+  is combined over the members' distributions, by their normalized product for rule 'product' or their mean
+  for 'mean': combined _probabilities are distributions and combined _scores their logs, fit for argmax or
+  Viterbi decoding. Losses are averaged and other outputs are the first member's
+  '''
+  if rule not in ENSEMBLE_RULES:
+    fatal_error("Unknown ensemble rule '%s', expected one of %s" % (rule, ENSEMBLE_RULES))
+  combined = dict(member_outputs[0])
+  if len(member_outputs) == 1:
+    return combined
+  for key in combined:
+    is_scores, is_probabilities = key.endswith("_scores"), key.endswith("_probabilities")
+    if not (is_scores or is_probabilities or key.endswith("loss")):
+      continue
+    values = [np.asarray(outputs[key]) for outputs in member_outputs]
+    if any(v.shape != values[0].shape for v in values):
+      fatal_error("Ensemble members disagree on the shape of '%s': %s" % (key, [v.shape for v in values]))
+    if not (is_scores or is_probabilities):
+      combined[key] = np.mean(values, 0).astype(values[0].dtype)
+      continue
+    log_p = [_log_normalize(v) if is_scores else np.log(np.maximum(v, np.finfo(v.dtype).tiny)) for v in values]
+    if rule == 'product':
+      combined_log_p = _log_normalize(np.mean(log_p, 0))
+    else:
+      combined_log_p = np.log(np.maximum(np.mean(np.exp(log_p), 0), np.finfo(values[0].dtype).tiny))
+    combined[key] = (combined_log_p if is_scores else np.exp(combined_log_p)).astype(values[0].dtype)
+  return combined
+
+
+def decode_predictions(input_np, outputs, feature_idx_map, label_idx_map, task_config, transition_params,
+                       viterbi_in_graph_tasks=()):
+  '''
+  Decodes the model outputs on a batch of input_np into predictions: the argmax of every _scores and
+  _probabilities output, and the Viterbi decoding of the scores of tasks with transition params, except for
+  the tasks in viterbi_in_graph_tasks, whose _predictions the model already decoded in-graph (see
+  output_fns.decodes_viterbi_in_graph). Returns the predictions and the features, labels and token mask of
+  the batch, as the eval fns take them
+  '''
+  batch_size, batch_seq_len = input_np.shape[:2]
+  feats = {f: input_np[:, :, idx] for f, idx in feature_idx_map.items()}
+  tokens_to_keep = np.where(feats['word'] == constants.PAD_VALUE, 0, 1)
+
+  predictions = dict(outputs)
+  scores = {k: v for k, v in outputs.items() if k.endswith("_scores")}
+  probabilities = {k: v for k, v in outputs.items() if k.endswith("_probabilities")}
+  exported_predictions = {k: v for k, v in outputs.items() if k.endswith("_predictions")}
+  predictions.update({k.replace('scores', 'predictions'): np.argmax(v, axis=-1) for k, v in scores.items()})
+  predictions.update({k.replace('probabilities', 'predictions'): np.argmax(v, axis=-1)
+                      for k, v in probabilities.items()})
+
+  labels = {}
+  for l, idx in label_idx_map.items():
+    these_labels = input_np[:, :, idx[0]:idx[0]+1] if idx[1] != -1 else input_np[:, :, idx[0]:]
+    these_labels_masked = np.multiply(these_labels, np.expand_dims(tokens_to_keep, -1))
+    # check if we need to mask another dimension
+    if idx[1] == -1:
+      this_mask = np.where(these_labels_masked == constants.PAD_VALUE, 0, 1)
+      these_labels_masked = np.multiply(these_labels_masked, this_mask)
+    else:
+      these_labels_masked = np.squeeze(these_labels_masked, -1)
+    labels[l] = these_labels_masked
+
+  for task, tran_params in transition_params.items():
+    task_predictions = np.zeros_like(predictions['%s_predictions' % task])
+    token_take_mask = get_token_take_mask(task, task_config, predictions, labels)
+    if token_take_mask is not None:
+      toks_to_keep_tiled = np.reshape(np.tile(tokens_to_keep, [1, batch_seq_len]),
+                                      [batch_size, batch_seq_len, batch_seq_len])
+      toks_to_keep_task = toks_to_keep_tiled[np.where(token_take_mask == 1)]
+    else:
+      toks_to_keep_task = tokens_to_keep
+    sent_lens_task = np.sum(toks_to_keep_task, axis=-1)
+    if 'srl' in transition_params:
+      if task in viterbi_in_graph_tasks:
+        # already decoded by tf_utils.viterbi_decode in the exported graph
+        task_predictions = exported_predictions['%s_predictions' % task]
+      else:
+        # decode all rows at once rather than calling viterbi_decode per row
+        task_scores = scores['%s_scores' % task]
+        num_rows = min(len(task_scores), len(sent_lens_task))
+        task_predictions[:num_rows], _ = viterbi_decode_batch(task_scores[:num_rows], sent_lens_task[:num_rows],
+                                                              tran_params)
+    predictions['%s_predictions' % task] = task_predictions
+  return predictions, feats, labels, tokens_to_keep
+
+
 def load_feat_label_idx_maps(data_config):
   feature_idx_map = {}
   label_idx_map = {}
@@ -185,3 +510,73 @@ def combine_attn_maps(layer_config, attention_config, task_config):
       fatal_error('type of layer indicator is not expected')
   # if 'parsed_label'
   return layer_task_config, layer_attention_config
+
+
+_PIPELINE_END = object()
+
+
+class _PipelineError(object):
+  def __init__(self, error):
+    self.error = error
+
+
+def _pipeline_put(q, item, stop):
+  while not stop.is_set():
+    try:
+      q.put(item, timeout=0.1)
+      return True
+    except queue.Full:
+      pass
+  return False
+
+
+def _pipeline_drain(q, stop):
+  while not stop.is_set():
+    try:
+      item = q.get(timeout=0.1)
+    except queue.Empty:
+      continue
+    if item is _PIPELINE_END:
+      return
+    if isinstance(item, _PipelineError):
+      raise item.error
+    yield item
+
+
+def _pipeline_stage(stage_fn, items, out_queue, stop):
+  try:
+    for item in items:
+      if not _pipeline_put(out_queue, stage_fn(item), stop):
+        return
+  except Exception as e:
+    _pipeline_put(out_queue, _PipelineError(e), stop)
+    return
+  _pipeline_put(out_queue, _PIPELINE_END, stop)
+
+
+def pipeline(items, stage_fns, queue_size=2):
+  '''
+  Iterates items and maps them through each of stage_fns in turn, each in its own thread, with at most
+  queue_size results waiting between consecutive stages. Yields the results of the last stage in the order
+  of items; an exception raised by iterating items or by a stage is raised here. With queue_size 0 the
+  stages run serially in the calling thread
+  '''
+  if queue_size <= 0:
+    for item in items:
+      for stage_fn in stage_fns:
+        item = stage_fn(item)
+      yield item
+    return
+
+  stop = threading.Event()
+  items = iter(items)
+  stage_fns = [lambda item: item] + list(stage_fns)
+  for stage_fn in stage_fns:
+    out_queue = queue.Queue(queue_size)
+    threading.Thread(target=_pipeline_stage, args=(stage_fn, items, out_queue, stop), daemon=True).start()
+    items = _pipeline_drain(out_queue, stop)
+  try:
+    for item in items:
+      yield item
+  finally:
+    stop.set()
@@ -2,12 +2,148 @@ from collections import OrderedDict
 
 import tensorflow as tf
 import numpy as np
+import hashlib
+import json
+import multiprocessing
 import os
+import weakref
 import util
 import constants
 import data_converters
 
 
+# binary cache of per-file vocab counts, kept next to the vocab files
+VOCAB_INDEX_FILE = 'vocab_index.npz'
+
+# files are split into chunks of roughly this many bytes, which are counted in parallel
+VOCAB_COUNT_CHUNK_BYTES = 1 << 26
+
+# chunks are read and converted this many lines at a time
+VOCAB_COUNT_BLOCK_LINES = 1 << 16
+
+
+def count_vocab_values(filename, data_config, vocab_names, start=0, end=None):
+  '''
+  Counts the converted values of each of vocab_names over a CoNLL file, or the lines of it between byte offsets
+  start and end. The file is streamed in blocks of VOCAB_COUNT_BLOCK_LINES lines, whose tokens are converted in
+  groups of lines with the same number of fields using the column converters, rather than one token at a time.
+
+  Returns:
+    Map from vocab names to an OrderedDict of value counts, in order of first occurrence in the file
+  '''
+  # value -> [(line, field) of first occurrence, count]
+  counts = {d: {} for d in vocab_names}
+  num_lines = 0
+  with open(filename, 'rb') as f:
+    f.seek(start)
+    position = start
+    block = []
+    while end is None or position < end:
+      line = f.readline()
+      if not line:
+        break
+      position += len(line)
+      split_line = line.decode('utf-8').split()
+      if split_line:
+        block.append(split_line)
+      if len(block) == VOCAB_COUNT_BLOCK_LINES:
+        _count_block(block, num_lines, data_config, vocab_names, counts)
+        num_lines += len(block)
+        block = []
+    _count_block(block, num_lines, data_config, vocab_names, counts)
+
+  return {d: OrderedDict((value, c[1]) for value, c in sorted(counts[d].items(), key=lambda x: x[1][0]))
+          for d in vocab_names}
+
+
+def _count_block(split_lines, first_line, data_config, vocab_names, counts):
+  rows_by_width = OrderedDict({})
+  for i, split_line in enumerate(split_lines):
+    rows_by_width.setdefault(len(split_line), []).append(i)
+  stride = max(rows_by_width.keys()) + 1 if rows_by_width else 1
+
+  for width, rows in rows_by_width.items():
+    columns = np.array([split_lines[i] for i in rows])
+    rows = np.array(rows, dtype=np.int64)
+    for d in vocab_names:
+      values = data_converters.convert_columns(data_config[d], columns)
+      positions = rows[:, None] * stride + np.arange(values.shape[1])[None, :]
+      uniques, first_idx, uniq_counts = np.unique(values.reshape([-1]), return_index=True, return_counts=True)
+      first_positions = positions.reshape([-1])[first_idx]
+      this_counts = counts[d]
+      for value, position, count in zip(uniques.tolist(), first_positions.tolist(), uniq_counts.tolist()):
+        position = (first_line + position // stride, position % stride)
+        if value in this_counts:
+          this_counts[value][0] = min(this_counts[value][0], position)
+          this_counts[value][1] += count
+        else:
+          this_counts[value] = [position, count]
+
+
+def _count_vocab_chunk(args):
+  return count_vocab_values(*args)
+
+
+def get_file_chunks(filename, chunk_bytes=None):
+  '''
+  Splits filename into (start, end) byte ranges of about chunk_bytes each, aligned to line boundaries.
+  '''
+  chunk_bytes = chunk_bytes or VOCAB_COUNT_CHUNK_BYTES
+  size = os.path.getsize(filename)
+  boundaries = [0]
+  with open(filename, 'rb') as f:
+    while boundaries[-1] + chunk_bytes < size:
+      f.seek(boundaries[-1] + chunk_bytes)
+      f.readline()
+      if f.tell() >= size:
+        break
+      boundaries.append(f.tell())
+  boundaries.append(size)
+  return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def merge_vocab_counts(counts_list, merged=None):
+  '''
+  Merges OrderedDicts of value counts, in order: values not seen yet are appended in their order of first
+  occurrence, so merging the counts of consecutive chunks gives the same order as counting them in one pass.
+  '''
+  merged = OrderedDict({}) if merged is None else merged
+  for counts in counts_list:
+    for value, count in counts.items():
+      merged[value] = merged.get(value, 0) + count
+  return merged
+
+
+def count_vocab_files(filenames, data_config, vocab_names, num_processes=None):
+  '''
+  Counts the values of vocab_names in each of filenames, counting file chunks in parallel in a process pool.
+
+  Returns:
+    List with, for each file, a map from vocab names to OrderedDicts of value counts
+  '''
+  vocab_names = list(vocab_names)
+  jobs = [(i, start, end) for i, filename in enumerate(filenames) for start, end in get_file_chunks(filename)]
+  chunk_args = [(filenames[i], data_config, vocab_names, start, end) for i, start, end in jobs]
+  num_processes = min(num_processes or multiprocessing.cpu_count(), len(jobs))
+  if num_processes > 1:
+    tf.logging.log(tf.logging.INFO, "Counting vocabs over %d chunks of %d files with %d processes" %
+                   (len(jobs), len(filenames), num_processes))
+    pool = multiprocessing.Pool(num_processes)
+    try:
+      chunk_counts = pool.map(_count_vocab_chunk, chunk_args)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    chunk_counts = [_count_vocab_chunk(args) for args in chunk_args]
+
+  file_chunk_counts = [[] for _ in filenames]
+  for (i, _, _), counts in zip(jobs, chunk_counts):
+    file_chunk_counts[i].append(counts)
+  return [{d: merge_vocab_counts([counts[d] for counts in chunks]) for d in vocab_names}
+          for chunks in file_chunk_counts]
+
+
 class Vocab:
   '''
   Handles creating and caching vocabulary files and tf vocabulary lookup ops for a given list of data files.
@@ -21,8 +157,16 @@ class Vocab:
     self.joint_label_lookup_maps = {}
     self.reverse_maps = {}
     self.vocab_maps = {}
-    self.vocab_lookups = None
+    # lookup ops per tf.Graph; the estimator builds a new graph for every train/eval run
+    self.vocab_lookups = weakref.WeakKeyDictionary()
     self.oovs = {}
+    self.embedding_vocab_maps = {}
+    self.pruned_embedding_rows = {}
+    self.vocab_counts = {}
+
+    # per-(file, vocab config) value counts, and the entries merged into each current vocab
+    self.vocab_index = OrderedDict({})
+    self.merged_entries = {}
 
     # make directory for vocabs
     self.vocabs_dir = "%s/assets.extra" % save_dir
@@ -36,12 +180,35 @@ class Vocab:
     else:
       tf.logging.log(tf.logging.INFO, "Using vocabs directory: %s" % self.vocabs_dir)
 
+    self.load_vocab_index()
     self.vocab_names_sizes = self.make_vocab_files(self.data_config, self.save_dir, data_filenames)
 
 
 
   '''
-  Creates tf.contrib.lookup ops for all the vocabs defined in self.data_config.
+  Creates a string -> int64 lookup table from an in-memory map, equivalent to
+  tf.contrib.lookup.index_table_from_file over a file listing the keys of vocab_map in order. The keys are handed
+  to the table initializer through a py_func, so that they are neither re-read from disk nor stored as a constant
+  in the graph.
+  '''
+  def index_table_from_map(self, vocab_map, num_oov_buckets, name):
+    keys_np = np.array([k.encode('utf-8') for k in vocab_map.keys()], dtype=object)
+    values_np = np.array(list(vocab_map.values()), dtype=np.int64)
+    with tf.name_scope(name):
+      keys = tf.py_func(lambda: keys_np, [], tf.string, stateful=False)
+      keys.set_shape([len(keys_np)])
+      values = tf.py_func(lambda: values_np, [], tf.int64, stateful=False)
+      values.set_shape([len(values_np)])
+      initializer = tf.contrib.lookup.KeyValueTensorInitializer(keys, values, key_dtype=tf.string,
+                                                                value_dtype=tf.int64)
+      table = tf.contrib.lookup.HashTable(initializer, default_value=-1)
+      if num_oov_buckets:
+        table = tf.contrib.lookup.IdTableWithHashBuckets(table, num_oov_buckets)
+    return table
+
+  '''
+  Creates tf.contrib.lookup ops for all the vocabs defined in self.data_config, from the vocab maps already
+  loaded in memory.
   
   Args: 
     word_embedding_file: File containing word embedding vocab, with words in the first space-separated column
@@ -57,42 +224,142 @@ class Vocab:
       for v in self.vocab_names_sizes.keys():
         if v in self.data_config:
           num_oov = 1 if 'oov' in self.data_config[v] and self.data_config[v]['oov'] else 0
-          this_lookup = tf.contrib.lookup.index_table_from_file("%s/%s.txt" % (self.vocabs_dir, v),
-                                                                num_oov_buckets=num_oov,
-                                                                key_column_index=0)
-          vocab_lookup_ops[v] = this_lookup
+          vocab_lookup_ops[v] = self.index_table_from_map(self.vocab_maps[v], num_oov, "%s_lookup" % v)
 
       if embedding_files:
         for embedding_file in embedding_files:
           embeddings_name = embedding_file
-          print("loading {} emb file".format(embedding_file))
-          vocab_lookup_ops[embeddings_name] = tf.contrib.lookup.index_table_from_file(embedding_file,
-                                                                                      num_oov_buckets=1,
-                                                                                      key_column_index=0,
-                                                                                      delimiter=' ')
-          print("loaded {} emb file".format(embedding_file))
-          self.vocab_names_sizes[embeddings_name] = vocab_lookup_ops[embeddings_name].size()
+          embedding_vocab_map = self.load_embedding_vocab_map(embedding_file)
+          vocab_lookup_ops[embeddings_name] = self.index_table_from_map(embedding_vocab_map, 1,
+                                                                        "%s_lookup" % os.path.basename(embedding_file))
+          self.vocab_names_sizes[embeddings_name] = len(embedding_vocab_map)
 
     tf.logging.log(tf.logging.INFO, "Created %d vocab lookup ops: %s" %
                    (len(vocab_lookup_ops), str([k for k in vocab_lookup_ops.keys()])))
     return vocab_lookup_ops
 
   '''
-  Gets the cached vocab ops for the given datafile, creating them if they already exist.
+  Loads the vocab of a pretrained embedding file as a map from word to row index, matching the ids assigned by
+  the lookup table created for it in create_vocab_lookup_ops (OOV words map to len(map)).
+
+  Args:
+    embedding_file: File containing word embedding vocab, with words in the first space-separated column
+
+  Returns:
+    Map from words to their row index in embedding_file
+  '''
+  def load_embedding_vocab_map(self, embedding_file):
+    if embedding_file not in self.embedding_vocab_maps:
+      this_map = {}
+      pruned_rows = self.get_pruned_embedding_rows(embedding_file)
+      if pruned_rows is not None:
+        # pruned ids index the rows kept by prune_embeddings
+        words = util.load_pretrained_embeddings_vocab(embedding_file)
+        for i, row in enumerate(pruned_rows):
+          this_map[words[row]] = i
+      else:
+        for i, word in enumerate(util.load_pretrained_embeddings_vocab(embedding_file)):
+          this_map.setdefault(word, i)
+      self.embedding_vocab_maps[embedding_file] = this_map
+    return self.embedding_vocab_maps[embedding_file]
+
+  def get_pruned_embeddings_fname(self, embedding_file):
+    return "%s/%s.pruned.txt" % (self.vocabs_dir, os.path.basename(embedding_file))
+
+  '''
+  Returns the rows of embedding_file kept by prune_embeddings, in pruned id order, or None if it isn't pruned.
+  '''
+  def get_pruned_embedding_rows(self, embedding_file):
+    if embedding_file not in self.pruned_embedding_rows:
+      pruned_fname = self.get_pruned_embeddings_fname(embedding_file)
+      pruned_rows = None
+      if os.path.exists(pruned_fname):
+        with open(pruned_fname, 'r', encoding='utf-8') as f:
+          pruned_rows = np.array([int(line.rstrip('\n').split('\t')[1]) for line in f], dtype=np.int64)
+      self.pruned_embedding_rows[embedding_file] = pruned_rows
+    return self.pruned_embedding_rows[embedding_file]
+
+  '''
+  Signature of the id mapping of an embedding vocab, for caches of int-mapped data.
+  '''
+  def get_embedding_vocab_signature(self, embedding_file):
+    pruned_fname = self.get_pruned_embeddings_fname(embedding_file)
+    signature_fname = pruned_fname if os.path.exists(pruned_fname) else embedding_file
+    stat = os.stat(signature_fname)
+    return [os.path.abspath(signature_fname), stat.st_size, int(stat.st_mtime)]
+
+  '''
+  Restricts each of embedding_files to the words that occur in filenames (after conversion by the data_config
+  entries using it as their vocab). Kept rows get new, contiguous ids in their original order, and all other
+  words map to a single OOV id right after them. The remapping is saved next to the vocab files as
+  <embedding file name>.pruned.txt ("word<TAB>original row" per pruned id), so that evaluation and export of
+  a model trained with pruned embeddings use the same ids.
+  
+  Args:
+    embedding_files: Files containing word embeddings, with words in the first space-separated column
+    filenames: Data files whose words should be kept
+  '''
+  def prune_embeddings(self, embedding_files, filenames):
+    for embedding_file in embedding_files:
+      datum_names = [d for d in self.data_config if
+                     'vocab' in self.data_config[d] and self.data_config[d]['vocab'] == embedding_file]
+      if not datum_names:
+        tf.logging.log(tf.logging.WARN, "Not pruning embeddings not used as a vocab: %s" % embedding_file)
+        continue
+
+      corpus_words = set()
+      for file_counts in count_vocab_files(filenames, self.data_config, datum_names):
+        for d in datum_names:
+          corpus_words.update(file_counts[d].keys())
+
+      words = util.load_pretrained_embeddings_vocab(embedding_file)
+      first_rows = {}
+      for i, word in enumerate(words):
+        first_rows.setdefault(word, i)
+      pruned_rows = sorted(first_rows[word] for word in corpus_words if word in first_rows)
+
+      with open(self.get_pruned_embeddings_fname(embedding_file), 'w', encoding='utf-8') as f:
+        for row in pruned_rows:
+          print("%s\t%d" % (words[row], row), file=f)
+      self.pruned_embedding_rows.pop(embedding_file, None)
+      self.embedding_vocab_maps.pop(embedding_file, None)
+      tf.logging.log(tf.logging.INFO, "Pruned embeddings %s from %d to %d rows (%d corpus words)" %
+                     (embedding_file, len(words), len(pruned_rows), len(corpus_words)))
+
+  '''
+  Removes pruning of embedding_files left over from an earlier run, so that the full embeddings are used.
+  '''
+  def clear_pruned_embeddings(self, embedding_files):
+    for embedding_file in embedding_files:
+      pruned_fname = self.get_pruned_embeddings_fname(embedding_file)
+      if os.path.exists(pruned_fname):
+        os.remove(pruned_fname)
+      self.pruned_embedding_rows.pop(embedding_file, None)
+      self.embedding_vocab_maps.pop(embedding_file, None)
+
+  def get_pruned_embeddings_assets(self, embedding_files):
+    return {os.path.basename(f): f for f in map(self.get_pruned_embeddings_fname, embedding_files)
+            if os.path.exists(f)}
+
+  '''
+  Gets the cached vocab ops for the current tf.Graph, creating them if they don't exist yet.
   This is needed in order to avoid re-creating duplicate lookup ops for each dataset input_fn, 
   since the lookup ops need to be called lazily from the input_fn in order to end up in the same tf.Graph.
   
   Args:
-    word_embedding_file: (Optional) file containing word embedding vocab, with words in the first space-separated column
+    embedding_files: (Optional) files containing word embedding vocab, with words in the first space-separated column
   
   Returns:
     Map from vocab names to tf.contrib.lookup ops.
     
   '''
-  def get_lookup_ops(self, word_embedding_file=None):
-    if self.vocab_lookups is None:
-      self.vocab_lookups = self.create_vocab_lookup_ops(word_embedding_file)
-    return self.vocab_lookups
+  def get_lookup_ops(self, embedding_files=None):
+    graph = tf.get_default_graph()
+    key = tuple(embedding_files) if embedding_files else ()
+    graph_lookups = self.vocab_lookups.setdefault(graph, {})
+    if key not in graph_lookups:
+      graph_lookups[key] = self.create_vocab_lookup_ops(embedding_files)
+    return graph_lookups[key]
 
 
   '''
@@ -115,30 +382,41 @@ class Vocab:
       updatable = 'updatable' in data_config[d] and data_config[d]['updatable']
       if 'vocab' in data_config[d] and data_config[d]['vocab'] == d and (updatable or not update_only):
         this_vocab = OrderedDict({})
-        if update_only and updatable and d in self.vocab_maps:
-          this_vocab = self.vocab_maps[d]
+        if update_only and updatable and d in self.vocab_counts:
+          this_vocab = self.vocab_counts[d]
         vocabs.append(this_vocab)
         vocabs_index[d] = len(vocabs_index)
 
+    # vocabs that need to be written back to disk
+    changed_vocabs = set()
+
     # Create vocabs from data files
     if filenames:
       # print("debug <creating vocab>", filenames)
-      for filename in filenames:
-        with open(filename, 'r') as f:
-          for line in f:
-            line = line.strip()
-            if line:
-              split_line = line.split()
-              for d in vocabs_index.keys():
-                datum_idx = data_config[d]['conll_idx']
-                this_vocab_map = vocabs[vocabs_index[d]]
-                converter_name = data_config[d]['converter']['name'] if 'converter' in data_config[d] else 'default_converter'
-                converter_params = data_converters.get_params(data_config[d], split_line, datum_idx)
-                this_data = data_converters.dispatch(converter_name)(**converter_params)
-                for this_datum in this_data:
-                  if this_datum not in this_vocab_map:
-                    this_vocab_map[this_datum] = 0
-                  this_vocab_map[this_datum] += 1
+      merged_entries = {d: list(self.merged_entries.get(d, [])) if update_only else [] for d in vocabs_index.keys()}
+      entry_keys = {d: [self.get_index_entry_key(filename, data_config[d]) for filename in filenames]
+                    for d in vocabs_index.keys()}
+
+      # only count the files we haven't counted with the same converters before
+      to_count = [i for i in range(len(filenames))
+                  if any(entry_keys[d][i] not in self.vocab_index and entry_keys[d][i] not in merged_entries[d]
+                         for d in vocabs_index.keys())]
+      if to_count:
+        file_counts = count_vocab_files([filenames[i] for i in to_count], data_config, vocabs_index.keys())
+        for i, counts in zip(to_count, file_counts):
+          for d in vocabs_index.keys():
+            self.vocab_index[entry_keys[d][i]] = counts[d]
+
+      for d in vocabs_index.keys():
+        for entry_key in entry_keys[d]:
+          if entry_key not in merged_entries[d]:
+            merge_vocab_counts([self.vocab_index[entry_key]], vocabs[vocabs_index[d]])
+            merged_entries[d].append(entry_key)
+            changed_vocabs.add(d)
+        if not update_only:
+          changed_vocabs.add(d)
+        self.merged_entries[d] = merged_entries[d]
+      self.save_vocab_index()
 
     # Assume we have the vocabs saved to disk; load them
     else:
@@ -172,6 +450,7 @@ class Vocab:
         # this_map[len(this_map)] = constants.OOV_STRING
       self.reverse_maps[v] = reverse_map
       self.vocab_maps[v] = this_map
+      self.vocab_counts[v] = this_counts_map
 
       # check whether we need to build joint_label_lookup_map
       if 'label_components' in self.data_config[v]:
@@ -191,7 +470,7 @@ class Vocab:
         for map_name, joint_to_comp_map in zip(map_names, joint_to_comp_maps):
           self.joint_label_lookup_maps[map_name] = joint_to_comp_map
 
-    for d in vocabs_index.keys():
+    for d in changed_vocabs:
       # print("debug <updating vocab>: ", d)
 
       this_vocab_map = vocabs[vocabs_index[d]]
@@ -203,6 +482,44 @@ class Vocab:
 
     return {k: len(vocabs[vocabs_index[k]]) for k in vocabs_index.keys()}
 
+  '''
+  Key of the vocab index entry holding the counts of filename under the conversion defined by datum_config.
+  Changing the file (size or mtime) or the converter gives a new key, so the file gets counted again.
+  '''
+  def get_index_entry_key(self, filename, datum_config):
+    stat = os.stat(filename)
+    key = json.dumps([os.path.abspath(filename), stat.st_size, int(stat.st_mtime), datum_config], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+  '''
+  Loads the binary index of per-file vocab counts from the vocabs directory, if there is one.
+  '''
+  def load_vocab_index(self):
+    index_file = os.path.join(self.vocabs_dir, VOCAB_INDEX_FILE)
+    if os.path.exists(index_file):
+      with np.load(index_file) as index:
+        meta = json.loads(str(index['meta']))
+        for entry_key in meta['entries']:
+          self.vocab_index[entry_key] = OrderedDict(zip(index['%s_values' % entry_key].tolist(),
+                                                        index['%s_counts' % entry_key].tolist()))
+        self.merged_entries = meta['merged']
+      tf.logging.log(tf.logging.INFO, "Loaded vocab index with %d entries: %s" % (len(self.vocab_index), index_file))
+
+  '''
+  Saves the per-file vocab counts that make up the current vocabs as a binary index in the vocabs directory.
+  '''
+  def save_vocab_index(self):
+    used_entries = set(entry_key for entry_keys in self.merged_entries.values() for entry_key in entry_keys)
+    self.vocab_index = OrderedDict((k, v) for k, v in self.vocab_index.items() if k in used_entries)
+    arrays = {'meta': np.array(json.dumps({'entries': list(self.vocab_index.keys()), 'merged': self.merged_entries}))}
+    for entry_key, counts in self.vocab_index.items():
+      arrays['%s_values' % entry_key] = np.array(list(counts.keys()), dtype=str)
+      arrays['%s_counts' % entry_key] = np.array(list(counts.values()), dtype=np.int64)
+    index_file = os.path.join(self.vocabs_dir, VOCAB_INDEX_FILE)
+    with open(index_file + '.tmp', 'wb') as f:
+      np.savez(f, **arrays)
+    os.replace(index_file + '.tmp', index_file)
+
   def make_vocab_files(self, data_config, save_dir, filenames=None):
     vocabs = self.create_load_or_update_vocab_files(data_config, save_dir, filenames, False)
     # print(vocabs)